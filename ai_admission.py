@@ -0,0 +1,271 @@
+"""
+AI 上游请求准入控制
+按服务商限制同时进行的请求数和请求速率（令牌桶），超出时在公平队列中等待：
+交互式请求（编辑器中的补全、润色等）优先于批量任务，同一优先级内按客户端轮流放行，
+单个客户端的大量请求不会挤占其他客户端。排队过长或等待超时立即返回 429/503，不再把错误当作生成内容返回。
+线程（Flask）和 asyncio（ai_stream_server.py）均可使用。
+"""
+
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+
+# 优先级，数值越小越先放行
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITIES = {'interactive': PRIORITY_INTERACTIVE, 'bulk': PRIORITY_BULK}
+
+# 所有服务商的默认配置，可按服务商用 {名称}_MAX_CONCURRENCY 等环境变量覆盖
+# 同时进行的上游请求上限，0 表示不限制
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '32'))
+# 每秒放行的请求数及令牌桶容量（允许的突发请求数），0 表示不限速
+UPSTREAM_RATE_LIMIT = float(os.getenv('UPSTREAM_RATE_LIMIT', '0'))
+UPSTREAM_RATE_BURST = int(os.getenv('UPSTREAM_RATE_BURST', '10'))
+# 最多排队的请求数，超出时直接返回 429
+UPSTREAM_MAX_QUEUE = int(os.getenv('UPSTREAM_MAX_QUEUE', '256'))
+# 排队等待的最长时间（秒），超时返回 503
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', '10'))
+
+
+def parse_priority(value):
+    """请求中的优先级（interactive/bulk），缺省为交互式"""
+    return PRIORITIES.get(str(value).lower(), PRIORITY_INTERACTIVE) if value else PRIORITY_INTERACTIVE
+
+
+def admission_args(priority, identity=None, address=None, default_priority=PRIORITY_INTERACTIVE):
+    """准入排队所用的 (优先级, 客户端标识)
+
+    priority 为请求中的优先级（X-Priority 头或请求体的 priority），缺省时使用 default_priority；
+    已登录的请求按用户排队，否则按来源IP。
+    """
+    priority = parse_priority(priority) if priority else default_priority
+    client = f'user:{identity}' if identity is not None else f'ip:{address}'
+    return priority, client
+
+
+def _setting(provider, name, default, cast):
+    value = os.getenv(f'{provider.upper()}_{name}')
+    return cast(value) if value else default
+
+
+class AdmissionError(Exception):
+    """请求未获准入，status 为应返回的HTTP状态码，retry_after 为建议的重试间隔（秒）"""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, loop=None):
+        self.admitted = False
+        self.expired = False
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else threading.Event()
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class Permit:
+    """已获准入的请求，结束后调用 release() 归还并发名额，可重复调用"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    """单个服务商的准入控制
+
+    等待中的请求按 (优先级, 公平序号, 到达顺序) 排序；公平序号为该客户端上一个排队请求的序号加一，
+    但不小于已放行的最大序号，因此同一优先级内各客户端轮流放行。
+    """
+
+    def __init__(self, name, max_concurrency=None, rate=None, burst=None, max_queue=None, queue_timeout=None):
+        self.name = name
+        self.max_concurrency = max_concurrency if max_concurrency is not None else \
+            _setting(name, 'MAX_CONCURRENCY', UPSTREAM_MAX_CONCURRENCY, int)
+        self.rate = rate if rate is not None else _setting(name, 'RATE_LIMIT', UPSTREAM_RATE_LIMIT, float)
+        self.burst = burst if burst is not None else _setting(name, 'RATE_BURST', UPSTREAM_RATE_BURST, int)
+        self.max_queue = max_queue if max_queue is not None else _setting(name, 'MAX_QUEUE', UPSTREAM_MAX_QUEUE, int)
+        self.queue_timeout = queue_timeout if queue_timeout is not None else \
+            _setting(name, 'QUEUE_TIMEOUT', UPSTREAM_QUEUE_TIMEOUT, float)
+
+        self._lock = threading.Lock()
+        self._queue = []  # 堆，元素为 (优先级, 公平序号, 到达顺序, _Waiter)
+        self._sequence = itertools.count()
+        self._client_tags = {}  # 客户端 -> 最近一个排队请求的公平序号
+        self._virtual = 0  # 已放行的最大公平序号
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0  # 队列已满被拒绝的请求数
+        self.timeouts = 0  # 排队超时的请求数
+        self.wait_seconds = 0.0  # 获准入请求的累计排队时间
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _dispatch(self, current=None):
+        """持有锁时调用：按顺序放行队首的请求；因令牌不足停下时返回需等待的秒数，否则返回 None
+
+        current 为调用方自己的等待者，它会自行等待返回的秒数，不必唤醒。
+        """
+        while self._queue:
+            _, tag, _, waiter = self._queue[0]
+            if waiter.expired:
+                heapq.heappop(self._queue)
+                continue
+            if self.max_concurrency and self.active >= self.max_concurrency:
+                return None
+            if self.rate > 0:
+                self._refill(time.monotonic())
+                if self._tokens < 1:
+                    # 唤醒队首，由它等到下一个令牌
+                    if waiter is not current:
+                        waiter.wake()
+                    return (1 - self._tokens) / self.rate
+                self._tokens -= 1
+            heapq.heappop(self._queue)
+            self._virtual = max(self._virtual, tag)
+            self.active += 1
+            self.waiting -= 1
+            self.admitted += 1
+            waiter.admitted = True
+            waiter.wake()
+        return None
+
+    def _enqueue(self, waiter, priority, client):
+        if self.max_queue and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionError(f'{self.name} 请求过多，请稍后重试', 429, self._retry_after())
+        tag = max(self._virtual, self._client_tags.get(client, 0)) + 1
+        self._client_tags[client] = tag
+        if len(self._client_tags) > 4 * max(self.max_queue, 256):
+            # 清理已没有排队请求的客户端
+            self._client_tags = {c: t for c, t in self._client_tags.items() if t > self._virtual}
+        heapq.heappush(self._queue, (priority, tag, next(self._sequence), waiter))
+        self.waiting += 1
+        self._dispatch(waiter)
+
+    def _check(self, waiter, deadline):
+        """持有锁时调用：已放行返回 True；超时则移出队列并抛出 AdmissionError；否则返回本次应等待的秒数"""
+        if waiter.admitted:
+            return True
+        delay = self._dispatch(waiter)
+        if waiter.admitted:
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            waiter.expired = True
+            self.waiting -= 1
+            self.timeouts += 1
+            raise AdmissionError(f'{self.name} 繁忙，排队超时', 503, self._retry_after())
+        return min(remaining, delay) if delay is not None else remaining
+
+    def _retry_after(self):
+        if self.rate > 0:
+            return max(1, int(self.waiting / self.rate) + 1)
+        return max(1, int(self.queue_timeout))
+
+    def _admitted(self, started):
+        with self._lock:
+            self.wait_seconds += time.monotonic() - started
+        return Permit(self)
+
+    def _release(self):
+        with self._lock:
+            self.active -= 1
+            self._dispatch()
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, client=None):
+        """阻塞直到获准入，返回 Permit；队列已满或排队超时抛出 AdmissionError"""
+        started = time.monotonic()
+        deadline = started + self.queue_timeout
+        waiter = _Waiter()
+        with self._lock:
+            self._enqueue(waiter, priority, client)
+        while True:
+            with self._lock:
+                waiter.event.clear()
+                result = self._check(waiter, deadline)
+            if result is True:
+                return self._admitted(started)
+            waiter.event.wait(result)
+
+    async def acquire_async(self, priority=PRIORITY_INTERACTIVE, client=None):
+        """acquire 的 asyncio 版本"""
+        started = time.monotonic()
+        deadline = started + self.queue_timeout
+        waiter = _Waiter(asyncio.get_running_loop())
+        with self._lock:
+            self._enqueue(waiter, priority, client)
+        try:
+            while True:
+                with self._lock:
+                    waiter.event.clear()
+                    result = self._check(waiter, deadline)
+                if result is True:
+                    return self._admitted(started)
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), result)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            # 客户端在排队时断开
+            with self._lock:
+                if waiter.admitted:
+                    self.active -= 1
+                    self._dispatch()
+                elif not waiter.expired:
+                    waiter.expired = True
+                    self.waiting -= 1
+            raise
+
+    def render(self):
+        """Prometheus 文本格式的指标行（不含 HELP/TYPE）"""
+        label = f'{{provider="{self.name}"}}'
+        with self._lock:
+            return [
+                f'upstream_admission_active{label} {self.active}',
+                f'upstream_admission_waiting{label} {self.waiting}',
+                f'upstream_admission_admitted_total{label} {self.admitted}',
+                f'upstream_admission_rejected_total{label} {self.rejected}',
+                f'upstream_admission_timeouts_total{label} {self.timeouts}',
+                f'upstream_admission_wait_seconds_total{label} {self.wait_seconds}',
+            ]
+
+
+ADMISSION_HELP = (
+    ('upstream_admission_active', 'gauge', '已获准入、正在进行的上游请求数'),
+    ('upstream_admission_waiting', 'gauge', '排队等待准入的请求数'),
+    ('upstream_admission_admitted_total', 'counter', '获准入的请求数'),
+    ('upstream_admission_rejected_total', 'counter', '队列已满被拒绝的请求数'),
+    ('upstream_admission_timeouts_total', 'counter', '排队超时的请求数'),
+    ('upstream_admission_wait_seconds_total', 'counter', '获准入请求的累计排队时间（秒）'),
+)
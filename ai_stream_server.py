@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+AI 流式代理服务器
+在一个 asyncio 事件循环中转发 AIFunc 和 ChatGLM 的流式生成，等待上游时不占用线程，
+少量线程即可同时承载大量生成，不再为每个生成占用一个 Flask 工作进程/线程。
+客户端断开时立即关闭上游连接，停止消耗服务商额度。
+
+接口与 Flask 版本相同：POST /function/AIFunc、POST /function/chatglm/stream，
+部署时由反向代理把这两个路径转发到本服务；GET /metrics 返回 Prometheus 格式的运行指标。
+
+用法: python ai_stream_server.py [--host 0.0.0.0] [--port 5001]
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import logging
+import os
+
+import aiohttp
+from aiohttp import web
+
+import ai_utils
+import collab_auth
+from ai_admission import AdmissionError, admission_args
+from app import CORS_ORIGINS
+from app.function import upstream
+from app.function.longtext import AsyncLongTextJob
+from app.function.singleflight import FlightError, SingleFlight
+from app.metrics import describe
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 同时保持的上游连接上限（所有服务商合计），每个进行中的生成占用一个连接
+AI_STREAM_MAX_CONNECTIONS = int(os.getenv('AI_STREAM_MAX_CONNECTIONS', '1000'))
+# 可信的反向代理地址（IP 或网段，逗号分隔），只有直接来自这些地址的请求才按 X-Forwarded-For 取客户端IP，
+# 否则客户端可以随意改写该头绕过按客户端的公平排队和限速
+AI_STREAM_TRUSTED_PROXIES = [ipaddress.ip_network(value.strip(), strict=False)
+                             for value in os.getenv('AI_STREAM_TRUSTED_PROXIES', '').split(',') if value.strip()]
+
+
+class AIStreamProxy:
+    """共享一个 aiohttp 连接池转发所有流式生成
+
+    超时、重试、准入和上游指标使用 Flask 版本的 upstream 客户端（request_async），
+    合并相同请求和长文本分块使用 singleflight、longtext 模块的 asyncio 版本，行为与 Flask 版本一致。
+    """
+
+    def __init__(self, cache=None):
+        self.session = None
+        self.cache = cache  # ai_utils.ResponseCache，未启用缓存时为None
+        # 只合并本进程内的请求
+        self.flights = SingleFlight(None, shared=False)
+        self.active = 0
+        self.streams_total = 0
+        self.cancelled = 0  # 客户端中途断开的生成数
+        self.errors = 0
+
+    async def start(self, app):
+        connector = aiohttp.TCPConnector(limit=AI_STREAM_MAX_CONNECTIONS, limit_per_host=0)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self, app):
+        await self.session.close()
+
+    async def _cache_call(self, method, *args):
+        """Redis 为同步客户端，放到线程池中执行"""
+        return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+    async def upstream_stream(self, client, url, headers, payload, cache_key=None):
+        """请求上游并逐块产出增量文本，出错时抛出异常；完整结束（收到 [DONE]）时把结果写入缓存"""
+        self.active += 1
+        self.streams_total += 1
+        chunks = []
+        try:
+            response = await client.request_async(self.session, 'POST', url, headers=headers, json=payload)
+            try:
+                response.raise_for_status()
+                async for line in response.content:
+                    content = ai_utils.parse_stream_line(line)
+                    if content is ai_utils.STREAM_DONE:
+                        # 读完剩余部分，连接回到连接池复用
+                        await response.read()
+                        if cache_key is not None:
+                            await self._cache_call(self.cache.set, cache_key, ''.join(chunks))
+                        break
+                    if content:
+                        chunks.append(content)
+                        yield content
+            except BaseException:
+                # 出错或客户端断开时关闭上游连接，服务商随之停止生成
+                response.close()
+                raise
+            finally:
+                response.release()
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.active -= 1
+
+    async def cached_stream(self, prompt, params, regenerate=False):
+        """长文本各块的生成，命中缓存时直接回放，文档修改后只有变动的块需要重新生成"""
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(ai_utils.SILICONFLOW_MODEL, prompt, params)
+            cached = None if regenerate else await self._cache_call(self.cache.get, cache_key)
+            if cached is not None:
+                for chunk in self.cache.replay(cached):
+                    yield chunk
+                return
+        headers, payload = ai_utils.siliconflow_request(prompt, params)
+        source = self.upstream_stream(upstream.siliconflow, ai_utils.SILICONFLOW_BASE_URL, headers, payload, cache_key)
+        try:
+            async for chunk in source:
+                yield chunk
+        finally:
+            await source.aclose()
+
+    async def stream(self, request, key, produce, admit):
+        """把生成的增量文本逐块写给客户端，与 Flask 版本相同只输出文本本身
+
+        key 相同的生成正在进行时直接读取它的输出，不再请求上游；key 为 None 时总是发起新的生成。
+        未获准入时返回 429/503；生成失败时把错误说明作为文本输出。
+        """
+        try:
+            source = await self.flights.stream_async(key, produce, admit)
+        except AdmissionError as e:
+            return rejected(e)
+        except FlightError as e:
+            source = error_text(e)
+        return await self.reply(request, source, 'MISS')
+
+    @staticmethod
+    async def reply(request, source, cache_status):
+        """把异步迭代器 source 的文本块写给客户端；客户端断开时关闭 source"""
+        reply = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'X-Cache': cache_status})
+        try:
+            await reply.prepare(request)
+            try:
+                async for chunk in source:
+                    await reply.write(chunk.encode('utf-8'))
+            except FlightError as e:
+                async for chunk in error_text(e):
+                    await reply.write(chunk.encode('utf-8'))
+        finally:
+            await source.aclose()
+        await reply.write_eof()
+        return reply
+
+    async def aifunc(self, request):
+        data = await request.json()
+        command = data['command']
+        text = data['text']
+        params = ai_utils.AIFUNC_PARAMS
+        # 长文本分块处理，续写只需要文本末尾
+        chunks = ai_utils.split_text(text) if ai_utils.estimate_tokens(text) > ai_utils.AI_LONG_TEXT_THRESHOLD else [text]
+        if command in ai_utils.TAIL_COMMANDS:
+            chunks = chunks[-1:]
+        prompt = ai_utils.build_prompt(command, chunks[0] if len(chunks) == 1 else text, data)
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(ai_utils.SILICONFLOW_MODEL, prompt, params)
+            cached = None if data.get('regenerate') else await self._cache_call(self.cache.get, cache_key)
+            if cached is not None:
+                return await self.reply(request, replay(self.cache.replay(cached)), 'HIT')
+
+        priority, client = request_admission_args(request, data)
+
+        def admit():
+            return upstream.siliconflow.admission.acquire_async(priority, client)
+
+        async def generate_siliconflow():
+            headers, payload = ai_utils.siliconflow_request(prompt, params)
+            source = self.upstream_stream(upstream.siliconflow, ai_utils.SILICONFLOW_BASE_URL, headers, payload,
+                                          cache_key)
+            try:
+                async for chunk in source:
+                    yield chunk
+            except Exception as e:
+                yield f"处理请求时发生错误: {str(e)}"
+            finally:
+                await source.aclose()
+
+        async def generate_long_text():
+            job = AsyncLongTextJob(command, chunks, data,
+                                   lambda chunk_prompt: self.cached_stream(chunk_prompt, params, data.get('regenerate')),
+                                   admit)
+            pieces = []
+            source = job.__aiter__()
+            try:
+                async for piece in source:
+                    pieces.append(piece)
+                    yield piece
+            except Exception as e:
+                yield f"处理请求时发生错误: {str(e)}"
+                return
+            finally:
+                await source.aclose()
+            if cache_key is not None and not job.failed:
+                await self._cache_call(self.cache.set, cache_key, ''.join(pieces))
+
+        # 用户要求重新生成时不合并到进行中的生成
+        key = None if data.get('regenerate') else \
+            'AIFunc:' + ai_utils.request_digest(ai_utils.SILICONFLOW_MODEL, prompt, params)
+        return await self.stream(request, key, generate_long_text if len(chunks) > 1 else generate_siliconflow,
+                                 admit)
+
+    async def chatglm_stream(self, request):
+        if not ai_utils.CHATGLM_API_KEY:
+            return web.json_response({'message': 'ChatGLM API 密钥未配置', 'code': 400})
+        data = await request.json()
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {ai_utils.CHATGLM_API_KEY}"
+        }
+        payload = ai_utils.chatglm_payload(data, stream=True)
+        priority, client = request_admission_args(request, data)
+
+        def produce():
+            return self.upstream_stream(upstream.chatglm, ai_utils.CHATGLM_API_URL, headers, payload)
+        return await self.stream(request, 'chatglm:' + ai_utils.chatglm_digest(payload), produce,
+                                 lambda: upstream.chatglm.admission.acquire_async(priority, client))
+
+    async def metrics(self, request):
+        lines = []
+        for name, metric_type, help_text, value in (
+            ('ai_stream_active', 'gauge', '正在转发的生成数', self.active),
+            ('ai_stream_total', 'counter', '转发过的生成总数', self.streams_total),
+            ('ai_stream_cancelled_total', 'counter', '客户端中途断开而取消的生成数', self.cancelled),
+            ('ai_stream_errors_total', 'counter', '上游出错的生成数', self.errors),
+        ):
+            lines += describe(name, metric_type, help_text)
+            lines.append(f'{name} {value}')
+        # 上游响应耗时、重试和准入指标与 Flask 版本相同
+        text = upstream.render_metrics() + '\n'.join(lines + self.flights.render()) + '\n'
+        return web.Response(text=text, content_type='text/plain')
+
+
+def _trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except (TypeError, ValueError):
+        return False
+    return any(address in network for network in AI_STREAM_TRUSTED_PROXIES)
+
+
+def client_address(request):
+    """请求的来源IP
+
+    直接连接的地址不是可信代理时忽略 X-Forwarded-For；否则从右向左跳过可信代理，取第一个其他地址。
+    """
+    address = request.remote
+    if not _trusted_proxy(address):
+        return address
+    forwarded = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+    for hop in reversed(forwarded):
+        address = hop
+        if not _trusted_proxy(hop):
+            break
+    return address
+
+
+def request_admission_args(request, data):
+    """准入排队所用的优先级和客户端标识：携带有效JWT的请求按用户排队，否则按来源IP"""
+    try:
+        identity = collab_auth.decode_identity(collab_auth.extract_token(headers=request.headers))
+    except collab_auth.AuthError:
+        identity = None
+    return admission_args(request.headers.get('X-Priority') or data.get('priority'), identity, client_address(request))
+
+
+async def replay(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def error_text(e):
+    """生成失败时输出的说明，与 Flask 版本相同作为文本返回"""
+    yield f"处理请求时发生错误: {str(e)}"
+
+
+def rejected(e):
+    """未获准入时立即返回对应的状态码，不再当作生成内容返回"""
+    return web.json_response({'message': e.message, 'code': e.status}, status=e.status,
+                             headers={'Retry-After': str(e.retry_after)})
+
+
+@web.middleware
+async def preflight_middleware(request, handler):
+    """应答跨域预检请求"""
+    if request.method != 'OPTIONS':
+        return await handler(request)
+    return web.Response(headers={
+        'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
+        'Access-Control-Allow-Headers': request.headers.get('Access-Control-Request-Headers',
+                                                            'Content-Type, Authorization')
+    })
+
+
+async def add_cors_headers(request, response):
+    """与 Flask 应用使用相同的 CORS_ORIGINS：列出的来源允许携带凭据，* 允许任意来源但不带凭据
+
+    流式响应在发出响应头之前添加。
+    """
+    origin = request.headers.get('Origin')
+    if not origin:
+        return
+    if origin in CORS_ORIGINS:
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.headers['Vary'] = 'Origin'
+    elif '*' in CORS_ORIGINS:
+        response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+PROXY_KEY = web.AppKey('proxy', AIStreamProxy)
+
+
+def create_app(cache=None):
+    if cache is None and ai_utils.AI_CACHE_ENABLED:
+        import redis
+        client = redis.Redis.from_url(os.getenv('REDIS_DATABASE_URI', 'redis://localhost:6379/0'),
+                                      decode_responses=True)
+        cache = ai_utils.ResponseCache(client)
+    proxy = AIStreamProxy(cache)
+    app = web.Application(middlewares=[preflight_middleware])
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_startup.append(proxy.start)
+    app.on_cleanup.append(proxy.close)
+    app.router.add_post('/function/AIFunc', proxy.aifunc)
+    app.router.add_post('/function/chatglm/stream', proxy.chatglm_stream)
+    app.router.add_get('/metrics', proxy.metrics)
+    app[PROXY_KEY] = proxy
+    return app
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='AI 流式代理服务器')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+    # 客户端断开时取消对应的处理协程，随之关闭上游连接
+    web.run_app(create_app(), host=args.host, port=args.port, handler_cancellation=True)
+
+
+if __name__ == '__main__':
+    main()
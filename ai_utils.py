@@ -0,0 +1,269 @@
+"""
+AI 功能公共工具
+供 ai_stream_server.py 与 Flask AI 功能模块共用：服务商配置、prompt 构建、流式响应解析、
+重试退避和结果缓存
+"""
+
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# SiliconFlow API配置
+SILICONFLOW_API_KEY = os.getenv('SILICONFLOW_API_KEY')
+SILICONFLOW_BASE_URL = os.getenv('SILICONFLOW_BASE_URL', 'https://api.siliconflow.cn/v1/chat/completions')
+SILICONFLOW_MODEL = os.getenv('SILICONFLOW_MODEL', 'Qwen/Qwen2.5-7B-Instruct')
+
+# ChatGLM API配置
+CHATGLM_API_URL = os.getenv('CHATGLM_API_URL', 'https://open.bigmodel.cn/api/paas/v4/chat/completions')
+CHATGLM_API_KEY = os.getenv('CHATGLM_API_KEY', '填写key')
+
+# AIFunc 的生成参数
+AIFUNC_PARAMS = {"max_tokens": 2048, "temperature": 0.7}
+
+# 是否缓存 AI 文本指令的结果（默认关闭）
+AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'False').lower() in ('true', '1', 't')
+# 缓存有效期（秒）
+AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', str(24 * 60 * 60)))
+# 最多保留的条目数，超出时淘汰最久未命中的条目
+AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', '10000'))
+# 超过该长度（字符）的结果不缓存
+AI_CACHE_MAX_ENTRY_CHARS = int(os.getenv('AI_CACHE_MAX_ENTRY_CHARS', '32768'))
+# 命中时按该长度（字符）分块回放，保持与流式响应相同的格式
+AI_CACHE_REPLAY_CHUNK = int(os.getenv('AI_CACHE_REPLAY_CHUNK', '64'))
+
+CACHE_KEY_PREFIX = 'ai_cache:'
+# 有序集合，成员为缓存键，分数为最近一次写入或命中的时间
+CACHE_INDEX_KEY = 'ai_cache_index'
+
+# 上游可重试的状态码
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# AI 文本指令对应的 prompt 模板
+PROMPT_TEMPLATES = {
+    '续写': '请根据以下内容进行续写，保持原有的风格和语气，只输出续写的部分：\n{text}',
+    '润色': '请对以下内容进行润色，使表达更加流畅、准确，只输出润色后的内容：\n{text}',
+    '校对': '请校对以下内容中的错别字、语法和标点错误，只输出修改后的内容：\n{text}',
+    '翻译': '请把以下内容翻译为{language}，只输出译文：\n{text}',
+    '摘要': '请为以下内容生成简洁的摘要：\n{text}',
+    '扩写': '请对以下内容进行扩写，丰富细节，只输出扩写后的内容：\n{text}',
+    '缩写': '请在保留要点的前提下精简以下内容，只输出精简后的内容：\n{text}',
+}
+
+# 长文本处理：超过 AI_LONG_TEXT_THRESHOLD 个估算token的文本按结构分块（每块不超过 AI_LONG_TEXT_CHUNK_TOKENS），
+# 各块并行处理（单个请求最多 AI_LONG_TEXT_CONCURRENCY 块同时进行）后按顺序输出
+AI_LONG_TEXT_THRESHOLD = int(os.getenv('AI_LONG_TEXT_THRESHOLD', '3000'))
+AI_LONG_TEXT_CHUNK_TOKENS = int(os.getenv('AI_LONG_TEXT_CHUNK_TOKENS', '1500'))
+AI_LONG_TEXT_CONCURRENCY = int(os.getenv('AI_LONG_TEXT_CONCURRENCY', '4'))
+
+# 需要归并步骤的指令：各块结果不直接输出，而是合并为最终结果；其余指令各块结果按顺序拼接即为最终结果
+REDUCE_TEMPLATES = {
+    '摘要': '以下依次是一篇长文各部分的摘要，请把它们整合为一篇连贯、简洁的全文摘要：\n{text}',
+}
+# 只依赖文本末尾的指令，长文本只取最后一块
+TAIL_COMMANDS = ('续写',)
+
+# 标题行：Markdown 标题、"第X章/节"、"一、"、"1." / "1.2 " 等编号
+HEADING_RE = re.compile(r'^\s*(#{1,6}\s|第[一二三四五六七八九十百千零〇\d]+[章节部分篇]|[一二三四五六七八九十]+、|\d+(\.\d+)*[、.．\s])')
+# 句末位置，用于切分过长的段落
+SENTENCE_END_RE = re.compile(r'(?<=[。！？!?；;])|(?<=\.\s)')
+
+# 流式响应结束标记
+STREAM_DONE = object()
+
+
+def build_prompt(command, text, data):
+    """根据指令构建 prompt，未知指令把指令本身作为要求"""
+    template = PROMPT_TEMPLATES.get(command)
+    if template is None:
+        return f'{command}：\n{text}'
+    return template.format(text=text, language=data.get('language', '英文'))
+
+
+def estimate_tokens(text):
+    """估算文本的token数：中日韩字符和全角标点约每字一个token，其余约每4个字符一个token"""
+    wide = sum(1 for ch in text if ch >= '\u2e80')
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _split_oversized(text, budget):
+    """把超过预算的段落先按句、再按字符切开"""
+    piece = ''
+    for sentence in SENTENCE_END_RE.split(text):
+        if estimate_tokens(piece + sentence) <= budget:
+            piece += sentence
+            continue
+        if piece:
+            yield piece
+        piece = sentence
+        while estimate_tokens(piece) > budget:
+            size = max(1, len(piece) * budget // estimate_tokens(piece))
+            yield piece[:size]
+            piece = piece[size:]
+    if piece:
+        yield piece
+
+
+def split_text(text, budget=AI_LONG_TEXT_CHUNK_TOKENS):
+    """按标题和段落把文本切成不超过 budget 个估算token的块，各块依次拼接即为原文
+
+    以段落（行）为单位装入当前块，放不下时另起一块；当前块已用过半时遇到标题也另起一块，使章节尽量完整。
+    """
+    chunks = []
+    current, size = '', 0
+    for line in text.splitlines(keepends=True):
+        pieces = [line] if estimate_tokens(line) <= budget else _split_oversized(line, budget)
+        for piece in pieces:
+            tokens = estimate_tokens(piece)
+            if current.strip() and (size + tokens > budget or (HEADING_RE.match(piece) and size >= budget // 2)):
+                chunks.append(current)
+                current, size = '', 0
+            current += piece
+            size += tokens
+    if current.strip() or not chunks:
+        chunks.append(current)
+    else:
+        chunks[-1] += current
+    return chunks
+
+
+def reduce_prompt(command, results):
+    """归并步骤的 prompt，results 为各块结果"""
+    parts = '\n\n'.join(f'第{index}部分：\n{result.strip()}' for index, result in enumerate(results, 1))
+    return REDUCE_TEMPLATES[command].format(text=parts)
+
+
+def request_digest(model, prompt, params):
+    """模型、prompt 和生成参数的哈希，相同的请求得到相同的结果"""
+    return hashlib.sha256(
+        json.dumps({'model': model, 'prompt': prompt, 'params': params}, sort_keys=True, ensure_ascii=False)
+        .encode('utf-8')
+    ).hexdigest()
+
+
+def chatglm_digest(payload):
+    """ChatGLM 请求体的哈希，流式与非流式请求的哈希不同"""
+    params = {name: value for name, value in payload.items() if name not in ('model', 'messages')}
+    return request_digest(payload['model'], payload['messages'], params)
+
+
+def siliconflow_request(prompt, params):
+    """SiliconFlow 流式生成的请求头和请求体"""
+    headers = {
+        "Authorization": f"Bearer {SILICONFLOW_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "model": SILICONFLOW_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True,
+        **params
+    }
+    return headers, payload
+
+
+def chatglm_payload(data, stream):
+    """按请求数据构建 ChatGLM 请求体"""
+    payload = {
+        "model": data.get('model', 'glm-4-flash'),
+        "messages": data.get('messages', []),
+        "temperature": data.get('temperature', 0.7),
+        "top_p": data.get('top_p', 0.9),
+        "max_tokens": data.get('max_tokens', 1024)
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+def parse_stream_line(line):
+    """解析一行 OpenAI 兼容的流式响应，返回增量文本、STREAM_DONE 或 None（无内容的行）"""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    line = line.strip()
+    if not line.startswith('data: '):
+        return None
+    data = line[6:]
+    if data == '[DONE]':
+        return STREAM_DONE
+    try:
+        choices = json.loads(data).get('choices', [])
+    except ValueError:
+        return None
+    if not choices:
+        return None
+    return choices[0].get('delta', {}).get('content', '') or None
+
+
+def retry_delay(attempt, retry_after, base, cap):
+    """第 attempt 次重试前的等待时间：优先使用服务商给出的 Retry-After，否则为 [0, base * 2^attempt] 内的随机值"""
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), cap)
+    return random.uniform(0, min(base * (2 ** attempt), cap))
+
+
+class ResponseCache:
+    """大模型文本结果缓存
+
+    键为模型、prompt 和生成参数的哈希，值为完整的生成结果，存放在 Redis 中并设置过期时间。
+    条目数超过上限时按最近使用时间淘汰。Redis 不可用时视为未命中，不影响正常调用。
+    """
+
+    def __init__(self, client, enabled=AI_CACHE_ENABLED):
+        self.client = client
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, prompt, params):
+        return CACHE_KEY_PREFIX + request_digest(model, prompt, params)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        try:
+            value = self.client.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.client.zadd(CACHE_INDEX_KEY, {key: time.time()})
+            return value
+        except Exception as e:
+            logger.warning(f"读取AI结果缓存失败: {str(e)}")
+            return None
+
+    def set(self, key, text):
+        if not self.enabled or not text or len(text) > AI_CACHE_MAX_ENTRY_CHARS:
+            return
+        now = time.time()
+        try:
+            pipe = self.client.pipeline()
+            pipe.set(key, text, ex=AI_CACHE_TTL)
+            pipe.zadd(CACHE_INDEX_KEY, {key: now})
+            # 已过期条目的索引一并清理
+            pipe.zremrangebyscore(CACHE_INDEX_KEY, 0, now - AI_CACHE_TTL)
+            pipe.zcard(CACHE_INDEX_KEY)
+            size = pipe.execute()[-1]
+            if size > AI_CACHE_MAX_ENTRIES:
+                evicted = [member for member, _ in self.client.zpopmin(CACHE_INDEX_KEY, size - AI_CACHE_MAX_ENTRIES)]
+                if evicted:
+                    self.client.delete(*evicted)
+        except Exception as e:
+            logger.warning(f"写入AI结果缓存失败: {str(e)}")
+
+    @staticmethod
+    def replay(text):
+        """把缓存的结果按块依次产出，客户端看到的仍是流式响应"""
+        for start in range(0, len(text), AI_CACHE_REPLAY_CHUNK):
+            yield text[start:start + AI_CACHE_REPLAY_CHUNK]
@@ -16,12 +16,19 @@ from .function import function as function_blueprint
 from .knowledge_base.views import knowledge_base_bp
 from .collaboration import collaboration as collaboration_blueprint
 from .collaboration.views import init_socketio_events
+from .collaboration.snapshots import snapshotter
+from .collaboration.materializer import materializer
+from .collaboration import compression
 from .auth.utils import create_default_users  # 导入创建默认用户的函数
 
 
+# 允许跨域访问的来源，逗号分隔；为 * 时允许任意来源，但不允许携带凭据（Cookie）。AI 流式代理使用同一配置
+CORS_ORIGINS = [origin.strip() for origin in os.getenv('CORS_ORIGINS', '*').split(',') if origin.strip()]
+
+
 def create_app():
     app = Flask(__name__)
-    CORS(app, supports_credentials=True)  # 允许跨域请求
+    CORS(app, origins=CORS_ORIGINS, supports_credentials='*' not in CORS_ORIGINS)  # 允许跨域请求
 
     # 配置日志
     logging.basicConfig(
@@ -43,6 +50,9 @@ def create_app():
         logging.warning("JWT_SECRET 未设置，使用生产模式默认密钥")
     app.config['JWT_SECRET_KEY'] = jwt_secret
     
+    # 请求体大小上限（字节），超出时直接返回 413，避免解析表单时把任意大的上传写入临时文件
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', str(100 * 1024 * 1024)))
+
     # JWT 过期配置
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = 24 * 60 * 60  # 设置 ACCESS_TOKEN 过期时间为24小时
     
@@ -136,17 +146,24 @@ def create_app():
             return jsonify({"message": "缺少令牌，但在开发模式下被接受", "code": "200"}), 200
         return jsonify({"message": f"缺少Token: {error}", "code": "401"}), 401
 
-    # 初始化 SocketIO
+    # 初始化 SocketIO，逐包日志开销较大，默认关闭
+    socketio_debug_log = os.getenv('SOCKETIO_DEBUG_LOG', 'False').lower() in ('true', '1', 't')
+    compression.install_websocket_compression()
     socketio = SocketIO(
         app,
         cors_allowed_origins="*",  # 允许所有来源的跨域请求
         async_mode='threading',  # 使用threading异步模式
-        logger=True,
-        engineio_logger=True
+        logger=socketio_debug_log,
+        engineio_logger=socketio_debug_log,
+        **compression.socketio_options()  # 压缩策略
     )
 
     # 初始化SocketIO事件处理器
     init_socketio_events(socketio)
+    # 初始化协同状态快照器
+    snapshotter.init_app(app, socketio)
+    # 初始化协同文档写回任务
+    materializer.init_app(app, socketio)
 
     # 将socketio实例存储到app中，供其他地方使用
     app.socketio = socketio
@@ -2,7 +2,7 @@ from flask import Blueprint
 
 collaboration = Blueprint('collaboration', __name__)
 
-from . import views
+from . import views, models
 from .websocket_test import websocket_test
 
 # 注册测试路由
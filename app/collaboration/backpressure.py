@@ -0,0 +1,107 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 单个连接出站队列的高/低水位（数据包数）：超过高水位后跳过中间更新，回落到低水位后补发完整快照
+OUTBOUND_HIGH_WATERMARK = int(os.getenv('COLLAB_OUTBOUND_HIGH_WATERMARK', '256'))
+OUTBOUND_LOW_WATERMARK = int(os.getenv('COLLAB_OUTBOUND_LOW_WATERMARK', '32'))
+# 出站队列硬上限，超过即断开连接
+OUTBOUND_HARD_LIMIT = int(os.getenv('COLLAB_OUTBOUND_HARD_LIMIT', '2048'))
+# 连接持续落后超过该时间（秒）即断开
+OUTBOUND_MAX_LAG_SECONDS = float(os.getenv('COLLAB_OUTBOUND_MAX_LAG_SECONDS', '30'))
+
+# check 的返回值
+SEND = 'send'  # 正常发送
+SKIP = 'skip'  # 跳过本次更新
+RESYNC = 'resync'  # 已追上，需要补发完整快照
+DROP = 'drop'  # 无法追上，断开连接
+
+
+class OutboundRegulator:
+    """慢连接的出站背压控制
+
+    根据 Engine.IO 连接出站队列的积压判断每个接收者的状态，落后的连接被排除在
+    房间广播之外，不会拖慢其他参与者。
+    """
+
+    def __init__(self):
+        self.socketio = None
+        self._lagging = {}  # sid -> 开始落后的时间
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.resynced = 0
+        self.dropped = 0
+
+    def init_app(self, socketio):
+        self.socketio = socketio
+
+    def queue_depth(self, sid, namespace='/'):
+        """连接出站队列中尚未发出的数据包数"""
+        if self.socketio is None or self.socketio.server is None:
+            return 0
+        server = self.socketio.server
+        try:
+            eio_sid = server.manager.eio_sid_from_sid(sid, namespace)
+            socket = server.eio.sockets.get(eio_sid)
+            return socket.queue.qsize() if socket is not None else 0
+        except Exception:
+            return 0
+
+    def check(self, sid):
+        depth = self.queue_depth(sid)
+        now = time.monotonic()
+        with self._lock:
+            since = self._lagging.get(sid)
+            if since is None:
+                if depth <= OUTBOUND_HIGH_WATERMARK:
+                    return SEND
+                self._lagging[sid] = now
+                self.skipped += 1
+                logger.warning(f"连接 {sid} 出站队列积压 {depth}，暂停增量更新")
+                return SKIP
+            if depth > OUTBOUND_HARD_LIMIT or now - since > OUTBOUND_MAX_LAG_SECONDS:
+                del self._lagging[sid]
+                self.dropped += 1
+                return DROP
+            if depth <= OUTBOUND_LOW_WATERMARK:
+                del self._lagging[sid]
+                self.resynced += 1
+                return RESYNC
+            self.skipped += 1
+            return SKIP
+
+    def partition(self, sids, exclude=None):
+        """把接收者分为 (需要跳过的, 需要补发快照的, 需要断开的) 三组"""
+        skip, resync, drop = [], [], []
+        for sid in sids:
+            if sid == exclude:
+                continue
+            decision = self.check(sid)
+            if decision == SKIP:
+                skip.append(sid)
+            elif decision == RESYNC:
+                resync.append(sid)
+            elif decision == DROP:
+                drop.append(sid)
+        return skip, resync, drop
+
+    def is_lagging(self, sid):
+        return sid in self._lagging
+
+    def forget(self, sid):
+        with self._lock:
+            self._lagging.pop(sid, None)
+
+    def disconnect(self, sid):
+        logger.warning(f"连接 {sid} 长时间无法跟上更新，断开连接")
+        self.forget(sid)
+        try:
+            self.socketio.server.disconnect(sid)
+        except Exception as e:
+            logger.error(f"断开慢连接失败: {str(e)}")
+
+
+regulator = OutboundRegulator()
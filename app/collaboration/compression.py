@@ -0,0 +1,77 @@
+import os
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# WebSocket permessage-deflate 压缩策略：off 不压缩；always 全部压缩；adaptive 只压缩超过阈值的消息
+WS_COMPRESSION = os.getenv('COLLAB_WS_COMPRESSION', 'adaptive')
+# adaptive 策略下压缩的最小消息大小（字节），同时作为长轮询HTTP响应的压缩阈值
+WS_COMPRESSION_THRESHOLD = int(os.getenv('COLLAB_WS_COMPRESSION_THRESHOLD', '256'))
+# 服务端压缩窗口位数（9-15）和 zlib memLevel（1-9），决定每个连接保留的压缩内存
+WS_COMPRESSION_WINDOW_BITS = int(os.getenv('COLLAB_WS_COMPRESSION_WINDOW_BITS', '12'))
+WS_COMPRESSION_MEM_LEVEL = int(os.getenv('COLLAB_WS_COMPRESSION_MEM_LEVEL', '5'))
+
+
+def socketio_options():
+    """SocketIO 构造参数中与压缩相关的部分（长轮询传输）"""
+    return {
+        'http_compression': WS_COMPRESSION != 'off',
+        'compression_threshold': WS_COMPRESSION_THRESHOLD if WS_COMPRESSION == 'adaptive' else 0
+    }
+
+
+def install_websocket_compression():
+    """按策略配置 simple-websocket 的 permessage-deflate 扩展
+
+    simple-websocket 在握手时固定接受 wsproto 的 PerMessageDeflate()，没有配置入口，
+    这里替换其模块中的扩展类，并用到 wsproto 的私有属性 _compressor、_compressible_opcode
+    （版本见 requirements.txt）。未安装 simple-websocket 时不做处理；
+    升级后这些入口不存在时保留默认的压缩行为并记录警告。
+    """
+    try:
+        from simple_websocket import ws
+        from wsproto.extensions import PerMessageDeflate
+        from wsproto.frame_protocol import Opcode
+    except ImportError:
+        return False
+
+    if not hasattr(ws, 'PerMessageDeflate'):
+        logger.warning("simple-websocket 不再通过 PerMessageDeflate 协商压缩，压缩策略未生效")
+        return False
+    probe = PerMessageDeflate()
+    if not hasattr(probe, '_compressor') or not callable(getattr(probe, '_compressible_opcode', None)):
+        logger.warning("wsproto 的 PerMessageDeflate 实现已变化，使用默认的压缩行为，压缩策略未生效")
+        return False
+
+    class PolicyPerMessageDeflate(PerMessageDeflate):
+        """按策略决定是否接受压缩、是否压缩单条消息，并限制压缩窗口和memLevel"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._skip_message = False
+
+        def accept(self, offer):
+            if WS_COMPRESSION == 'off':
+                return None
+            accepted = super().accept(offer)
+            # 服务端使用不大于协商值的窗口即可，客户端按更大的窗口解压不受影响
+            self.server_max_window_bits = min(self.server_max_window_bits, WS_COMPRESSION_WINDOW_BITS)
+            return accepted
+
+        def frame_outbound(self, proto, opcode, rsv, data, fin):
+            if opcode in (Opcode.TEXT, Opcode.BINARY):
+                # 分片消息只根据第一帧决定，后续帧沿用
+                self._skip_message = WS_COMPRESSION == 'adaptive' and fin and len(data) < WS_COMPRESSION_THRESHOLD
+                if not self._skip_message and self._compressor is None:
+                    bits = self.client_max_window_bits if proto.client else self.server_max_window_bits
+                    self._compressor = zlib.compressobj(
+                        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -int(bits), WS_COMPRESSION_MEM_LEVEL
+                    )
+            if self._skip_message and self._compressible_opcode(opcode):
+                return rsv, data
+            return super().frame_outbound(proto, opcode, rsv, data, fin)
+
+    ws.PerMessageDeflate = PolicyPerMessageDeflate
+    logger.info(f"WebSocket压缩策略: {WS_COMPRESSION}")
+    return True
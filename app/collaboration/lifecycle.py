@@ -0,0 +1,161 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from . import wire
+from .metrics import metrics
+from .presence import presence
+from .snapshots import snapshotter
+from .state import document_states, room_users, state_lock, all_operations
+
+logger = logging.getLogger(__name__)
+
+# 房间清空后保留的时间（秒），期间重新加入无需重建房间
+ROOM_GRACE_SECONDS = float(os.getenv('COLLAB_ROOM_GRACE_SECONDS', '60'))
+# 无人编辑的文档状态在内存中保留的最长时间（秒）
+STATE_IDLE_SECONDS = float(os.getenv('COLLAB_STATE_IDLE_SECONDS', '600'))
+# 所有文档状态的内存预算（字节），超出时按最近最少使用淘汰无人编辑的文档
+STATE_MEMORY_BUDGET = int(os.getenv('COLLAB_STATE_MEMORY_BUDGET', str(64 * 1024 * 1024)))
+# 回收任务的检查周期（秒）
+REAPER_INTERVAL = float(os.getenv('COLLAB_REAPER_INTERVAL', '10'))
+
+
+def _operation_size(operation):
+    payload = wire.operation_to_bytes(operation)
+    return len(payload) if payload is not None else len(str(operation))
+
+
+def state_size(state):
+    """估算文档状态占用的字节数"""
+    return len(state.get('content') or '') + sum(_operation_size(op) for op in all_operations(state))
+
+
+class RoomLifecycle:
+    """房间与文档状态的生命周期管理
+
+    房间清空超过 ROOM_GRACE_SECONDS 后回收房间记录；文档状态写入快照后，
+    空闲超过 STATE_IDLE_SECONDS 或总量超出 STATE_MEMORY_BUDGET 时按LRU淘汰，
+    下次加入时再从快照恢复。
+    """
+
+    def __init__(self):
+        self.socketio = None
+        self._last_used = OrderedDict()  # document_id -> 最近使用时间，按使用先后排序
+        self._emptied_at = {}  # document_id -> 房间清空的时间
+        self._lock = threading.Lock()
+        self._task = None
+        self.evicted = 0
+
+    def init_app(self, socketio):
+        self.socketio = socketio
+
+    def touch(self, document_id):
+        """记录文档被使用，房间重新有人时取消回收"""
+        with self._lock:
+            self._last_used[document_id] = time.monotonic()
+            self._last_used.move_to_end(document_id)
+            self._emptied_at.pop(document_id, None)
+            if self._task is None and self.socketio is not None:
+                self._task = self.socketio.start_background_task(self._run)
+
+    def room_emptied(self, document_id):
+        with self._lock:
+            self._emptied_at[document_id] = time.monotonic()
+
+    def _reap_rooms(self, now):
+        with self._lock:
+            expired = [document_id for document_id, emptied_at in self._emptied_at.items()
+                       if now - emptied_at >= ROOM_GRACE_SECONDS]
+        for document_id in expired:
+            room = f"doc_{document_id}"
+            with state_lock:
+                if room_users.get(room):
+                    continue
+                room_users.pop(room, None)
+                wire.participant_indexes.pop(room, None)
+            metrics.forget_room(room)
+            with self._lock:
+                self._emptied_at.pop(document_id, None)
+        return len(expired)
+
+    def _evict(self, document_id):
+        """写入快照后从内存移除文档状态，房间仍有人或写入后又有新操作时放弃"""
+        room = f"doc_{document_id}"
+        state = document_states.get(document_id)
+        if state is None or room_users.get(room):
+            return False
+        snapshotter.flush([document_id])
+        with state_lock:
+            if room_users.get(room) or not snapshotter.is_persisted(document_id, state):
+                return False
+            document_states.pop(document_id, None)
+            room_users.pop(room, None)
+        presence.discard_room(room)
+        snapshotter.forget(document_id)
+        metrics.forget_room(room)
+        with self._lock:
+            self._last_used.pop(document_id, None)
+            self._emptied_at.pop(document_id, None)
+        self.evicted += 1
+        return True
+
+    def _idle_documents(self):
+        """按最近最少使用顺序返回无人编辑的文档"""
+        with self._lock:
+            candidates = list(self._last_used.items())
+        return [(document_id, last_used) for document_id, last_used in candidates
+                if not room_users.get(f"doc_{document_id}")]
+
+    def reap(self):
+        now = time.monotonic()
+        self._reap_rooms(now)
+
+        evicted = 0
+        for document_id, last_used in self._idle_documents():
+            if now - last_used >= STATE_IDLE_SECONDS and self._evict(document_id):
+                evicted += 1
+
+        retained = self.retained_bytes()
+        if retained > STATE_MEMORY_BUDGET:
+            for document_id, _ in self._idle_documents():
+                size = state_size(document_states.get(document_id) or {'content': '', 'operations': []})
+                if self._evict(document_id):
+                    evicted += 1
+                    retained -= size
+                    if retained <= STATE_MEMORY_BUDGET:
+                        break
+            if retained > STATE_MEMORY_BUDGET:
+                logger.warning(f"协同文档状态超出内存预算: {retained} > {STATE_MEMORY_BUDGET} 字节")
+
+        if evicted:
+            logger.info(f"已从内存淘汰 {evicted} 个空闲协同文档")
+        return evicted
+
+    def retained_bytes(self):
+        return sum(state_size(state) for state in list(document_states.values()))
+
+    def gauges(self):
+        """房间、参与者与内存占用的实时指标"""
+        active_rooms = [users for users in list(room_users.values()) if users]
+        return {
+            'rooms': len(room_users),
+            'active_rooms': len(active_rooms),
+            'participants': sum(len(users) for users in active_rooms),
+            'documents': len(document_states),
+            'retained_bytes': self.retained_bytes(),
+            'memory_budget': STATE_MEMORY_BUDGET,
+            'evicted_documents': self.evicted
+        }
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(REAPER_INTERVAL)
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"协同房间回收任务错误: {str(e)}")
+
+
+lifecycle = RoomLifecycle()
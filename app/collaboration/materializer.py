@@ -0,0 +1,179 @@
+import os
+import time
+import logging
+import threading
+import traceback
+from urllib.parse import unquote
+
+import collab_auth
+import yjs_utils
+from database import db
+from app.document.models import Documents
+from app.document.utils import save_document_content
+
+logger = logging.getLogger(__name__)
+
+# 物化任务的检查周期（秒），0 表示关闭
+MATERIALIZE_INTERVAL = float(os.getenv('COLLAB_MATERIALIZE_INTERVAL', '10'))
+# 同一文档两次写回 documents 表之间的最小间隔（秒）
+MATERIALIZE_DEBOUNCE = float(os.getenv('COLLAB_MATERIALIZE_DEBOUNCE', '30'))
+# 同一文档两次创建版本之间的最小间隔（秒），间隔内的写回只更新内容
+MATERIALIZE_VERSION_INTERVAL = float(os.getenv('COLLAB_MATERIALIZE_VERSION_INTERVAL', '600'))
+# Y.js 服务器的数据目录，为空或不存在时不扫描
+MATERIALIZE_YJS_DIR = os.getenv('YJS_DATA_DIR', '')
+# Tiptap 协同字段名
+YJS_FRAGMENT = os.getenv('COLLAB_YJS_FRAGMENT', yjs_utils.DEFAULT_FRAGMENT)
+
+VERSION_SUMMARY = '协同编辑自动保存'
+
+
+class DocumentMaterializer:
+    """把协同文档的合并状态写回 documents 表
+
+    Socket.IO 协同写入快照后提交合并好的Y.js状态；Y.js 服务器的数据目录按文件修改时间扫描，
+    有变化的文档以只读方式合并快照和日志。两者都经过防抖，走与 PUT 接口相同的保存逻辑
+    （创建版本、刷新缓存），协同期间客户端无需再提交整篇文档。
+
+    documents.content 是文档的权威内容，只写回能由HTML完整还原的文档（yjs_utils.render_html 的 strict 模式）；
+    含有无法渲染的节点、mark或属性的文档不写回，仍由客户端保存，渲染结果只保存在快照中。
+    """
+
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.store = None
+        self._pending = {}  # document_id -> 待写回的Y.js状态
+        self._dirty_rooms = set()  # 日志或快照有变化、待渲染的 Y.js 房间
+        self._mtimes = {}  # (Y.js 房间, 文件后缀) -> 最近一次看到的修改时间
+        self._last_save = {}  # document_id -> 上次写回时间
+        self._last_version = {}  # document_id -> 上次创建版本时间
+        self._lossy = set()  # 无法完整渲染为HTML、已记录过日志的文档
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        if MATERIALIZE_INTERVAL <= 0:
+            return
+        if MATERIALIZE_YJS_DIR and os.path.isdir(MATERIALIZE_YJS_DIR):
+            self.store = yjs_utils.YjsSnapshotStore(MATERIALIZE_YJS_DIR)
+        self._task = socketio.start_background_task(self._run)
+
+    def submit(self, document_id, state):
+        """提交一个文档合并后的Y.js状态，等待下一个周期写回"""
+        if self.app is None or not isinstance(document_id, int) or not state:
+            return
+        with self._lock:
+            self._pending[document_id] = state
+
+    def _due(self, document_id, now):
+        last_save = self._last_save.get(document_id)
+        return last_save is None or now - last_save >= MATERIALIZE_DEBOUNCE
+
+    def _render(self, document_id, state):
+        """渲染可以代替 documents.content 的HTML，含有无法还原的内容或渲染失败时返回 None"""
+        try:
+            html = yjs_utils.render_html(state, YJS_FRAGMENT, strict=True)
+        except yjs_utils.UnsupportedContent as e:
+            if document_id not in self._lossy:
+                self._lossy.add(document_id)
+                logger.info(f"协同文档无法完整渲染为HTML，不写回文档表: document_id={document_id}, {str(e)}")
+            return None
+        except Exception as e:
+            logger.warning(f"渲染协同文档失败: document_id={document_id}, {str(e)}")
+            return None
+        self._lossy.discard(document_id)
+        # 空文档多半是尚未同步完成的新房间，不覆盖已有内容
+        return html or None
+
+    def _scan_yjs(self, now):
+        """找出数据目录中有变化的房间，读取到期房间的Y.js状态"""
+        try:
+            names = os.listdir(self.store.directory)
+        except OSError as e:
+            logger.warning(f"扫描Y.js数据目录失败: {str(e)}")
+            return {}
+        for name in names:
+            room, suffix = os.path.splitext(name)
+            if suffix not in ('.ylog', '.ystate'):
+                continue
+            try:
+                mtime = os.stat(os.path.join(self.store.directory, name)).st_mtime
+            except FileNotFoundError:
+                continue
+            key = (unquote(room), suffix)
+            if self._mtimes.get(key) != mtime:
+                self._mtimes[key] = mtime
+                self._dirty_rooms.add(key[0])
+
+        states = {}
+        for room in list(self._dirty_rooms):
+            document_id = collab_auth.document_id_from_room(room)
+            if document_id is None:
+                self._dirty_rooms.discard(room)
+                continue
+            if not self._due(document_id, now):
+                continue
+            self._dirty_rooms.discard(room)
+            try:
+                states[document_id] = self.store.peek(room)
+            except Exception as e:
+                logger.warning(f"读取Y.js文档失败: room={room}, {str(e)}")
+        return states
+
+    def materialize(self):
+        """把到期文档写回 documents 表，返回写回的文档数"""
+        now = time.monotonic()
+        with self._lock:
+            due = {document_id: state for document_id, state in self._pending.items() if self._due(document_id, now)}
+            for document_id in due:
+                del self._pending[document_id]
+        if self.store is not None:
+            due.update(self._scan_yjs(now))
+        if not due:
+            return 0
+
+        saved = 0
+        with self.app.app_context():
+            try:
+                for document_id, state in due.items():
+                    html = self._render(document_id, state)
+                    if html is None:
+                        continue
+                    doc = Documents.query.filter_by(id=document_id, is_deleted=False).first()
+                    if doc is None or doc.content == html:
+                        continue
+                    last_version = self._last_version.get(document_id)
+                    create_version = last_version is None or now - last_version >= MATERIALIZE_VERSION_INTERVAL
+                    try:
+                        save_document_content(doc, html, doc.user_id, create_version=create_version,
+                                              version_summary=VERSION_SUMMARY)
+                    except Exception as e:
+                        logger.error(f"写回协同文档失败: document_id={document_id}, {str(e)}")
+                        logger.error(traceback.format_exc())
+                        db.session.rollback()
+                        # 留待下个周期重试，期间提交的更新内容优先
+                        with self._lock:
+                            self._pending.setdefault(document_id, state)
+                        continue
+                    self._last_save[document_id] = now
+                    if create_version:
+                        self._last_version[document_id] = now
+                    saved += 1
+            finally:
+                db.session.remove()
+        if saved:
+            logger.info(f"已将 {saved} 个协同文档写回文档表")
+        return saved
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(MATERIALIZE_INTERVAL)
+            try:
+                self.materialize()
+            except Exception as e:
+                logger.error(f"协同文档写回任务错误: {str(e)}")
+
+
+materializer = DocumentMaterializer()
@@ -0,0 +1,99 @@
+import threading
+
+from app.metrics import Histogram, describe, format_labels, format_number
+
+# 直方图分桶
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+# 直方图指标：名称 -> (说明, 分桶)
+_HISTOGRAMS = {
+    'collab_fanout_size': ('每次操作广播的接收者数', FANOUT_BUCKETS),
+    'collab_emit_seconds': ('一次操作广播的耗时（秒）', LATENCY_BUCKETS),
+    'collab_payload_bytes': ('文档操作的载荷大小（字节）', SIZE_BUCKETS),
+    'collab_join_seconds': ('加入文档的处理耗时（秒）', LATENCY_BUCKETS),
+}
+
+
+class CollaborationMetrics:
+    """协同编辑指标，按房间和全局两个维度统计，以 Prometheus 文本格式导出"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connected_sockets = 0
+        self.rejected_sockets = 0  # 握手时认证或授权失败被拒绝的连接数
+        self.operations_total = 0
+        self.room_operations = {}  # room -> 操作数
+        self.histograms = {name: Histogram(buckets) for name, (_, buckets) in _HISTOGRAMS.items()}
+        self.room_histograms = {}  # room -> {name: Histogram}
+
+    def _room_histogram(self, room, name):
+        histograms = self.room_histograms.setdefault(room, {})
+        if name not in histograms:
+            histograms[name] = Histogram(_HISTOGRAMS[name][1])
+        return histograms[name]
+
+    def _observe(self, room, name, value):
+        self.histograms[name].observe(value)
+        self._room_histogram(room, name).observe(value)
+
+    def socket_connected(self):
+        with self._lock:
+            self.connected_sockets += 1
+
+    def socket_rejected(self):
+        with self._lock:
+            self.rejected_sockets += 1
+
+    def socket_disconnected(self):
+        with self._lock:
+            self.connected_sockets = max(self.connected_sockets - 1, 0)
+
+    def record_operation(self, room, payload_bytes, fanout, emit_seconds):
+        with self._lock:
+            self.operations_total += 1
+            self.room_operations[room] = self.room_operations.get(room, 0) + 1
+            self._observe(room, 'collab_payload_bytes', payload_bytes)
+            self._observe(room, 'collab_fanout_size', fanout)
+            self._observe(room, 'collab_emit_seconds', emit_seconds)
+
+    def record_join(self, room, seconds):
+        with self._lock:
+            self._observe(room, 'collab_join_seconds', seconds)
+
+    def forget_room(self, room):
+        """房间被回收后删除其指标，避免标签无限增长"""
+        with self._lock:
+            self.room_operations.pop(room, None)
+            self.room_histograms.pop(room, None)
+
+    def render(self, extra=None):
+        """导出 Prometheus 文本格式，extra 为附加的指标 {名称: (说明, 类型, 数值)}"""
+        lines = []
+        with self._lock:
+            lines += describe('collab_connected_sockets', 'gauge', '当前连接的Socket数')
+            lines.append(f'collab_connected_sockets {self.connected_sockets}')
+            lines += describe('collab_rejected_sockets_total', 'counter', '握手时认证失败被拒绝的连接数')
+            lines.append(f'collab_rejected_sockets_total {self.rejected_sockets}')
+            lines += describe('collab_operations_total', 'counter', '收到的文档操作数（用 rate() 计算每秒操作数）')
+            lines.append(f'collab_operations_total {self.operations_total}')
+            lines += describe('collab_room_operations_total', 'counter', '各房间收到的文档操作数')
+            lines += [f'collab_room_operations_total{format_labels({"room": room})} {count}'
+                      for room, count in self.room_operations.items()]
+            for name, (help_text, _) in _HISTOGRAMS.items():
+                lines += describe(name, 'histogram', help_text)
+                lines += self.histograms[name].render(name, {})
+                room_name = 'collab_room_' + name[len('collab_'):]
+                lines += describe(room_name, 'histogram', f'{help_text}（按房间）')
+                for room, histograms in self.room_histograms.items():
+                    if name in histograms:
+                        lines += histograms[name].render(room_name, {'room': room})
+        for name, (help_text, metric_type, value) in (extra or {}).items():
+            lines += describe(name, metric_type, help_text)
+            lines.append(f'{name} {format_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = CollaborationMetrics()
@@ -0,0 +1,20 @@
+from datetime import datetime
+
+import pytz
+
+from database import db
+
+
+class CollaborationSnapshots(db.Model):
+    """协同编辑状态快照表，保存收敛后的Y.js文档状态及其HTML渲染结果"""
+    __tablename__ = 'collaboration_snapshots'
+
+    document_id = db.Column(db.String(64), primary_key=True)  # 协同文档ID
+    version = db.Column(db.Integer, nullable=False, default=0)  # 快照对应的操作版本号
+    content = db.Column(db.Text, nullable=False, default='')  # 文档的HTML渲染
+    state = db.Column(db.LargeBinary(length=2 ** 32 - 1), nullable=True)  # 合并后的Y.js文档状态
+    operations = db.Column(db.Text(length=2 ** 32 - 1), nullable=True)  # 无法合并进 state 的操作日志（JSON），全部合并时为空
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('Asia/Shanghai')), nullable=False)
+
+    def __repr__(self):
+        return f'<CollaborationSnapshot {self.document_id}-v{self.version}>'
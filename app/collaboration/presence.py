@@ -0,0 +1,131 @@
+import os
+import logging
+import threading
+
+from .backpressure import regulator
+from .state import room_users
+
+logger = logging.getLogger(__name__)
+
+# 光标/感知信息广播周期（毫秒），设置为0时所有连接都逐条立即广播
+PRESENCE_TICK_MS = int(os.getenv('COLLAB_PRESENCE_TICK_MS', '40'))
+
+# 连接可协商的感知信息接收方式
+PRESENCE_LEGACY = 'legacy'  # 逐条接收 cursor_position/awareness_update
+PRESENCE_BATCH = 'batch'  # 每个tick接收一帧 presence_batch
+
+
+class PresenceBroadcaster:
+    """光标与感知信息的合并广播器
+
+    只有协商为 batch 的连接接收合并帧：每个房间只保留每个参与者最新的光标/感知状态，
+    由后台任务每个tick为每个有变化的房间发送 presence_batch，被覆盖的中间状态直接丢弃。
+    未声明的旧客户端仍逐条接收 cursor_position/awareness_update，两种连接互相能看到对方的光标。
+    批量帧中不含接收者自己的状态。
+    """
+
+    def __init__(self, tick_ms=PRESENCE_TICK_MS):
+        self.interval = max(tick_ms, 0) / 1000.0
+        self.socketio = None
+        self.batch_sids = set()  # 协商为 batch 的连接
+        self._pending = {}  # room -> {'document_id': ..., 'participants': {sid: {...}}}
+        self._lock = threading.Lock()
+        self._task = None
+        self.received = 0  # 收到的原始事件数
+        self.emitted = 0  # 实际发出的批量帧数
+
+    def init_app(self, socketio):
+        self.socketio = socketio
+
+    @property
+    def enabled(self):
+        return self.socketio is not None and self.interval > 0
+
+    def negotiate(self, sid, requested):
+        """根据客户端请求确定连接的感知信息接收方式，未声明的旧客户端或关闭合并时为 legacy"""
+        if requested == PRESENCE_BATCH and self.interval > 0:
+            self.batch_sids.add(sid)
+            return PRESENCE_BATCH
+        self.batch_sids.discard(sid)
+        return PRESENCE_LEGACY
+
+    def forget(self, sid):
+        self.batch_sids.discard(sid)
+
+    def split_room(self, room):
+        """把房间成员分为 (batch 连接, legacy 连接)"""
+        members = list(room_users.get(room, ()))
+        batched = [sid for sid in members if sid in self.batch_sids]
+        legacy = [sid for sid in members if sid not in self.batch_sids]
+        return batched, legacy
+
+    def submit(self, room, document_id, sid, kind, payload):
+        """记录参与者的最新状态，kind 为 'cursor' 或 'awareness'"""
+        with self._lock:
+            batch = self._pending.get(room)
+            if batch is None:
+                batch = self._pending[room] = {'document_id': document_id, 'participants': {}}
+            batch['participants'].setdefault(sid, {})[kind] = payload
+            self.received += 1
+            if self._task is None:
+                self._task = self.socketio.start_background_task(self._run)
+
+    def discard(self, room, sid):
+        """参与者离开房间时丢弃其尚未发出的状态"""
+        with self._lock:
+            batch = self._pending.get(room)
+            if batch is not None:
+                batch['participants'].pop(sid, None)
+                if not batch['participants']:
+                    del self._pending[room]
+
+    def discard_room(self, room):
+        with self._lock:
+            self._pending.pop(room, None)
+
+    def flush(self):
+        """把各房间积累的状态发给房间内的 batch 连接，每个房间一帧，发送者收到的帧中去掉自己的状态"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        for room, batch in pending.items():
+            batched, legacy = self.split_room(room)
+            # 出站队列积压的连接不接收感知信息，等其追上后随下一帧更新
+            lagging = {sid for sid in batched if regulator.is_lagging(sid)}
+            recipients = [sid for sid in batched if sid not in lagging]
+            if not recipients:
+                continue
+            participants = batch['participants']
+            skip = legacy + list(lagging) + [sid for sid in recipients if sid in participants]
+            if len(skip) < len(batched) + len(legacy):
+                self._emit(batch['document_id'], participants, room=room, skip_sid=skip or None)
+            for sid in recipients:
+                if sid in participants and len(participants) > 1:
+                    others = {other: state for other, state in participants.items() if other != sid}
+                    self._emit(batch['document_id'], others, room=sid)
+
+    def _emit(self, document_id, participants, room, skip_sid=None):
+        cursors = []
+        awareness = []
+        for sid, state in participants.items():
+            if 'cursor' in state:
+                cursors.append(dict(state['cursor'], user_id=sid))
+            if 'awareness' in state:
+                awareness.append({'user_id': sid, 'awareness': state['awareness']})
+        self.socketio.emit('presence_batch', {
+            'document_id': document_id,
+            'cursors': cursors,
+            'awareness': awareness
+        }, room=room, skip_sid=skip_sid)
+        self.emitted += 1
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"感知信息批量广播错误: {str(e)}")
+
+
+presence = PresenceBroadcaster()
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import base64
+import logging
+import threading
+import traceback
+from datetime import datetime
+
+import pytz
+
+import yjs_utils
+from database import db
+from app.document.models import Documents
+from . import wire
+from .materializer import materializer
+from .models import CollaborationSnapshots
+from .state import document_states, new_document_state, state_lock
+
+logger = logging.getLogger(__name__)
+
+# 快照后台任务的检查周期（秒）
+SNAPSHOT_INTERVAL = float(os.getenv('COLLAB_SNAPSHOT_INTERVAL', '5'))
+# 同一文档两次写入之间的最小间隔（秒）
+SNAPSHOT_DEBOUNCE = float(os.getenv('COLLAB_SNAPSHOT_DEBOUNCE', '30'))
+# 每个周期最多写入的文档数，所有文档在同一个事务中提交
+SNAPSHOT_BATCH_SIZE = int(os.getenv('COLLAB_SNAPSHOT_BATCH_SIZE', '100'))
+# Tiptap 协同字段名
+YJS_FRAGMENT = os.getenv('COLLAB_YJS_FRAGMENT', yjs_utils.DEFAULT_FRAGMENT)
+
+
+def build_snapshot(state):
+    """把内存中的协同状态合并为 (版本号, HTML, Y.js状态, 操作日志)
+
+    操作日志全部能还原为Y.js更新时合并进Y.js状态，操作日志为None；否则Y.js状态只含已压缩的部分，
+    操作日志原样返回并与快照一起保存，文档被淘汰或服务重启后重连的客户端仍能增量补齐。
+    """
+    with state_lock:
+        version = state['version']
+        snapshot = state.get('snapshot')
+        operations = list(state['operations'])
+        compactable = state['compactable']
+    content = state.get('content', '')
+    updates = [wire.operation_to_bytes(op) for op in operations] if compactable else None
+    if updates is None or any(update is None for update in updates):
+        return version, content, snapshot, operations
+
+    merged = yjs_utils.merge_updates(([snapshot] if snapshot else []) + updates)
+    if merged:
+        try:
+            content = yjs_utils.render_html(merged, YJS_FRAGMENT)
+        except Exception as e:
+            logger.warning(f"渲染协同文档HTML失败，沿用上次内容: {str(e)}")
+    return version, content, merged, None
+
+
+def dump_operations(operations):
+    """把操作日志序列化为JSON，字节形式的操作编码为 {"$bytes": base64}"""
+    return json.dumps([
+        {'$bytes': base64.b64encode(op).decode('ascii')} if isinstance(op, (bytes, bytearray)) else op
+        for op in operations
+    ], ensure_ascii=False)
+
+
+def load_operations(text):
+    """dump_operations 的逆操作，text 为空时返回空列表"""
+    if not text:
+        return []
+    return [
+        base64.b64decode(op['$bytes']) if isinstance(op, dict) and list(op) == ['$bytes'] else op
+        for op in json.loads(text)
+    ]
+
+
+class DocumentSnapshotter:
+    """协同状态快照器
+
+    文档收到操作后标记为脏，后台任务按周期批量写入 collaboration_snapshots，
+    同一文档在 SNAPSHOT_DEBOUNCE 内最多写一次；房间清空时立即安排写入。
+    """
+
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self._dirty = {}  # document_id -> 是否需要立即写入
+        self._last_flush = {}  # document_id -> (写入时间, 版本号)
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+
+    def mark_dirty(self, document_id, urgent=False):
+        if self.app is None:
+            return
+        with self._lock:
+            self._dirty[document_id] = self._dirty.get(document_id, False) or urgent
+            if self._task is None:
+                self._task = self.socketio.start_background_task(self._run)
+
+    def request_flush(self, document_id):
+        """房间清空时调用，下一个周期即写入，不受防抖限制"""
+        if document_id in document_states:
+            self.mark_dirty(document_id, urgent=True)
+
+    def is_persisted(self, document_id, state):
+        """文档状态是否已全部写入快照（未收到过操作的文档无需写入）"""
+        _, flushed_version = self._last_flush.get(document_id, (None, state['base_version']))
+        return state['version'] == flushed_version
+
+    def forget(self, document_id):
+        """文档状态被淘汰后清理写入记录"""
+        with self._lock:
+            self._dirty.pop(document_id, None)
+            self._last_flush.pop(document_id, None)
+
+    def load(self, document_id):
+        """从快照表或文档表中恢复协同状态，需在应用上下文中调用"""
+        try:
+            snapshot = db.session.get(CollaborationSnapshots, str(document_id))
+            if snapshot is not None:
+                self._last_flush[document_id] = (time.monotonic(), snapshot.version)
+                return new_document_state(snapshot.content, snapshot.version, snapshot.state or None,
+                                          load_operations(snapshot.operations))
+            if isinstance(document_id, int):
+                doc = db.session.get(Documents, document_id)
+                if doc is not None:
+                    return new_document_state(doc.content)
+        except Exception as e:
+            logger.error(f"加载协同快照失败: document_id={document_id}, {str(e)}")
+        return None
+
+    def _due(self):
+        """选出本周期需要写入的文档"""
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for document_id, urgent in list(self._dirty.items()):
+                if len(due) >= SNAPSHOT_BATCH_SIZE:
+                    break
+                last_time, _ = self._last_flush.get(document_id, (None, None))
+                if urgent or last_time is None or now - last_time >= SNAPSHOT_DEBOUNCE:
+                    due.append(document_id)
+                    del self._dirty[document_id]
+        return due
+
+    def flush(self, document_ids=None):
+        """把指定文档（默认为到期文档）的快照在一个事务中写入数据库"""
+        if document_ids is None:
+            document_ids = self._due()
+
+        rows = {}
+        for document_id in document_ids:
+            state = document_states.get(document_id)
+            if state is None:
+                continue
+            _, flushed_version = self._last_flush.get(document_id, (None, None))
+            if state['version'] == flushed_version:
+                continue
+            snapshot = build_snapshot(state)
+            # 新加入的用户直接拿到最新的HTML渲染
+            state['content'] = snapshot[1]
+            rows[str(document_id)] = (document_id, snapshot)
+        if not rows:
+            return 0
+
+        with self.app.app_context():
+            try:
+                existing = {
+                    snapshot.document_id: snapshot
+                    for snapshot in CollaborationSnapshots.query.filter(
+                        CollaborationSnapshots.document_id.in_(list(rows.keys()))).all()
+                }
+                now = datetime.now(pytz.timezone('Asia/Shanghai'))
+                for key, (_, (version, content, state, operations)) in rows.items():
+                    snapshot = existing.get(key)
+                    if snapshot is None:
+                        snapshot = CollaborationSnapshots(document_id=key)
+                        db.session.add(snapshot)
+                    snapshot.version = version
+                    snapshot.content = content or ''
+                    snapshot.state = state
+                    snapshot.operations = dump_operations(operations) if operations is not None else None
+                    snapshot.updated_at = now
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"写入协同快照失败: {str(e)}")
+                logger.error(traceback.format_exc())
+                db.session.rollback()
+                # 失败的文档留待下个周期重试
+                for document_id, _ in rows.values():
+                    self.mark_dirty(document_id)
+                return 0
+            finally:
+                db.session.remove()
+
+        flushed_at = time.monotonic()
+        for document_id, (version, content, state, operations) in rows.values():
+            self._last_flush[document_id] = (flushed_at, version)
+            # 全部操作都已并入Y.js状态的文档才交给物化任务，其余沿用客户端保存
+            if operations is None and state is not None:
+                materializer.submit(document_id, state)
+        logger.info(f"已写入 {len(rows)} 个协同文档快照")
+        return len(rows)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"协同快照任务错误: {str(e)}")
+
+
+snapshotter = DocumentSnapshotter()
@@ -0,0 +1,104 @@
+import os
+import threading
+
+import yjs_utils
+from . import wire
+
+# 内存中保留的最大操作数，超过后把较早的操作合并进快照
+OPLOG_MAX_OPERATIONS = int(os.getenv('COLLAB_OPLOG_MAX_OPERATIONS', '500'))
+# 合并后保留的最近操作数，供断线重连的客户端增量补齐
+OPLOG_RETAIN_OPERATIONS = int(os.getenv('COLLAB_OPLOG_RETAIN_OPERATIONS', '200'))
+# 含无法还原为Y.js更新的操作、不能压缩的日志最多保留的操作数，超出时以保存的文档内容为基准整体重新同步
+OPLOG_MAX_UNCOMPACTED = int(os.getenv('COLLAB_OPLOG_MAX_UNCOMPACTED', '2000'))
+
+# 存储文档的协同编辑状态
+document_states = {}
+# 存储房间中的用户
+room_users = {}
+# 保护操作日志的追加、压缩与读取
+state_lock = threading.RLock()
+
+
+def new_document_state(content='', version=0, snapshot=None, operations=()):
+    """创建文档协同状态
+
+    snapshot 为合并到 base_version 为止的Y.js状态，operations 依次对应
+    base_version + 1 到 version 的操作。
+    """
+    operations = list(operations)
+    return {
+        'content': content,
+        'version': version,
+        'base_version': version - len(operations),
+        'snapshot': snapshot,
+        'operations': operations,
+        'compactable': True  # 操作日志能否合并进Y.js快照，发现无法还原的操作后不再尝试
+    }
+
+
+def all_operations(state):
+    """完整重建文档所需的操作列表：快照在前，其后为操作日志"""
+    with state_lock:
+        operations = list(state['operations'])
+        if state.get('snapshot'):
+            operations.insert(0, state['snapshot'])
+        return operations
+
+
+def operations_since(state, version):
+    """返回客户端版本之后缺失的操作，缺口已被合并进快照或版本无效时返回None"""
+    if not isinstance(version, int):
+        return None
+    with state_lock:
+        if version < state['base_version'] or version > state['version']:
+            return None
+        return list(state['operations'][version - state['base_version']:])
+
+
+def append_operation(state, operation):
+    """追加操作并在日志过长时压缩，返回新版本号"""
+    with state_lock:
+        state['version'] += 1
+        state['operations'].append(operation)
+        if len(state['operations']) > OPLOG_MAX_OPERATIONS and state['compactable']:
+            compact(state)
+        return state['version']
+
+
+def compact(state, retain=None):
+    """把除最近 retain 个以外的操作合并进快照
+
+    操作无法还原为Y.js更新时不压缩，并把状态标记为不可压缩，之后追加操作时不再重复转换整个日志。
+    """
+    if retain is None:
+        retain = OPLOG_RETAIN_OPERATIONS
+    with state_lock:
+        count = len(state['operations']) - retain
+        if count <= 0 or not state['compactable']:
+            return False
+        folded = [wire.operation_to_bytes(op) for op in state['operations'][:count]]
+        if any(update is None for update in folded):
+            state['compactable'] = False
+            return False
+        state['snapshot'] = yjs_utils.merge_updates([state.get('snapshot') or b''] + folded)
+        state['base_version'] += count
+        del state['operations'][:count]
+        return True
+
+
+def needs_reset(state):
+    """不能压缩的操作日志是否已超出 OPLOG_MAX_UNCOMPACTED"""
+    with state_lock:
+        return not state['compactable'] and len(state['operations']) > OPLOG_MAX_UNCOMPACTED
+
+
+def reset(state, content):
+    """丢弃操作日志，以 content 为新的基准并推进版本号，之前的所有版本都需要完整同步"""
+    with state_lock:
+        state['version'] += 1
+        state['base_version'] = state['version']
+        state['content'] = content
+        state['snapshot'] = None
+        state['operations'] = []
+        state['compactable'] = True
+        return state['version']
@@ -1,25 +1,215 @@
+import os
+import time
+import random
 import logging
-from flask import request
-from flask_socketio import emit, join_room, leave_room, rooms
-from flask_jwt_extended import decode_token, get_jwt_identity
+from flask import request, jsonify, Response, session
+from flask_socketio import emit, join_room, leave_room, rooms, ConnectionRefusedError
+from flask_jwt_extended import decode_token
+import collab_auth
+from database import db
+from app.document.models import Documents
 from . import collaboration
-
-# 存储文档的协同编辑状态
-document_states = {}
-# 存储房间中的用户
-room_users = {}
+from .presence import presence
+from . import wire
+from .snapshots import snapshotter
+from .lifecycle import lifecycle
+from .backpressure import regulator
+from .metrics import metrics
+from .state import (document_states, room_users, state_lock, new_document_state, all_operations, operations_since,
+                    append_operation, needs_reset, reset, OPLOG_MAX_UNCOMPACTED)
 
 logger = logging.getLogger(__name__)
 
+# 逐条操作日志的采样率，仅在 DEBUG 级别输出
+OP_LOG_SAMPLE_RATE = float(os.getenv('COLLAB_OP_LOG_SAMPLE_RATE', '0.01'))
+
+
+def _normalize_document_id(document_id):
+    """统一文档ID类型，避免 1 和 "1" 被当作两个文档"""
+    if isinstance(document_id, str) and document_id.isdigit():
+        return int(document_id)
+    return document_id
+
+
+def _authenticate(auth):
+    """握手时校验JWT，用户ID和文档权限缓存在会话中，失败时抛出 collab_auth.AuthError"""
+    session['permissions'] = {}
+    if not collab_auth.AUTH_REQUIRED:
+        session['user_id'] = None
+        return
+    token = collab_auth.extract_token(auth, request.query_string.decode(), request.headers)
+    if not token:
+        raise collab_auth.AuthError('缺少Token')
+    try:
+        claims = decode_token(token)
+    except Exception as e:
+        raise collab_auth.AuthError(f'无效的Token: {str(e)}')
+    # 刷新令牌只能用于换取新的访问令牌
+    if claims.get('type') != 'access':
+        raise collab_auth.AuthError('无效的Token')
+    session['user_id'] = claims['sub']
+    # 连接时指定了文档的，握手阶段就完成授权
+    document_id = _normalize_document_id(auth.get('document_id')) if isinstance(auth, dict) else None
+    if document_id and _document_permission(document_id) is None:
+        raise collab_auth.AuthError('无权访问该文档')
+
+
+def _document_permission(document_id):
+    """连接对文档的权限，每个文档只在首次访问时查询数据库，之后从会话中读取"""
+    if not collab_auth.AUTH_REQUIRED:
+        return 'owner'
+    permissions = session.setdefault('permissions', {})
+    if document_id not in permissions:
+        doc = db.session.get(Documents, document_id) if isinstance(document_id, int) else None
+        permissions[document_id] = collab_auth.permission_for(
+            doc.user_id if doc else None, doc.is_deleted if doc else None, session.get('user_id'))
+    return permissions[document_id]
+
+
+def _join_wire_room(room, document_id, sid):
+    """按连接的传输格式加入对应的子房间，返回实际使用的格式"""
+    fmt = wire.wire_format(sid)
+    if fmt == wire.WIRE_BINARY and not wire.supports_binary(document_id):
+        fmt = wire.WIRE_JSON
+    for other in (wire.WIRE_JSON, wire.WIRE_BINARY):
+        if other != fmt:
+            leave_room(wire.sub_room(room, other))
+    join_room(wire.sub_room(room, fmt))
+    return fmt
+
+
+def _operations_for_client(operations, fmt):
+    """JSON客户端收到的字节操作转换为数字数组"""
+    if fmt == wire.WIRE_BINARY:
+        return operations
+    return [wire.bytes_to_operation(op) if isinstance(op, bytes) else op for op in operations]
+
+
+def _state_for_client(document_id, fmt):
+    state = document_states[document_id]
+    return {
+        'content': state['content'],
+        'version': state['version'],
+        'operations': _operations_for_client(all_operations(state), fmt)
+    }
+
+
+def _leave_room_state(room, sid):
+    """把用户从房间状态中移除，房间清空时安排写入快照"""
+    if room not in room_users:
+        return
+    room_users[room].discard(sid)
+    presence.discard(room, sid)
+    wire.release_index(room, sid)
+    if not room_users[room]:
+        document_id = _normalize_document_id(room[len('doc_'):])
+        snapshotter.request_flush(document_id)
+        lifecycle.room_emptied(document_id)
+
+
+def _resync(document_id, sid):
+    """给跳过了中间更新的慢连接补发完整文档状态"""
+    fmt = wire.wire_format(sid)
+    if fmt == wire.WIRE_BINARY and not wire.supports_binary(document_id):
+        fmt = wire.WIRE_JSON
+    emit('document_state', {
+        'document_id': document_id,
+        'state': _state_for_client(document_id, fmt),
+        'wire_format': fmt,
+        'resync': True
+    }, to=sid)
+
+
+def _reset_document(document_id):
+    """不能压缩的操作日志超出上限时，以最近保存的文档内容为基准重置，房间内所有连接整体重新同步
+
+    这类操作服务端无法合并，只能依赖客户端保存的内容；重置后操作日志清空，内存占用不再增长。
+    """
+    state = document_states[document_id]
+    doc = db.session.get(Documents, document_id) if isinstance(document_id, int) else None
+    version = reset(state, doc.content if doc is not None else state['content'])
+    logger.warning(f"文档 {document_id} 的操作日志无法压缩且超过 {OPLOG_MAX_UNCOMPACTED} 条，"
+                   f"已按保存的内容重新同步，版本: {version}")
+    snapshotter.mark_dirty(document_id, urgent=True)
+    for sid in list(room_users.get(f"doc_{document_id}", ())):
+        _resync(document_id, sid)
+
+
+def _apply_operation(document_id, operation, payload, sender_sid):
+    """记录操作并分别向JSON和二进制子房间广播
+
+    operation 为写入操作日志的原始对象，payload 为其字节形式（无法转换时为None）。
+    出站队列积压的接收者不参与本次广播，追上后补发完整快照，始终追不上则断开。
+    """
+    room = f"doc_{document_id}"
+    
+    # 更新文档状态
+    version = append_operation(document_states[document_id], operation)
+    snapshotter.mark_dirty(document_id)
+    lifecycle.touch(document_id)
+    
+    if OP_LOG_SAMPLE_RATE > 0 and logger.isEnabledFor(logging.DEBUG) and random.random() < OP_LOG_SAMPLE_RATE:
+        logger.debug(f"文档 {document_id} 收到操作，版本: {version}（采样）")
+    
+    started = time.perf_counter()
+    recipients = [sid for sid in list(room_users.get(room, ())) if sid != sender_sid]
+    skip, resync, drop = regulator.partition(recipients)
+    skip_sids = [sender_sid] + skip + resync + drop
+    
+    # 旧客户端保持原有的JSON格式
+    emit('document_operation', {
+        'document_id': document_id,
+        'operation': operation if not isinstance(operation, bytes) else wire.bytes_to_operation(operation),
+        'from_user': sender_sid,
+        'version': version
+    }, room=wire.sub_room(room, wire.WIRE_JSON), skip_sid=skip_sids)
+    
+    # 协商了二进制格式的客户端直接收到原始字节帧
+    if payload is not None and wire.supports_binary(document_id):
+        sender_index = wire.assign_index(room, sender_sid)
+        frame = wire.pack_operation(document_id, version, sender_index, payload)
+        emit('document_operation_bin', frame,
+             room=wire.sub_room(room, wire.WIRE_BINARY), skip_sid=skip_sids)
+    
+    for sid in resync:
+        _resync(document_id, sid)
+    for sid in drop:
+        regulator.disconnect(sid)
+    
+    metrics.record_operation(
+        room,
+        len(payload) if payload is not None else len(str(operation)),
+        len(recipients) - len(skip) - len(drop),
+        time.perf_counter() - started
+    )
+    
+    if needs_reset(document_states[document_id]):
+        _reset_document(document_id)
+
+
 def init_socketio_events(socketio):
     """初始化SocketIO事件处理器"""
+    presence.init_app(socketio)
+    lifecycle.init_app(socketio)
+    regulator.init_app(socketio)
     
     @socketio.on('connect')
     def on_connect(auth):
-        """客户端连接事件"""
+        """客户端连接事件，未通过认证的连接在握手阶段即被拒绝"""
+        try:
+            _authenticate(auth)
+        except collab_auth.AuthError as e:
+            logger.warning(f"拒绝未授权的连接: {request.sid}, {str(e)}")
+            metrics.socket_rejected()
+            raise ConnectionRefusedError(str(e))
         try:
             logger.info(f"客户端连接: {request.sid}")
-            emit('connected', {'status': 'success', 'message': '连接成功'})
+            metrics.socket_connected()
+            options = auth if isinstance(auth, dict) else {}
+            fmt = wire.negotiate(request.sid, options.get('wire_format'))
+            presence_mode = presence.negotiate(request.sid, options.get('presence'))
+            emit('connected', {'status': 'success', 'message': '连接成功', 'wire_format': fmt,
+                               'presence': presence_mode})
         except Exception as e:
             logger.error(f"连接处理错误: {str(e)}")
             emit('error', {'message': '连接失败'})
@@ -29,18 +219,22 @@ def init_socketio_events(socketio):
         """客户端断开连接事件"""
         try:
             logger.info(f"客户端断开连接: {request.sid}")
+            metrics.socket_disconnected()
             # 从所有房间中移除用户
             user_rooms = rooms(request.sid)
             for room in user_rooms:
                 if room != request.sid:  # 排除默认房间
                     leave_room(room)
                     if room in room_users:
-                        room_users[room].discard(request.sid)
+                        _leave_room_state(room, request.sid)
                         # 通知房间内其他用户
                         emit('user_left', {
                             'user_id': request.sid,
                             'room': room
                         }, room=room)
+            wire.forget(request.sid)
+            presence.forget(request.sid)
+            regulator.forget(request.sid)
         except Exception as e:
             logger.error(f"断开连接处理错误: {str(e)}")
     
@@ -48,45 +242,72 @@ def init_socketio_events(socketio):
     def on_join_document(data):
         """加入文档协同编辑"""
         try:
-            document_id = data.get('document_id')
+            started = time.perf_counter()
+            document_id = _normalize_document_id(data.get('document_id'))
             user_info = data.get('user_info', {})
             
             if not document_id:
                 emit('error', {'message': '文档ID不能为空'})
                 return
+            if _document_permission(document_id) is None:
+                emit('error', {'message': '无权访问该文档'})
+                return
             
             room = f"doc_{document_id}"
             join_room(room)
+            if 'wire_format' in data:
+                wire.negotiate(request.sid, data['wire_format'])
+            if 'presence' in data:
+                presence.negotiate(request.sid, data['presence'])
+            fmt = _join_wire_room(room, document_id, request.sid)
+            index = wire.assign_index(room, request.sid)
             
-            # 初始化房间用户列表
-            if room not in room_users:
-                room_users[room] = set()
-            room_users[room].add(request.sid)
+            # 初始化文档状态时优先从快照恢复
+            loaded = snapshotter.load(document_id) if document_id not in document_states else None
             
-            # 初始化文档状态
-            if document_id not in document_states:
-                document_states[document_id] = {
-                    'content': '',
-                    'version': 0,
-                    'operations': []
-                }
+            # 初始化房间用户列表和文档状态，与房间回收互斥
+            with state_lock:
+                if room not in room_users:
+                    room_users[room] = set()
+                room_users[room].add(request.sid)
+                if document_id not in document_states:
+                    document_states[document_id] = loaded or new_document_state()
+            lifecycle.touch(document_id)
             
             logger.info(f"用户 {request.sid} 加入文档 {document_id}")
             
-            # 发送当前文档状态给新加入的用户
-            emit('document_state', {
-                'document_id': document_id,
-                'state': document_states[document_id],
-                'users': list(room_users[room])
-            })
+            # 重连的客户端带上最后看到的版本号时只补发缺失的操作
+            missing = operations_since(document_states[document_id], data.get('version'))
+            if missing is not None:
+                emit('document_catchup', {
+                    'document_id': document_id,
+                    'from_version': data['version'],
+                    'version': data['version'] + len(missing),
+                    'operations': _operations_for_client(missing, fmt),
+                    'users': list(room_users[room]),
+                    'participants': dict(wire.participant_indexes.get(room, {})),
+                    'wire_format': fmt
+                })
+            else:
+                # 发送当前文档状态给新加入的用户
+                emit('document_state', {
+                    'document_id': document_id,
+                    'state': _state_for_client(document_id, fmt),
+                    'users': list(room_users[room]),
+                    'participants': dict(wire.participant_indexes.get(room, {})),
+                    'wire_format': fmt
+                })
             
             # 通知房间内其他用户有新用户加入
             emit('user_joined', {
                 'user_id': request.sid,
                 'user_info': user_info,
+                'index': index,
                 'room': room
             }, room=room, include_self=False)
             
+            metrics.record_join(room, time.perf_counter() - started)
+            
         except Exception as e:
             logger.error(f"加入文档错误: {str(e)}")
             emit('error', {'message': '加入文档失败'})
@@ -95,15 +316,16 @@ def init_socketio_events(socketio):
     def on_leave_document(data):
         """离开文档协同编辑"""
         try:
-            document_id = data.get('document_id')
+            document_id = _normalize_document_id(data.get('document_id'))
             if not document_id:
                 return
             
             room = f"doc_{document_id}"
             leave_room(room)
+            for fmt in (wire.WIRE_JSON, wire.WIRE_BINARY):
+                leave_room(wire.sub_room(room, fmt))
             
-            if room in room_users:
-                room_users[room].discard(request.sid)
+            _leave_room_state(room, request.sid)
             
             logger.info(f"用户 {request.sid} 离开文档 {document_id}")
             
@@ -120,34 +342,41 @@ def init_socketio_events(socketio):
     def on_document_operation(data):
         """处理文档操作（Y.js更新）"""
         try:
-            document_id = data.get('document_id')
+            document_id = _normalize_document_id(data.get('document_id'))
             operation = data.get('operation')
             
             if not document_id or not operation:
                 emit('error', {'message': '文档ID和操作不能为空'})
                 return
-            
-            room = f"doc_{document_id}"
-            
-            # 更新文档状态
-            if document_id in document_states:
-                document_states[document_id]['version'] += 1
-                document_states[document_id]['operations'].append(operation)
-            
-            logger.info(f"文档 {document_id} 收到操作，版本: {document_states[document_id]['version']}")
+            if not collab_auth.can_write(_document_permission(document_id)):
+                emit('error', {'message': '无权编辑该文档'})
+                return
             
             # 广播操作给房间内其他用户
-            emit('document_operation', {
-                'document_id': document_id,
-                'operation': operation,
-                'from_user': request.sid,
-                'version': document_states[document_id]['version']
-            }, room=room, include_self=False)
+            _apply_operation(document_id, operation, wire.operation_to_bytes(operation), request.sid)
             
         except Exception as e:
             logger.error(f"文档操作错误: {str(e)}")
             emit('error', {'message': '操作处理失败'})
     
+    @socketio.on('document_operation_bin')
+    def on_document_operation_bin(frame):
+        """处理二进制格式的文档操作，帧头中的版本号和发送者序号由服务端重新填写"""
+        try:
+            document_id, _, _, payload = wire.unpack_operation(frame)
+            if not payload:
+                emit('error', {'message': '文档ID和操作不能为空'})
+                return
+            if not collab_auth.can_write(_document_permission(document_id)):
+                emit('error', {'message': '无权编辑该文档'})
+                return
+            
+            _apply_operation(document_id, payload, payload, request.sid)
+            
+        except Exception as e:
+            logger.error(f"二进制文档操作错误: {str(e)}")
+            emit('error', {'message': '操作处理失败'})
+    
     @socketio.on('cursor_position')
     def on_cursor_position(data):
         """处理光标位置更新"""
@@ -156,18 +385,27 @@ def init_socketio_events(socketio):
             position = data.get('position')
             user_info = data.get('user_info', {})
             
-            if not document_id:
+            if not document_id or _document_permission(_normalize_document_id(document_id)) is None:
                 return
             
             room = f"doc_{document_id}"
+            batched, legacy = presence.split_room(room)
             
-            # 广播光标位置给房间内其他用户
-            emit('cursor_position', {
-                'document_id': document_id,
-                'position': position,
-                'user_id': request.sid,
-                'user_info': user_info
-            }, room=room, include_self=False)
+            # 协商为合并接收的连接只记录最新位置，由 presence 每个tick统一发送
+            if any(sid != request.sid for sid in batched):
+                presence.submit(room, document_id, request.sid, 'cursor', {
+                    'position': position,
+                    'user_info': user_info
+                })
+            
+            # 逐条广播光标位置给房间内其他旧客户端
+            if any(sid != request.sid for sid in legacy):
+                emit('cursor_position', {
+                    'document_id': document_id,
+                    'position': position,
+                    'user_id': request.sid,
+                    'user_info': user_info
+                }, room=room, skip_sid=[request.sid] + batched)
             
         except Exception as e:
             logger.error(f"光标位置更新错误: {str(e)}")
@@ -179,19 +417,51 @@ def init_socketio_events(socketio):
             document_id = data.get('document_id')
             awareness_data = data.get('awareness')
             
-            if not document_id:
+            if not document_id or _document_permission(_normalize_document_id(document_id)) is None:
                 return
             
             room = f"doc_{document_id}"
+            batched, legacy = presence.split_room(room)
             
-            # 广播感知信息给房间内其他用户
-            emit('awareness_update', {
-                'document_id': document_id,
-                'awareness': awareness_data,
-                'user_id': request.sid
-            }, room=room, include_self=False)
+            if any(sid != request.sid for sid in batched):
+                presence.submit(room, document_id, request.sid, 'awareness', awareness_data)
+            
+            # 逐条广播感知信息给房间内其他旧客户端
+            if any(sid != request.sid for sid in legacy):
+                emit('awareness_update', {
+                    'document_id': document_id,
+                    'awareness': awareness_data,
+                    'user_id': request.sid
+                }, room=room, skip_sid=[request.sid] + batched)
             
         except Exception as e:
             logger.error(f"感知信息更新错误: {str(e)}")
 
-    return socketio
\ No newline at end of file
+    return socketio
+
+
+@collaboration.route('/stats', methods=['GET'])
+def collaboration_stats():
+    """协同编辑房间、参与者与内存占用的实时指标"""
+    return jsonify({'stats': lifecycle.gauges(), 'code': '200'})
+
+
+@collaboration.route('/metrics', methods=['GET'])
+def collaboration_metrics():
+    """Prometheus 格式的协同编辑指标"""
+    gauges = lifecycle.gauges()
+    extra = {
+        'collab_rooms': ('房间数（含等待回收的空房间）', 'gauge', gauges['rooms']),
+        'collab_active_rooms': ('有参与者的房间数', 'gauge', gauges['active_rooms']),
+        'collab_participants': ('所有房间的参与者数', 'gauge', gauges['participants']),
+        'collab_documents': ('内存中的文档状态数', 'gauge', gauges['documents']),
+        'collab_retained_bytes': ('文档状态占用的内存（字节）', 'gauge', gauges['retained_bytes']),
+        'collab_memory_budget_bytes': ('文档状态的内存预算（字节）', 'gauge', gauges['memory_budget']),
+        'collab_evicted_documents_total': ('被淘汰的文档状态数', 'counter', gauges['evicted_documents']),
+        'collab_presence_events_total': ('收到的光标/感知事件数', 'counter', presence.received),
+        'collab_presence_frames_total': ('发出的感知信息批量帧数', 'counter', presence.emitted),
+        'collab_backpressure_skipped_total': ('因积压被跳过的更新数', 'counter', regulator.skipped),
+        'collab_backpressure_resynced_total': ('追上后补发快照的次数', 'counter', regulator.resynced),
+        'collab_backpressure_dropped_total': ('因无法追上被断开的连接数', 'counter', regulator.dropped),
+    }
+    return Response(metrics.render(extra), content_type='text/plain; version=0.0.4; charset=utf-8')
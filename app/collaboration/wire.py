@@ -0,0 +1,103 @@
+import base64
+import binascii
+import struct
+
+# 连接可协商的文档操作传输格式
+WIRE_JSON = 'json'
+WIRE_BINARY = 'binary'
+
+# 二进制帧头: 文档ID(uint32) + 版本号(uint32) + 发送者序号(uint16)，其后为原始Y.js更新
+FRAME_HEADER = struct.Struct('!IIH')
+MAX_DOCUMENT_ID = 0xFFFFFFFF
+
+# 协商为二进制格式的连接
+binary_sids = set()
+# 房间内参与者的序号，房间 -> {sid: 序号}
+participant_indexes = {}
+
+
+def negotiate(sid, requested):
+    """根据客户端请求确定连接的传输格式，未声明的旧客户端保持JSON"""
+    if requested == WIRE_BINARY:
+        binary_sids.add(sid)
+        return WIRE_BINARY
+    binary_sids.discard(sid)
+    return WIRE_JSON
+
+
+def forget(sid):
+    binary_sids.discard(sid)
+
+
+def wire_format(sid):
+    return WIRE_BINARY if sid in binary_sids else WIRE_JSON
+
+
+def supports_binary(document_id):
+    """二进制帧头只能携带 uint32 的文档ID"""
+    return isinstance(document_id, int) and 0 <= document_id <= MAX_DOCUMENT_ID
+
+
+def sub_room(room, fmt):
+    """按传输格式划分的子房间，文档操作分别向两个子房间广播"""
+    return f"{room}:{fmt}"
+
+
+def assign_index(room, sid):
+    """为参与者分配房间内最小的空闲序号"""
+    indexes = participant_indexes.setdefault(room, {})
+    if sid not in indexes:
+        used = set(indexes.values())
+        index = 0
+        while index in used:
+            index += 1
+        indexes[sid] = index
+    return indexes[sid]
+
+
+def release_index(room, sid):
+    indexes = participant_indexes.get(room)
+    if indexes is not None:
+        indexes.pop(sid, None)
+        if not indexes:
+            del participant_indexes[room]
+
+
+def pack_operation(document_id, version, sender_index, payload):
+    return FRAME_HEADER.pack(document_id, version & 0xFFFFFFFF, sender_index & 0xFFFF) + payload
+
+
+def unpack_operation(frame):
+    """解析二进制帧，返回 (文档ID, 版本号, 发送者序号, 更新字节)"""
+    if len(frame) < FRAME_HEADER.size:
+        raise ValueError('二进制帧长度不足')
+    document_id, version, sender_index = FRAME_HEADER.unpack_from(frame)
+    return document_id, version, sender_index, bytes(frame[FRAME_HEADER.size:])
+
+
+def operation_to_bytes(operation):
+    """把JSON客户端发送的操作（字节、数字数组或base64字符串）还原为字节，无法识别时返回None"""
+    if isinstance(operation, (bytes, bytearray)):
+        return bytes(operation)
+    if isinstance(operation, list):
+        try:
+            return bytes(operation)
+        except (TypeError, ValueError):
+            return None
+    if isinstance(operation, dict) and operation and all(k.isdigit() for k in operation):
+        # Uint8Array 经 JSON.stringify 后会变成 {"0": 1, "1": 2, ...}
+        try:
+            return bytes(operation[str(i)] for i in range(len(operation)))
+        except (KeyError, TypeError, ValueError):
+            return None
+    if isinstance(operation, str):
+        try:
+            return base64.b64decode(operation, validate=True)
+        except (binascii.Error, ValueError):
+            return None
+    return None
+
+
+def bytes_to_operation(payload):
+    """把二进制操作转换为旧客户端使用的数字数组"""
+    return list(payload)
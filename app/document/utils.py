@@ -0,0 +1,61 @@
+import json
+import logging
+from datetime import datetime
+
+import pytz
+
+from database import db, redis_client
+from .models import DocumentVersions
+
+
+# 自定义JSON编码器，用于处理datetime对象
+class CustomJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def save_document_content(doc, content, user_id, title=None, create_version=True, version_summary=''):
+    """保存文档内容：内容有变化且需要时创建新版本，提交后刷新Redis缓存
+
+    返回内容是否有变化。提交失败时抛出异常，由调用方回滚。
+    """
+    new_title = doc.title if title is None else title
+    content_changed = doc.content != content
+
+    doc.title = new_title
+    doc.content = content
+    doc.updated_at = datetime.now(pytz.timezone('Asia/Shanghai'))
+
+    # 如果内容有变化且需要创建版本，则创建新版本
+    if create_version and content_changed:
+        try:
+            # 获取当前文档的最大版本号
+            max_version = db.session.query(db.func.max(DocumentVersions.version_number)).filter_by(document_id=doc.id).scalar()
+            next_version_number = (max_version or 0) + 1
+
+            # 将之前的版本标记为非当前版本
+            DocumentVersions.query.filter_by(document_id=doc.id).update({'is_current': False})
+
+            # 创建新版本
+            new_version = DocumentVersions(
+                document_id=doc.id,
+                user_id=user_id,
+                version_number=next_version_number,
+                content=content,
+                summary=version_summary or f'版本 {next_version_number}',
+                is_current=True
+            )
+
+            db.session.add(new_version)
+            logging.info(f"文档更新时创建版本: document_id={doc.id}, version={next_version_number}")
+        except Exception as version_error:
+            logging.warning(f"创建版本失败，但文档更新继续: {str(version_error)}")
+
+    db.session.commit()
+
+    # 更新Redis缓存
+    cache_key = f"document:{doc.id}"
+    redis_client.set(cache_key, json.dumps(doc.to_dict(), cls=CustomJSONEncoder))
+    return content_changed
@@ -11,14 +11,7 @@ from flask_jwt_extended import jwt_required, get_jwt_identity, verify_jwt_in_req
 from database import db, redis_client
 from . import document
 from .models import Documents, DocumentVersions
-
-
-# 自定义JSON编码器，用于处理datetime对象
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+from .utils import CustomJSONEncoder, save_document_content
 
 
 # 自定义JWT验证装饰器，提供更详细的错误处理
@@ -179,45 +172,8 @@ def update_document(document_id):
         create_version = data.get('create_version', True)  # 默认创建版本
         version_summary = data.get('version_summary', '')  # 版本摘要
         
-        # 检查内容是否有变化
-        content_changed = doc.content != new_content
-        title_changed = doc.title != new_title
-        
-        # 更新文档
-        doc.title = new_title
-        doc.content = new_content
-        doc.updated_at = datetime.now(pytz.timezone('Asia/Shanghai'))
-        
-        # 如果内容有变化且需要创建版本，则创建新版本
-        if create_version and content_changed:
-            try:
-                # 获取当前文档的最大版本号
-                max_version = db.session.query(db.func.max(DocumentVersions.version_number)).filter_by(document_id=document_id).scalar()
-                next_version_number = (max_version or 0) + 1
-                
-                # 将之前的版本标记为非当前版本
-                DocumentVersions.query.filter_by(document_id=document_id).update({'is_current': False})
-                
-                # 创建新版本
-                new_version = DocumentVersions(
-                    document_id=document_id,
-                    user_id=user_id,
-                    version_number=next_version_number,
-                    content=new_content,
-                    summary=version_summary or f'版本 {next_version_number}',
-                    is_current=True
-                )
-                
-                db.session.add(new_version)
-                logging.info(f"文档更新时创建版本: document_id={document_id}, version={next_version_number}")
-            except Exception as version_error:
-                logging.warning(f"创建版本失败，但文档更新继续: {str(version_error)}")
-        
-        db.session.commit()
-        
-        # 更新Redis缓存
-        cache_key = f"document:{document_id}"
-        redis_client.set(cache_key, json.dumps(doc.to_dict(), cls=CustomJSONEncoder))
+        save_document_content(doc, new_content, user_id, title=new_title,
+                              create_version=create_version, version_summary=version_summary)
         
         return jsonify({'message': '更新成功!', 'code': '200'})
         
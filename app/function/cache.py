@@ -0,0 +1,5 @@
+from ai_utils import ResponseCache
+from database import redis_client
+
+# AI 文本指令结果缓存，使用应用的 Redis 连接
+response_cache = ResponseCache(redis_client)
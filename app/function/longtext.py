@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from ai_admission import AdmissionError
+from ai_utils import AI_LONG_TEXT_CONCURRENCY, REDUCE_TEMPLATES, build_prompt, reduce_prompt
+from .singleflight import Flight, FlightError
+
+logger = logging.getLogger(__name__)
+
+
+class LongTextJob:
+    """长文本的分块并行处理
+
+    各块由最多 concurrency 个工作线程并行处理：第一个线程使用请求本身已获得的准入，
+    其余线程每处理一块先单独获取准入，获取不到时退出，剩余的块由其他线程接着处理。
+    迭代本对象按块的顺序产出结果，第一块边生成边输出，后面的块在轮到时输出已缓冲的部分；
+    需要归并的指令（摘要）在所有块完成后再流式输出归并结果。
+
+    generate(prompt) 为请求上游并产出文本块的生成器，出错时抛出异常；acquire() 返回额外一块的 Permit。
+    """
+
+    def __init__(self, command, chunks, data, generate, acquire, concurrency=AI_LONG_TEXT_CONCURRENCY):
+        self.command = command
+        self.prompts = [build_prompt(command, chunk, data) for chunk in chunks]
+        self.generate = generate
+        self.acquire = acquire
+        self.concurrency = max(1, min(concurrency, len(chunks)))
+        self.results = [Flight(index) for index in range(len(chunks))]
+        self.failed = False  # 有块处理失败，结果不完整
+        self.cancelled = False
+        self._pending = deque(range(len(chunks)))
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            if self.cancelled or not self._pending:
+                return None
+            return self._pending.popleft()
+
+    def _work(self, borrow):
+        while True:
+            permit = None
+            if borrow:
+                try:
+                    permit = self.acquire()
+                except AdmissionError:
+                    # 服务商繁忙，剩余的块交给其他线程
+                    return
+            try:
+                index = self._next()
+                if index is None:
+                    return
+                self._process(index)
+            finally:
+                if permit is not None:
+                    permit.release()
+
+    def _process(self, index):
+        result = self.results[index]
+        source = self.generate(self.prompts[index])
+        error = None
+        try:
+            for piece in source:
+                if self.cancelled:
+                    error = '生成已取消'
+                    break
+                result.publish(piece)
+        except Exception as e:
+            error = str(e)
+        finally:
+            source.close()
+            result.finish(error)
+
+    def _failure(self, index, e):
+        """一块处理失败，返回代替该块输出的说明"""
+        self.failed = True
+        logger.warning(f"长文本第{index + 1}块处理失败: {str(e)}")
+        return f"（第{index + 1}部分处理失败: {str(e)}）"
+
+    def _reduce_prompt(self, outputs):
+        if not outputs:
+            raise FlightError('所有部分均处理失败')
+        return reduce_prompt(self.command, outputs)
+
+    def __iter__(self):
+        for number in range(self.concurrency):
+            threading.Thread(target=self._work, args=(number > 0,), daemon=True).start()
+        reduce = self.command in REDUCE_TEMPLATES
+        outputs = []
+        try:
+            for index, result in enumerate(self.results):
+                pieces = []
+                try:
+                    for piece in result.follow():
+                        pieces.append(piece)
+                        if not reduce:
+                            yield piece
+                except FlightError as e:
+                    message = self._failure(index, e)
+                    if not reduce:
+                        yield message
+                    continue
+                outputs.append(''.join(pieces))
+                if not reduce and index < len(self.results) - 1:
+                    yield '\n'
+            if reduce:
+                yield from self.generate(self._reduce_prompt(outputs))
+        finally:
+            # 客户端断开时停止尚未完成的块
+            self.cancelled = True
+
+
+class AsyncLongTextJob(LongTextJob):
+    """LongTextJob 的 asyncio 版本，供 ai_stream_server.py 使用
+
+    generate(prompt) 返回产出文本块的异步生成器，acquire() 为返回 Permit 的协程；
+    各块在工作协程中处理，迭代结束或客户端断开时取消工作协程，随之关闭上游连接。
+    """
+
+    async def _work(self, borrow):
+        while True:
+            permit = None
+            if borrow:
+                try:
+                    permit = await self.acquire()
+                except AdmissionError:
+                    return
+            try:
+                index = self._next()
+                if index is None:
+                    return
+                await self._process(index)
+            finally:
+                if permit is not None:
+                    permit.release()
+
+    async def _process(self, index):
+        result = self.results[index]
+        source = self.generate(self.prompts[index])
+        error = None
+        try:
+            async for piece in source:
+                result.publish(piece)
+        except asyncio.CancelledError:
+            error = '生成已取消'
+            raise
+        except Exception as e:
+            error = str(e)
+        finally:
+            await source.aclose()
+            result.finish(error)
+
+    async def __aiter__(self):
+        workers = [asyncio.ensure_future(self._work(number > 0)) for number in range(self.concurrency)]
+        reduce = self.command in REDUCE_TEMPLATES
+        outputs = []
+        try:
+            for index, result in enumerate(self.results):
+                pieces = []
+                try:
+                    async for piece in result.follow_async():
+                        pieces.append(piece)
+                        if not reduce:
+                            yield piece
+                except FlightError as e:
+                    message = self._failure(index, e)
+                    if not reduce:
+                        yield message
+                    continue
+                outputs.append(''.join(pieces))
+                if not reduce and index < len(self.results) - 1:
+                    yield '\n'
+            if reduce:
+                source = self.generate(self._reduce_prompt(outputs))
+                try:
+                    async for piece in source:
+                        yield piece
+                finally:
+                    await source.aclose()
+        finally:
+            self.cancelled = True
+            for worker in workers:
+                worker.cancel()
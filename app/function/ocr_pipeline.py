@@ -0,0 +1,145 @@
+import os
+import io
+import base64
+import hashlib
+import logging
+import tempfile
+
+from database import redis_client
+from . import upstream
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装 Pillow 时原样发送图片
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# 发给OCR服务的图片长边上限（像素），手机照片缩小到该尺寸识别效果不变
+OCR_MAX_SIDE = int(os.getenv('OCR_MAX_SIDE', '2048'))
+# 重新压缩时的 JPEG 质量
+OCR_JPEG_QUALITY = int(os.getenv('OCR_JPEG_QUALITY', '85'))
+# 尺寸未超过上限但文件大于该值（字节）时也重新压缩
+OCR_RECOMPRESS_BYTES = int(os.getenv('OCR_RECOMPRESS_BYTES', str(1024 * 1024)))
+# 上传内容在内存中保留的上限（字节），超出部分写入临时文件
+OCR_SPOOL_MAX_MEMORY = int(os.getenv('OCR_SPOOL_MAX_MEMORY', str(1024 * 1024)))
+# 识别结果按图片内容哈希缓存的有效期（秒），0 表示不缓存
+OCR_CACHE_TTL = int(os.getenv('OCR_CACHE_TTL', str(7 * 24 * 60 * 60)))
+# 单个上传文件的大小上限（字节）
+OCR_MAX_FILE_BYTES = int(os.getenv('OCR_MAX_FILE_BYTES', str(10 * 1024 * 1024)))
+# 批量识别每次最多的文件数及文件合计大小上限（字节）；同时识别的页数由 OCR 服务商的准入控制决定
+OCR_BATCH_MAX_FILES = int(os.getenv('OCR_BATCH_MAX_FILES', '20'))
+OCR_BATCH_MAX_BYTES = int(os.getenv('OCR_BATCH_MAX_BYTES', str(50 * 1024 * 1024)))
+# multipart 表单中文件内容以外的部分（分隔符、字段头）允许的大小，用于在解析表单前按 Content-Length 拒绝
+OCR_FORM_OVERHEAD = 64 * 1024
+
+OCR_CACHE_PREFIX = 'ocr_cache:'
+
+if Image is None:
+    logger.warning("未安装 Pillow，OCR 图片将不经缩放直接发送")
+
+
+class UploadTooLarge(ValueError):
+    """上传内容超过大小上限"""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def format_size(size):
+    return f'{round(size / (1024 * 1024), 2):g}MB'
+
+
+def check_content_length(content_length, limit):
+    """解析表单前按 Content-Length 检查请求大小，limit 为允许的文件内容合计大小，超出时抛出 UploadTooLarge"""
+    if content_length is not None and content_length > limit + OCR_FORM_OVERHEAD:
+        raise UploadTooLarge(f'上传内容超过{format_size(limit)}')
+
+
+class Upload:
+    """暂存到 SpooledTemporaryFile 的上传文件，边读边计算内容哈希
+
+    limit 为允许的最大字节数，超出时停止读取、关闭已暂存的内容并抛出 UploadTooLarge。
+    """
+
+    def __init__(self, file, limit=OCR_MAX_FILE_BYTES, chunk_size=64 * 1024):
+        self.filename = file.filename
+        self.spool = tempfile.SpooledTemporaryFile(max_size=OCR_SPOOL_MAX_MEMORY)
+        digest = hashlib.sha256()
+        self.size = 0
+        while True:
+            chunk = file.stream.read(min(chunk_size, limit - self.size + 1))
+            if not chunk:
+                break
+            self.size += len(chunk)
+            if self.size > limit:
+                self.spool.close()
+                raise UploadTooLarge(f'文件 {self.filename} 超过{format_size(limit)}')
+            digest.update(chunk)
+            self.spool.write(chunk)
+        self.digest = digest.hexdigest()
+
+    def close(self):
+        self.spool.close()
+
+
+def prepare_image(upload):
+    """返回发给OCR服务的图片：超过 OCR_MAX_SIDE 或 OCR_RECOMPRESS_BYTES 时缩小并重新压缩为 JPEG，否则原样返回"""
+    upload.spool.seek(0)
+    if Image is None:
+        return upload.spool.read()
+    try:
+        image = Image.open(upload.spool)
+        if max(image.size) <= OCR_MAX_SIDE and upload.size <= OCR_RECOMPRESS_BYTES:
+            upload.spool.seek(0)
+            return upload.spool.read()
+        # JPEG 解码时直接按 1/2、1/4、1/8 缩小，不必先解码出完整的大图
+        image.draft('RGB', (OCR_MAX_SIDE, OCR_MAX_SIDE))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=OCR_JPEG_QUALITY, optimize=True)
+        return output.getvalue()
+    except Exception as e:
+        # 无法识别的格式交给OCR服务处理
+        logger.warning(f"OCR 图片预处理失败，原样发送: {str(e)}")
+        upload.spool.seek(0)
+        return upload.spool.read()
+
+
+def cache_key(upload):
+    """缓存键包含缩放参数，调整参数后不再使用旧结果"""
+    return f'{OCR_CACHE_PREFIX}{upload.digest}:{OCR_MAX_SIDE}'
+
+
+def cached_result(upload):
+    if not OCR_CACHE_TTL:
+        return None
+    try:
+        return redis_client.get(cache_key(upload))
+    except Exception as e:
+        logger.warning(f"读取OCR结果缓存失败: {str(e)}")
+        return None
+
+
+def recognize(upload):
+    """预处理图片并调用OCR服务，返回识别出的文本，出错时抛出异常；调用方负责获取准入"""
+    image_base64 = base64.b64encode(prepare_image(upload)).decode('ascii')
+    headers = {
+        "Authorization": f"token {os.getenv('ACCESS_TOKEN')}",
+        "Content-Type": "application/json"
+    }
+    resp = upstream.ocr.post(os.getenv('OCR_API_URL'), json={"image": image_base64}, headers=headers)
+    resp.raise_for_status()
+    result = ''
+    for text in resp.json()["result"]["texts"]:
+        result += text["text"] + '\n'
+    if OCR_CACHE_TTL:
+        try:
+            redis_client.set(cache_key(upload), result, ex=OCR_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"写入OCR结果缓存失败: {str(e)}")
+    return result
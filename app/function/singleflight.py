@@ -0,0 +1,449 @@
+import os
+import asyncio
+import logging
+import functools
+import threading
+
+from database import redis_client
+
+logger = logging.getLogger(__name__)
+
+# 是否合并相同的进行中AI请求（默认开启）
+AI_SINGLEFLIGHT_ENABLED = os.getenv('AI_SINGLEFLIGHT_ENABLED', 'True').lower() in ('true', '1', 't')
+# 是否通过 Redis 在多个工作进程之间合并（默认关闭，只合并同一进程内的请求）
+AI_SINGLEFLIGHT_SHARED = os.getenv('AI_SINGLEFLIGHT_SHARED', 'False').lower() in ('true', '1', 't')
+# 跨进程时等待另一进程产出下一块的最长时间（秒），超时视为该进程已退出
+AI_SINGLEFLIGHT_WAIT = int(os.getenv('AI_SINGLEFLIGHT_WAIT', os.getenv('UPSTREAM_READ_TIMEOUT', '60')))
+# 生成结束后结果在 Redis 中保留的时间（秒），期间到达的相同请求直接读取
+AI_SINGLEFLIGHT_LINGER = int(os.getenv('AI_SINGLEFLIGHT_LINGER', '30'))
+
+# Redis 流，依次保存产出的文本块和结束标记
+FLIGHT_KEY_PREFIX = 'ai_flight:'
+# 正在生成的进程持有的键，其他进程据此改为读取 Redis 流
+LEADER_KEY_PREFIX = 'ai_flight_leader:'
+
+
+class FlightError(Exception):
+    """合并到的生成失败"""
+
+
+class Subscription:
+    """一个请求读取的文本块迭代器，close() 结束读取并执行 on_close（减少订阅数、释放准入），可重复调用
+
+    统计和名额不放在生成器的 finally 中：生成器在第一次 next() 之前被关闭时 finally 不会执行，
+    而 werkzeug 在响应结束或客户端断开时总会调用响应迭代器的 close()。迭代结束或出错时也会自动 close()。
+    error_text(e) 不为 None 时，合并到的生成失败（FlightError）改为输出它返回的文本后结束。
+    """
+
+    def __init__(self, chunks, on_close, error_text=None):
+        self._chunks = chunks
+        self._on_close = on_close
+        self._error_text = error_text
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            return next(self._chunks)
+        except FlightError as e:
+            self.close()
+            if self._error_text is None:
+                raise
+            return self._error_text(e)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._chunks.close()
+        finally:
+            self._on_close()
+
+
+class AsyncSubscription:
+    """Subscription 的 asyncio 版本，aclose() 结束读取"""
+
+    def __init__(self, chunks, on_close):
+        self._chunks = chunks
+        self._on_close = on_close
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self._chunks.aclose()
+        finally:
+            self._on_close()
+
+
+class Flight:
+    """一次进行中的生成，保存已产出的全部文本块，随时加入的请求都从第一块开始读取
+
+    线程用 follow() 读取，asyncio 协程用 follow_async() 读取，写入方可以是线程也可以是协程。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cancelled = False
+        self.shared = False  # 结果同时写入 Redis 供其他进程读取，本进程的请求都断开后也继续生成
+        self.ready = threading.Event()  # 首个请求已获准入或被拒绝
+        self.rejection = None  # 首个请求未获准入时的异常
+        self.task = None  # asyncio 版本中生成所在的任务
+        self.cond = threading.Condition()
+        self._async_waiters = []  # 等待更新的协程 (事件循环, asyncio.Event)
+
+    def _notify(self):
+        """持有 cond 时调用：唤醒等待的线程和协程"""
+        self.cond.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def publish(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self._notify()
+
+    def set_ready(self, rejection=None):
+        """首个请求已获准入（rejection 为 None）或被拒绝"""
+        with self.cond:
+            self.rejection = rejection
+            self.ready.set()
+            self._notify()
+
+    async def _changed(self, predicate):
+        """等待 predicate() 在持有 cond 时为真，不占用线程"""
+        while True:
+            with self.cond:
+                if predicate():
+                    return
+                waiter = (asyncio.get_running_loop(), asyncio.Event())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1].wait()
+            finally:
+                with self.cond:
+                    self._async_waiters.remove(waiter)
+
+    async def wait_ready_async(self):
+        await self._changed(self.ready.is_set)
+
+    def follow(self):
+        index = 0
+        while True:
+            with self.cond:
+                while index >= len(self.chunks) and not self.done:
+                    self.cond.wait()
+                pending = self.chunks[index:]
+                done, error = self.done, self.error
+            index += len(pending)
+            yield from pending
+            if done:
+                if error is not None:
+                    raise FlightError(error)
+                return
+
+    async def follow_async(self):
+        """follow 的 asyncio 版本"""
+        index = 0
+        while True:
+            await self._changed(lambda: index < len(self.chunks) or self.done)
+            with self.cond:
+                pending = self.chunks[index:]
+                done, error = self.done, self.error
+            index += len(pending)
+            for chunk in pending:
+                yield chunk
+            if done:
+                if error is not None:
+                    raise FlightError(error)
+                return
+
+
+class SingleFlight:
+    """合并相同的进行中AI请求
+
+    同一个键的生成正在进行时，后到的请求不再请求上游，而是读取同一次生成的输出。
+    生成在后台线程中运行，发起请求的客户端断开不影响其他请求；所有请求都断开时停止生成。
+    启用跨进程合并时，首个进程把输出写入 Redis 流，其他进程读取该流。
+    asyncio 服务（ai_stream_server.py）使用 stream_async，生成在事件循环的任务中运行。
+    """
+
+    def __init__(self, client, enabled=AI_SINGLEFLIGHT_ENABLED, shared=AI_SINGLEFLIGHT_SHARED):
+        self.client = client
+        self.enabled = enabled
+        self.shared = shared
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.started = 0  # 本进程发起的生成数
+        self.coalesced = 0  # 合并到本进程已有生成的请求数
+        self.remote = 0  # 读取其他进程生成的次数
+
+    def stream(self, key, produce, admit=None, error_text=None):
+        """返回 key 对应生成的 Subscription，produce() 为实际请求上游并产出文本块的生成器，key 为 None 时不合并
+
+        admit() 在本进程需要请求上游时调用，返回生成结束后释放的 Permit；
+        它抛出的异常（如 AdmissionError）会原样抛给本次请求和此时已合并进来的请求。
+        error_text 见 Subscription。
+        """
+        if not self.enabled or key is None:
+            permit = admit() if admit is not None else None
+            return Subscription(produce(), functools.partial(self._release, permit), error_text)
+        flight, start = self._join(key)
+        if start:
+            try:
+                source, leader = self._source(flight, produce)
+                permit = admit() if leader and admit is not None else None
+            except Exception as e:
+                if flight.shared:
+                    # 已声明由本进程生成，通知正在读取的其他进程
+                    self._append(FLIGHT_KEY_PREFIX + key, LEADER_KEY_PREFIX + key, {'error': str(e)},
+                                 linger=True, release=True)
+                self._reject(flight, e)
+                raise
+            flight.set_ready()
+            threading.Thread(target=self._run, args=(flight, source, permit), daemon=True).start()
+        else:
+            # 等待首个请求获准入
+            flight.ready.wait()
+            if flight.rejection is not None:
+                with self._lock:
+                    flight.subscribers -= 1
+                raise flight.rejection
+        return Subscription(flight.follow(), functools.partial(self._leave, flight), error_text)
+
+    async def stream_async(self, key, produce, admit=None):
+        """stream 的 asyncio 版本：produce() 返回产出文本块的异步生成器，admit 为返回 Permit 的协程函数，返回 AsyncSubscription
+
+        只合并本进程内的请求，不使用 Redis。所有请求都断开时取消生成所在的任务，随之关闭上游连接。
+        """
+        if not self.enabled or key is None:
+            permit = await admit() if admit is not None else None
+            return AsyncSubscription(produce(), functools.partial(self._release, permit))
+        flight, start = self._join(key)
+        if start:
+            with self._lock:
+                self.started += 1
+            try:
+                permit = await admit() if admit is not None else None
+            except asyncio.CancelledError:
+                # 发起请求的客户端在排队时断开，已合并进来的请求按生成失败处理
+                self._reject(flight, FlightError('生成已取消'))
+                raise
+            except Exception as e:
+                self._reject(flight, e)
+                raise
+            flight.task = asyncio.ensure_future(self._run_async(flight, produce(), permit))
+            flight.set_ready()
+        else:
+            await flight.wait_ready_async()
+            if flight.rejection is not None:
+                with self._lock:
+                    flight.subscribers -= 1
+                raise flight.rejection
+        return AsyncSubscription(flight.follow_async(), functools.partial(self._leave_async, flight))
+
+    def _join(self, key):
+        """加入 key 对应的生成，不存在时新建；返回 (Flight, 是否由本请求发起)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            start = flight is None
+            if start:
+                flight = self._flights[key] = Flight(key)
+            else:
+                self.coalesced += 1
+            flight.subscribers += 1
+        return flight, start
+
+    def _reject(self, flight, error):
+        """首个请求未能发起生成，已合并进来的请求抛出同一个异常"""
+        with self._lock:
+            flight.subscribers -= 1
+            self._forget(flight)
+        flight.finish(str(error))
+        flight.set_ready(error)
+
+    def _leave(self, flight):
+        """一个请求读取结束或断开；所有请求都已断开时标记取消并返回 True"""
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done and not flight.shared:
+                # 之后到达的相同请求重新发起
+                flight.cancelled = True
+                self._forget(flight)
+                return True
+        return False
+
+    def _leave_async(self, flight):
+        if self._leave(flight) and flight.task is not None:
+            # 取消生成所在的任务，随之关闭上游连接
+            flight.task.cancel()
+
+    @staticmethod
+    def _release(permit):
+        if permit is not None:
+            permit.release()
+
+    def _forget(self, flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def _finish(self, flight, permit, error):
+        if permit is not None:
+            permit.release()
+        with self._lock:
+            self._forget(flight)
+        flight.finish(error)
+
+    def _run(self, flight, source, permit):
+        error = None
+        try:
+            for chunk in source:
+                if flight.cancelled:
+                    error = '生成已取消'
+                    break
+                flight.publish(chunk)
+        except Exception as e:
+            error = str(e)
+        finally:
+            # 关闭生成器，由其中的 with 关闭上游连接
+            source.close()
+            self._finish(flight, permit, error)
+
+    async def _run_async(self, flight, source, permit):
+        error = None
+        try:
+            async for chunk in source:
+                flight.publish(chunk)
+        except asyncio.CancelledError:
+            error = '生成已取消'
+        except Exception as e:
+            error = str(e)
+        finally:
+            # 关闭生成器，由其中的 async with 关闭上游连接
+            await source.aclose()
+            self._finish(flight, permit, error)
+
+    def _source(self, flight, produce):
+        """本进程生成，或在启用跨进程合并且另一进程正在生成时读取其 Redis 流；返回 (生成器, 是否本进程生成)"""
+        if not self.shared:
+            with self._lock:
+                self.started += 1
+            return produce(), True
+        try:
+            leader = self.client.set(LEADER_KEY_PREFIX + flight.key, '1', nx=True, ex=AI_SINGLEFLIGHT_WAIT)
+        except Exception as e:
+            logger.warning(f"跨进程合并AI请求失败，改为本进程生成: {str(e)}")
+            leader = True
+        with self._lock:
+            if leader:
+                self.started += 1
+            else:
+                self.remote += 1
+        if not leader:
+            return self._read_remote(flight.key), False
+        flight.shared = True
+        return self._publish_remote(flight.key, produce()), True
+
+    def _publish_remote(self, key, source):
+        """产出文本块的同时写入 Redis 流；Redis 出错时只影响其他进程，本进程照常返回"""
+        stream_key = FLIGHT_KEY_PREFIX + key
+        leader_key = LEADER_KEY_PREFIX + key
+        shared = True
+        error = '生成已取消'
+        try:
+            for chunk in source:
+                shared = shared and self._append(stream_key, leader_key, {'chunk': chunk})
+                yield chunk
+            error = None
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            source.close()
+            if shared:
+                self._append(stream_key, leader_key, {'done': '1'} if error is None else {'error': error},
+                             linger=True, release=error is not None)
+
+    def _append(self, stream_key, leader_key, fields, linger=False, release=False):
+        ttl = AI_SINGLEFLIGHT_LINGER if linger else AI_SINGLEFLIGHT_WAIT + AI_SINGLEFLIGHT_LINGER
+        try:
+            pipe = self.client.pipeline()
+            pipe.xadd(stream_key, fields)
+            pipe.expire(stream_key, ttl)
+            if release:
+                # 生成失败，后续的相同请求重新发起
+                pipe.delete(leader_key)
+            else:
+                # 续期，进程退出后其他进程可在 AI_SINGLEFLIGHT_WAIT 秒内接手
+                pipe.expire(leader_key, AI_SINGLEFLIGHT_LINGER if linger else AI_SINGLEFLIGHT_WAIT)
+            pipe.execute()
+            return True
+        except Exception as e:
+            logger.warning(f"写入共享AI生成失败: {str(e)}")
+            return False
+
+    def _read_remote(self, key):
+        stream_key = FLIGHT_KEY_PREFIX + key
+        last_id = '0-0'
+        while True:
+            result = self.client.xread({stream_key: last_id}, count=100, block=AI_SINGLEFLIGHT_WAIT * 1000)
+            if not result:
+                raise FlightError('等待其他进程的生成超时')
+            for entry_id, fields in result[0][1]:
+                last_id = entry_id
+                if 'chunk' in fields:
+                    yield fields['chunk']
+                elif 'error' in fields:
+                    raise FlightError(fields['error'])
+                else:
+                    return
+
+    def render(self):
+        """Prometheus 文本格式的合并指标"""
+        with self._lock:
+            values = (
+                ('ai_singleflight_started_total', '本进程实际发起的上游生成数', self.started),
+                ('ai_singleflight_coalesced_total', '合并到本进程已有生成的请求数', self.coalesced),
+                ('ai_singleflight_remote_total', '读取其他进程生成结果的次数', self.remote),
+                ('ai_singleflight_in_flight', '正在进行的生成数', len(self._flights)),
+            )
+        lines = []
+        for name, help_text, value in values:
+            metric_type = 'gauge' if name.endswith('in_flight') else 'counter'
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+        return lines
+
+
+flights = SingleFlight(redis_client)
@@ -0,0 +1,218 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ai_admission import ADMISSION_HELP, AdmissionController
+from ai_utils import RETRY_STATUS, retry_delay
+from app.metrics import Histogram, describe, format_labels
+
+logger = logging.getLogger(__name__)
+
+# 所有服务商的默认配置，可按服务商用 {名称}_POOL_SIZE 等环境变量覆盖
+# 每个服务商保持的最大空闲连接数
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '16'))
+# 建立连接和两次读取之间的超时（秒），流式响应的读取超时按相邻两块数据计算
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', '60'))
+# 429/5xx 和连接失败的最大重试次数及退避基数（秒），实际等待时间为 [0, 基数 * 2^n] 内的随机值
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', '2'))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv('UPSTREAM_RETRY_BACKOFF', '0.5'))
+# 单次退避的最长等待（秒），服务商返回的 Retry-After 也不超过该值
+UPSTREAM_RETRY_MAX_WAIT = float(os.getenv('UPSTREAM_RETRY_MAX_WAIT', '8'))
+
+# 上游响应耗时分桶（秒），大模型首包可能需要数秒
+UPSTREAM_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _setting(provider, name, default, cast):
+    value = os.getenv(f'{provider.upper()}_{name}')
+    return cast(value) if value else default
+
+
+class UpstreamClient:
+    """单个服务商的HTTP客户端
+
+    复用 requests.Session 的 keep-alive 连接池，避免每次请求重新建立TCP和TLS连接；
+    统一设置超时，对 429/5xx 和连接失败按带抖动的指数退避重试，并记录每个服务商的指标。
+    admission 限制该服务商的并发数和请求速率，由调用方在发起生成前获取准入。
+    asyncio 服务（ai_stream_server.py）用 request_async 通过自己的 aiohttp 会话发送，重试策略、准入和指标与此相同。
+    """
+
+    def __init__(self, name, pool_size=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, retry_backoff=None):
+        self.name = name
+        self.pool_size = pool_size or _setting(name, 'POOL_SIZE', UPSTREAM_POOL_SIZE, int)
+        self.timeout = (
+            connect_timeout or _setting(name, 'CONNECT_TIMEOUT', UPSTREAM_CONNECT_TIMEOUT, float),
+            read_timeout or _setting(name, 'READ_TIMEOUT', UPSTREAM_READ_TIMEOUT, float)
+        )
+        self.max_retries = max_retries if max_retries is not None else \
+            _setting(name, 'MAX_RETRIES', UPSTREAM_MAX_RETRIES, int)
+        self.retry_backoff = retry_backoff if retry_backoff is not None else \
+            _setting(name, 'RETRY_BACKOFF', UPSTREAM_RETRY_BACKOFF, float)
+
+        self.admission = AdmissionController(name)
+
+        self.session = requests.Session()
+        # 重试由本类处理，适配器本身不重试
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self.latency = Histogram(UPSTREAM_LATENCY_BUCKETS)  # 发出请求到收到响应头的耗时
+        self.responses = {}  # HTTP状态码 -> 次数
+        self.retries = 0
+        self.errors = 0  # 重试后仍然失败（连接错误或超时）的请求数
+        self.in_flight = 0
+
+    def _backoff(self, attempt, retry_after=None):
+        """第 attempt 次重试前的等待时间，优先使用服务商给出的 Retry-After"""
+        return retry_delay(attempt, retry_after, self.retry_backoff, UPSTREAM_RETRY_MAX_WAIT)
+
+    def _started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def _ended(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _failed(self, attempt, e):
+        """连接失败或超时：返回重试前的等待时间，已达重试上限时返回 None"""
+        if attempt >= self.max_retries:
+            with self._lock:
+                self.errors += 1
+            return None
+        wait = self._backoff(attempt)
+        logger.warning(f"{self.name} 请求失败，{wait:.2f} 秒后重试: {str(e)}")
+        return wait
+
+    def _responded(self, attempt, status, headers, started):
+        """收到响应头：记录指标，返回重试前的等待时间，不需要重试时返回 None"""
+        with self._lock:
+            self.latency.observe(time.perf_counter() - started)
+            self.responses[status] = self.responses.get(status, 0) + 1
+        if status not in RETRY_STATUS or attempt >= self.max_retries:
+            return None
+        wait = self._backoff(attempt, headers.get('Retry-After'))
+        logger.warning(f"{self.name} 返回 {status}，{wait:.2f} 秒后重试")
+        return wait
+
+    def _retrying(self):
+        with self._lock:
+            self.retries += 1
+
+    def request(self, method, url, **kwargs):
+        """发送请求并返回响应，只在收到响应体之前重试，调用方负责检查状态码和关闭流式响应"""
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        self._started()
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    wait = self._failed(attempt, e)
+                    if wait is None:
+                        raise
+                else:
+                    wait = self._responded(attempt, response.status_code, response.headers, started)
+                    if wait is None:
+                        return response
+                    drain(response)
+                attempt += 1
+                self._retrying()
+                time.sleep(wait)
+        finally:
+            self._ended()
+
+    async def request_async(self, session, method, url, **kwargs):
+        """request 的 asyncio 版本，session 为 aiohttp.ClientSession，返回 aiohttp 的响应"""
+        import aiohttp
+
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(total=None, sock_connect=self.timeout[0],
+                                                           sock_read=self.timeout[1]))
+        attempt = 0
+        self._started()
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    response = await session.request(method, url, **kwargs)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    wait = self._failed(attempt, e)
+                    if wait is None:
+                        raise
+                else:
+                    wait = self._responded(attempt, response.status, response.headers, started)
+                    if wait is None:
+                        return response
+                    await response.read()
+                    response.release()
+                attempt += 1
+                self._retrying()
+                await asyncio.sleep(wait)
+        finally:
+            self._ended()
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def render(self):
+        """导出该服务商的 Prometheus 指标"""
+        labels = {'provider': self.name}
+        with self._lock:
+            lines = self.latency.render('upstream_response_seconds', labels)
+            lines += [f'upstream_responses_total{format_labels(labels, status=status)} {count}'
+                      for status, count in sorted(self.responses.items())]
+            lines.append(f'upstream_retries_total{format_labels(labels)} {self.retries}')
+            lines.append(f'upstream_errors_total{format_labels(labels)} {self.errors}')
+            lines.append(f'upstream_in_flight{format_labels(labels)} {self.in_flight}')
+        return lines + self.admission.render()
+
+
+def drain(response, limit=64 * 1024):
+    """读完响应的剩余部分再关闭，使连接回到连接池复用；剩余内容过多时直接断开"""
+    try:
+        received = 0
+        for chunk in response.iter_content(8192):
+            received += len(chunk)
+            if received > limit:
+                break
+    except requests.exceptions.RequestException:
+        pass
+    response.close()
+
+
+# 每个服务商一个客户端，进程内共享
+siliconflow = UpstreamClient('siliconflow')
+chatglm = UpstreamClient('chatglm')
+ocr = UpstreamClient('ocr')
+
+clients = (siliconflow, chatglm, ocr)
+
+_HELP = (
+    ('upstream_response_seconds', 'histogram', '上游服务从发出请求到收到响应头的耗时（秒）'),
+    ('upstream_responses_total', 'counter', '上游服务各状态码的响应数（含被重试的响应）'),
+    ('upstream_retries_total', 'counter', '上游请求的重试次数'),
+    ('upstream_errors_total', 'counter', '重试后仍连接失败或超时的请求数'),
+    ('upstream_in_flight', 'gauge', '正在进行的上游请求数'),
+) + ADMISSION_HELP
+
+
+def render_metrics():
+    """所有服务商的 Prometheus 文本格式指标"""
+    per_client = [client.render() for client in clients]
+    lines = []
+    for name, metric_type, help_text in _HELP:
+        lines += describe(name, metric_type, help_text)
+        for client_lines in per_client:
+            lines += [line for line in client_lines if line.startswith(name + '{') or line.startswith(name + '_')]
+    return '\n'.join(lines) + '\n'
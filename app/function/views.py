@@ -1,52 +1,184 @@
-import os
-import json  # 添加这一行
 from time import sleep
-import base64
-import requests
+import threading
 from dotenv import load_dotenv
 from flask import jsonify, request, Response
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import jwt_required, get_jwt_identity, verify_jwt_in_request
 import erniebot
 
+from ai_admission import PRIORITY_BULK, PRIORITY_INTERACTIVE, AdmissionError, admission_args
+from ai_utils import (
+    SILICONFLOW_BASE_URL, SILICONFLOW_MODEL, CHATGLM_API_URL, CHATGLM_API_KEY,
+    AIFUNC_PARAMS, AI_LONG_TEXT_THRESHOLD, STREAM_DONE, TAIL_COMMANDS, build_prompt, chatglm_digest, chatglm_payload,
+    estimate_tokens, parse_stream_line, request_digest, siliconflow_request, split_text
+)
 from . import function
+from . import upstream
+from .cache import response_cache
+from .longtext import LongTextJob
+from .ocr_pipeline import (
+    OCR_BATCH_MAX_BYTES, OCR_BATCH_MAX_FILES, OCR_MAX_FILE_BYTES, Upload, UploadTooLarge,
+    cached_result, check_content_length, format_size, recognize
+)
+from .singleflight import flights
 
 load_dotenv()
 
-# SiliconFlow API配置
-SILICONFLOW_API_KEY = os.getenv('SILICONFLOW_API_KEY')
-SILICONFLOW_BASE_URL = "https://api.siliconflow.cn/v1/chat/completions"
 
-# ChatGLM API配置
-CHATGLM_API_URL = os.getenv('CHATGLM_API_URL', 'https://open.bigmodel.cn/api/paas/v4/chat/completions')
-CHATGLM_API_KEY = os.getenv('CHATGLM_API_KEY', '填写key')
+def _admission_args(default_priority=PRIORITY_INTERACTIVE):
+    """准入排队所用的优先级和客户端标识：优先级取自 X-Priority 头或请求体的 priority，客户端为登录用户或IP"""
+    data = request.get_json(silent=True) or {}
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        identity = None
+    return admission_args(request.headers.get('X-Priority') or data.get('priority'), identity,
+                          request.remote_addr, default_priority)
+
+
+def _admit(client, default_priority=PRIORITY_INTERACTIVE):
+    """返回在需要请求上游时获取准入的函数"""
+    priority, client_id = _admission_args(default_priority)
+    return lambda: client.admission.acquire(priority, client_id)
+
+
+def _error_text(e):
+    """生成失败时代替剩余输出的文本，流式接口已发出响应头，只能把错误作为生成内容返回"""
+    return f"处理请求时发生错误: {str(e)}"
+
+
+def _rejected(e):
+    """未获准入时立即返回对应的状态码，不再当作生成内容返回"""
+    return jsonify({'message': e.message, 'code': e.status}), e.status, {'Retry-After': str(e.retry_after)}
+
+
+def _too_large(e):
+    return jsonify({'message': e.message, 'code': 413}), 413
+
+
+def _ocr_page(upload, admit):
+    """识别一页：命中缓存时直接返回，相同图片正在识别时合并到同一次调用"""
+    cached = cached_result(upload)
+    if cached is not None:
+        return cached
+    return _ocr_flight(upload, admit)
+
+
+def _ocr_flight(upload, admit):
+    """调用OCR服务识别一页，相同图片正在识别时合并到同一次调用"""
+    def produce():
+        yield recognize(upload)
+    return ''.join(flights.stream('ocr:' + upload.digest, produce, admit))
 
 
 @function.route('/ocr', methods=['POST'])
 def ocr():
+    # 解析表单前按 Content-Length 拒绝过大的请求
+    try:
+        check_content_length(request.content_length, OCR_MAX_FILE_BYTES)
+    except UploadTooLarge as e:
+        return _too_large(e)
     # 检查是否有文件被上传
     if 'file' not in request.files:
         return jsonify({'message': '无文件上传!', 'code': 400})
     file = request.files['file']
     if file.filename == '':
         return jsonify({'message': '无文件上传!', 'code': 400})
-    image_bytes = file.read()
-    image_base64 = base64.b64encode(image_bytes).decode('ascii')
-    headers = {
-        "Authorization": f"token {os.getenv('ACCESS_TOKEN')}",
-        "Content-Type": "application/json"
-    }
-    payload = {"image": image_base64}
     try:
-        resp = requests.post(url=os.getenv('OCR_API_URL'), json=payload, headers=headers)
-        resp.raise_for_status()
-        ocr_result = resp.json()["result"]
-        result = ''
-        for text in ocr_result["texts"]:
-            result += text["text"] + '\n'
-        return jsonify({'message': result, 'code': 200})
+        upload = Upload(file)
+    except UploadTooLarge as e:
+        return _too_large(e)
+    try:
+        return jsonify({'message': _ocr_page(upload, _admit(upstream.ocr)), 'code': 200})
+    except AdmissionError as e:
+        return _rejected(e)
     except Exception as e:
         print(f"处理响应时发生错误: {e}")
         return jsonify({'message': '后端小模型OCR服务未启动！', 'code': 400})
+    finally:
+        upload.close()
+
+
+@function.route('/ocr/batch', methods=['POST'])
+def ocr_batch():
+    """
+    批量OCR接口，各页并行识别
+    请求格式：multipart/form-data，字段 files 为多个图片文件
+    响应格式：{'message': [{'filename': ..., 'message': 识别结果或错误信息, 'code': 200}, ...], 'code': 200}，顺序与上传顺序相同
+    同时识别的页数由 OCR 服务商的准入控制决定：每获准入一页才开始识别该页，批量任务默认排在交互式请求之后
+    """
+    try:
+        check_content_length(request.content_length, OCR_BATCH_MAX_BYTES)
+    except UploadTooLarge as e:
+        return _too_large(e)
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({'message': '无文件上传!', 'code': 400})
+    if len(files) > OCR_BATCH_MAX_FILES:
+        return jsonify({'message': f'一次最多识别{OCR_BATCH_MAX_FILES}个文件', 'code': 400})
+    uploads = []
+    try:
+        try:
+            for file in files:
+                remaining = OCR_BATCH_MAX_BYTES - sum(upload.size for upload in uploads)
+                try:
+                    uploads.append(Upload(file, min(OCR_MAX_FILE_BYTES, remaining)))
+                except UploadTooLarge as e:
+                    if remaining < OCR_MAX_FILE_BYTES:
+                        raise UploadTooLarge(f'批量识别的文件合计超过{format_size(OCR_BATCH_MAX_BYTES)}') from e
+                    raise
+        except UploadTooLarge as e:
+            return _too_large(e)
+        return jsonify({'message': _ocr_batch(uploads), 'code': 200})
+    finally:
+        for upload in uploads:
+            upload.close()
+
+
+def _ocr_batch(uploads):
+    """识别各页，返回与 uploads 顺序相同的结果
+
+    本线程依次为每页获取准入，获准入后才启动识别该页的线程并把准入交给它，
+    因此同时识别的页数不超过服务商的并发上限，且与其他请求一起按优先级和客户端公平排队；
+    命中缓存的页不占用准入。某页未获准入时，剩余未命中缓存的页返回相同的错误，不再逐页排队等待。
+    """
+    priority, client_id = _admission_args(PRIORITY_BULK)
+    results = [None] * len(uploads)
+    rejection = None
+
+    def recognize_page(index, permit):
+        upload = uploads[index]
+        try:
+            results[index] = {'filename': upload.filename, 'message': _ocr_flight(upload, lambda: permit), 'code': 200}
+        except Exception as e:
+            print(f"处理响应时发生错误: {e}")
+            results[index] = {'filename': upload.filename, 'message': '后端小模型OCR服务未启动！', 'code': 400}
+        finally:
+            # 合并到其他请求时未用到准入
+            permit.release()
+
+    threads = []
+    try:
+        for index, upload in enumerate(uploads):
+            cached = cached_result(upload)
+            if cached is not None:
+                results[index] = {'filename': upload.filename, 'message': cached, 'code': 200}
+                continue
+            if rejection is None:
+                try:
+                    permit = upstream.ocr.admission.acquire(priority, client_id)
+                except AdmissionError as e:
+                    rejection = e
+            if rejection is not None:
+                results[index] = {'filename': upload.filename, 'message': rejection.message, 'code': rejection.status}
+                continue
+            thread = threading.Thread(target=recognize_page, args=(index, permit), daemon=True)
+            thread.start()
+            threads.append(thread)
+    finally:
+        for thread in threads:
+            thread.join()
+    return results
 
 
 @function.route('/asr', methods=['POST'])
@@ -60,51 +192,89 @@ def asr():
     return jsonify({'message': '后端小模型ASR服务未启动！', 'code': 400})
 
 
+def _siliconflow_stream(prompt, params, cache_key=None):
+    """请求 SiliconFlow 并逐块产出增量文本，出错时抛出异常；完整结束（收到 [DONE]）时把结果写入缓存"""
+    headers, payload = siliconflow_request(prompt, params)
+    # 只缓存完整结束的结果，出错或客户端中途断开的不缓存
+    chunks = []
+    # 客户端断开时生成器被关闭，with 负责把连接还给连接池
+    with upstream.siliconflow.post(
+        SILICONFLOW_BASE_URL,
+        headers=headers,
+        json=payload,
+        stream=True
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            content = parse_stream_line(line)
+            if content is STREAM_DONE:
+                upstream.drain(response)
+                if cache_key is not None:
+                    response_cache.set(cache_key, ''.join(chunks))
+                break
+            if content:
+                chunks.append(content)
+                yield content
+
+
+def _cached_stream(prompt, params, regenerate=False):
+    """长文本各块的生成，命中缓存时直接回放，文档修改后只有变动的块需要重新生成"""
+    cache_key = response_cache.make_key(SILICONFLOW_MODEL, prompt, params)
+    cached = None if regenerate else response_cache.get(cache_key)
+    if cached is not None:
+        return response_cache.replay(cached)
+    return _siliconflow_stream(prompt, params, cache_key)
+
+
 @function.route('/AIFunc', methods=['POST'])
 def AIFunc():
     data = request.get_json()
     command = data['command']
     text = data['text']
-    # 根据 command 构建 prompt（省略相同逻辑）
-    prompt = build_prompt(command, text, data)
+    params = AIFUNC_PARAMS
+    # 长文本分块处理，续写只需要文本末尾
+    chunks = split_text(text) if estimate_tokens(text) > AI_LONG_TEXT_THRESHOLD else [text]
+    if command in TAIL_COMMANDS:
+        chunks = chunks[-1:]
+    # 根据 command 构建 prompt
+    prompt = build_prompt(command, chunks[0] if len(chunks) == 1 else text, data)
+
+    # 相同的模型、prompt 和参数直接回放缓存的结果，用户要求重新生成时跳过缓存
+    cache_key = response_cache.make_key(SILICONFLOW_MODEL, prompt, params)
+    cached = None if data.get('regenerate') else response_cache.get(cache_key)
+    if cached is not None:
+        return Response(response_cache.replay(cached), content_type='text/event-stream', headers={'X-Cache': 'HIT'})
+
+    priority, client = _admission_args()
 
     def generate_siliconflow():
-        headers = {
-            "Authorization": f"Bearer {SILICONFLOW_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "model": "Qwen/Qwen2.5-7B-Instruct",
-            "messages": [{"role": "user", "content": prompt}],
-            "stream": True,
-            "max_tokens": 2048,
-            "temperature": 0.7
-        }
         try:
-            response = requests.post(
-                SILICONFLOW_BASE_URL,
-                headers=headers,
-                json=payload,
-                stream=True,
-                timeout=30
-            )
-            response.raise_for_status()
-            for line in response.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
-                        if line.strip() == 'data: [DONE]':
-                            break
-                        data_json = json.loads(line[6:])
-                        choices = data_json.get('choices', [])
-                        if choices:
-                            content = choices[0].get('delta', {}).get('content', '')
-                            if content:
-                                yield content
+            yield from _siliconflow_stream(prompt, params, cache_key)
         except Exception as e:
-            yield f"处理请求时发生错误: {str(e)}"
+            yield _error_text(e)
 
-    return Response(generate_siliconflow(), content_type='text/event-stream')
+    def generate_long_text():
+        job = LongTextJob(command, chunks, data, lambda chunk_prompt: _cached_stream(chunk_prompt, params, data.get('regenerate')),
+                          lambda: upstream.siliconflow.admission.acquire(priority, client))
+        pieces = []
+        try:
+            for piece in job:
+                pieces.append(piece)
+                yield piece
+        except Exception as e:
+            yield _error_text(e)
+            return
+        if not job.failed:
+            response_cache.set(cache_key, ''.join(pieces))
+
+    # 相同的请求正在生成时（多人同时点击、重复提交）读取同一次生成的输出，重新生成时不合并
+    key = None if data.get('regenerate') else 'AIFunc:' + request_digest(SILICONFLOW_MODEL, prompt, params)
+    try:
+        stream = flights.stream(key, generate_long_text if len(chunks) > 1 else generate_siliconflow,
+                                lambda: upstream.siliconflow.admission.acquire(priority, client), _error_text)
+    except AdmissionError as e:
+        return _rejected(e)
+    return Response(stream, content_type='text/event-stream', headers={'X-Cache': 'MISS'})
 
 
 @function.route('/chatglm', methods=['POST'])
@@ -117,28 +287,23 @@ def chatglm():
     if not CHATGLM_API_KEY:
         return jsonify({'message': 'ChatGLM API 密钥未配置', 'code': 400})
     data = request.get_json()
-    messages = data.get('messages', [])
-    model = data.get('model', 'glm-4-flash')
-    temperature = data.get('temperature', 0.7)
-    top_p = data.get('top_p', 0.9)
-    max_tokens = data.get('max_tokens', 1024)
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "top_p": top_p,
-        "max_tokens": max_tokens
-    }
+    payload = chatglm_payload(data, stream=False)
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {CHATGLM_API_KEY}"
     }
-    try:
-        resp = requests.post(CHATGLM_API_URL, json=payload, headers=headers)
+
+    def generate():
+        resp = upstream.chatglm.post(CHATGLM_API_URL, json=payload, headers=headers)
         resp.raise_for_status()
         result = resp.json()
-        ai_msg = result.get('choices', [{}])[0].get('message', {}).get('content', '')
+        yield result.get('choices', [{}])[0].get('message', {}).get('content', '')
+
+    try:
+        ai_msg = ''.join(flights.stream('chatglm:' + chatglm_digest(payload), generate, _admit(upstream.chatglm)))
         return jsonify({'message': ai_msg, 'code': 200})
+    except AdmissionError as e:
+        return _rejected(e)
     except Exception as e:
         print(f"调用 ChatGLM API 时发生错误: {e}")
         return jsonify({'message': f'调用 ChatGLM API 失败: {e}', 'code': 500})
@@ -152,38 +317,44 @@ def chatglm_stream():
     if not CHATGLM_API_KEY:
         return jsonify({'message': 'ChatGLM API 密钥未配置', 'code': 400})
     data = request.get_json()
-    messages = data.get('messages', [])
-    model = data.get('model', 'glm-4-flash')
-    temperature = data.get('temperature', 0.7)
-    top_p = data.get('top_p', 0.9)
-    max_tokens = data.get('max_tokens', 1024)
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "top_p": top_p,
-        "max_tokens": max_tokens,
-        "stream": True
-    }
+    payload = chatglm_payload(data, stream=True)
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {CHATGLM_API_KEY}"
     }
     def generate():
-        resp = requests.post(CHATGLM_API_URL, json=payload, headers=headers, stream=True)
-        resp.raise_for_status()
-        for line in resp.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith('data: '):
-                    data = line[6:]
-                    if data == '[DONE]':
+        # 与 AIFunc 相同，出错时把错误作为文本输出给本次请求和合并进来的请求
+        try:
+            with upstream.chatglm.post(CHATGLM_API_URL, json=payload, headers=headers, stream=True) as resp:
+                resp.raise_for_status()
+                for line in resp.iter_lines():
+                    content = parse_stream_line(line)
+                    if content is STREAM_DONE:
+                        upstream.drain(resp)
                         break
-                    try:
-                        data_json = json.loads(data)
-                        content = data_json.get('choices', [{}])[0].get('delta', {}).get('content', '')
-                        if content:
-                            yield content
-                    except:
-                        continue
-    return Response(generate(), content_type='text/event-stream')
+                    if content:
+                        yield content
+        except Exception as e:
+            yield _error_text(e)
+    try:
+        stream = flights.stream('chatglm:' + chatglm_digest(payload), generate, _admit(upstream.chatglm),
+                                _error_text)
+    except AdmissionError as e:
+        return _rejected(e)
+    return Response(stream, content_type='text/event-stream')
+
+
+@function.route('/metrics', methods=['GET'])
+def function_metrics():
+    """Prometheus 格式的上游服务（大模型、OCR）指标"""
+    lines = [
+        '# HELP ai_cache_hits_total AI 文本指令结果缓存的命中次数',
+        '# TYPE ai_cache_hits_total counter',
+        f'ai_cache_hits_total {response_cache.hits}',
+        '# HELP ai_cache_misses_total AI 文本指令结果缓存的未命中次数',
+        '# TYPE ai_cache_misses_total counter',
+        f'ai_cache_misses_total {response_cache.misses}',
+    ]
+    lines += flights.render()
+    return Response(upstream.render_metrics() + '\n'.join(lines) + '\n',
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
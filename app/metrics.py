@@ -0,0 +1,53 @@
+"""
+Prometheus 文本格式的指标工具
+协同编辑指标（app/collaboration/metrics.py）与上游请求指标（app/function/upstream.py）共用
+"""
+
+import bisect
+
+
+class Histogram:
+    """固定分桶的直方图，调用方负责加锁"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(labels, le=format_number(bound))} {cumulative}')
+        lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {self.count}')
+        lines.append(f'{name}_sum{format_labels(labels)} {format_number(self.sum)}')
+        lines.append(f'{name}_count{format_labels(labels)} {self.count}')
+        return lines
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, **extra):
+    """{"a": 1} -> '{a="1"}'，没有标签时返回空字符串"""
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def describe(name, metric_type, help_text):
+    """指标的 HELP/TYPE 行"""
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
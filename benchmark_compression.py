@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+WebSocket压缩策略基准测试
+分别以 off、always、adaptive 三种压缩策略启动 yjs_server.py 和 Socket.IO 服务，
+客户端经由本机计数代理连接，统计线路上的实际字节数、服务进程的CPU时间和常驻内存。
+
+每个房间先由一个客户端写入较大的初始文档，其余客户端加入时收到完整文档（大消息，压缩收益高），
+之后所有客户端按给定频率发送按键级别的小更新和光标（小消息，压缩收益低）。
+
+用法: python benchmark_compression.py [--target both] [--rooms 5,20] [--duration 5]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import yjs_utils
+from benchmark_yjs_fanout import free_port, percentile
+from loadtest_collaboration import (
+    Recorder, SocketIOClient, YjsClient, drive, process_usage, start_server, wait_for_port
+)
+
+POLICIES = ('off', 'always', 'adaptive')
+
+# 初始文档内容，约 40KB 的普通段落文本
+PARAGRAPH = ('协同编辑器需要在多人同时输入时保持文档一致，服务端负责合并更新并转发给房间内的其他成员。'
+             'Collaborative editing keeps every replica consistent while users type concurrently. ')
+SEED_TEXT = PARAGRAPH * 180
+
+
+class ByteCounter:
+    """转发TCP连接并统计两个方向的字节数"""
+
+    def __init__(self, target_port):
+        self.target_port = target_port
+        self.upstream = 0  # 客户端 -> 服务端
+        self.downstream = 0  # 服务端 -> 客户端
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        target_reader, target_writer = await asyncio.open_connection('127.0.0.1', self.target_port)
+        try:
+            await asyncio.gather(
+                self._pipe(reader, target_writer, 'upstream'),
+                self._pipe(target_reader, writer, 'downstream')
+            )
+        except asyncio.CancelledError:
+            # 测试结束时仍未关闭的连接
+            writer.close()
+            target_writer.close()
+
+    async def _pipe(self, reader, writer, direction):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                setattr(self, direction, getattr(self, direction) + len(data))
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+async def seed(target, client):
+    """由第一个客户端写入初始文档"""
+    if target == 'yjs':
+        client.text.insert(0, SEED_TEXT)
+        await client.websocket.send(yjs_utils.encode_sync_update(client.doc.get_update()))
+    else:
+        await client.sio.emit('document_operation', {
+            'document_id': client.room,
+            'operation': {'seq': 0, 'insert': SEED_TEXT, 'position': 0}
+        })
+
+
+async def run_config(target, policy, clients, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as data_dir:
+        env_name = 'YJS_COMPRESSION' if target == 'yjs' else 'COLLAB_WS_COMPRESSION'
+        os.environ[env_name] = policy
+        process = start_server(target, port, data_dir, None)
+        try:
+            await wait_for_port(port, process)
+            counter = ByteCounter(port)
+            await counter.start()
+            recorder = Recorder()
+            client_class = YjsClient if target == 'yjs' else SocketIOClient
+            room = 'compression' if target == 'yjs' else '200000'
+            cpu_start, _ = process_usage(process.pid)
+            started = time.monotonic()
+
+            room_clients = [client_class(1, recorder)]
+            await room_clients[0].connect(counter.port, room)
+            await seed(target, room_clients[0])
+            await asyncio.sleep(0.5)
+            for i in range(2, clients + 1):
+                client = client_class(i, recorder)
+                await client.connect(counter.port, room)
+                if target == 'yjs':
+                    # 请求完整文档
+                    await client.websocket.send(yjs_utils.encode_sync_step1(client.doc.get_state()))
+                room_clients.append(client)
+            receivers = [asyncio.create_task(client.receive()) for client in room_clients]
+            await asyncio.sleep(1)
+            joined_bytes = counter.downstream
+
+            end = time.monotonic() + args.duration
+            await asyncio.gather(*(
+                drive(action, rate, end)
+                for client in room_clients
+                for action, rate in ((client.edit, args.edit_rate), (client.cursor, args.cursor_rate))
+            ))
+            await asyncio.sleep(1)
+            cpu_end, rss = process_usage(process.pid)
+            elapsed = time.monotonic() - started
+
+            for client in room_clients:
+                await client.close()
+            for task in receivers:
+                task.cancel()
+            counter.close()
+        finally:
+            process.terminate()
+            process.wait()
+            os.environ.pop(env_name, None)
+
+    latencies = recorder.latencies
+    return {
+        'target': target,
+        'policy': policy,
+        'clients': clients,
+        'join_kb': round(joined_bytes / 1024, 1),
+        'typing_kb': round((counter.downstream - joined_bytes) / 1024, 1),
+        'upstream_kb': round(counter.upstream / 1024, 1),
+        'cpu_seconds': round(cpu_end - cpu_start, 2) if cpu_start is not None else None,
+        'cpu_percent': round((cpu_end - cpu_start) / elapsed * 100, 1) if cpu_start is not None else None,
+        'rss_mb': round(rss / 1024 / 1024, 1) if rss else None,
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'latency_mean_ms': round(statistics.mean(latencies) * 1000, 2) if latencies else None,
+    }
+
+
+def print_results(results):
+    columns = ['join_kb', 'typing_kb', 'upstream_kb', 'saved', 'cpu_seconds', 'rss_mb', 'latency_p50_ms', 'latency_p99_ms']
+    print(f"{'配置':<28}" + ''.join(f'{column:>16}' for column in columns))
+    baseline = {}
+    for result in results:
+        key = (result['target'], result['clients'])
+        total = result['join_kb'] + result['typing_kb']
+        if result['policy'] == 'off':
+            baseline[key] = total
+        off = baseline.get(key)
+        result['saved'] = f'{1 - total / off:.1%}' if off else '-'
+        name = f"{result['target']}:{result['policy']}:{result['clients']}"
+        print(f'{name:<28}' + ''.join(f'{str(result[column]):>16}' for column in columns))
+
+
+async def run(args):
+    targets = ['yjs', 'socketio'] if args.target == 'both' else [args.target]
+    results = []
+    for target in targets:
+        for clients in args.rooms:
+            for policy in POLICIES:
+                print(f'运行 {target} {policy} {clients} 个客户端 ...', flush=True)
+                results.append(await run_config(target, policy, clients, args))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WebSocket压缩策略基准测试')
+    parser.add_argument('--target', choices=['yjs', 'socketio', 'both'], default='both')
+    parser.add_argument('--rooms', type=lambda v: [int(c) for c in v.split(',') if c], default=[5, 20],
+                        help='房间内客户端数，逗号分隔')
+    parser.add_argument('--duration', type=float, default=5, help='按键阶段持续时间（秒）')
+    parser.add_argument('--edit-rate', type=float, default=5, help='每个客户端每秒编辑次数')
+    parser.add_argument('--cursor-rate', type=float, default=5, help='每个客户端每秒光标更新次数')
+    args = parser.parse_args()
+    print_results(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Y.js广播延迟基准测试
+在子进程中启动Y.js WebSocket服务器，分别以 2、20、200 个连接加入同一文档，
+由一个连接持续发送更新，统计其余连接收到更新的 p50/p99 延迟。
+
+用法: python benchmark_yjs_fanout.py [--updates 200] [--interval 0.005] [--peers 2,20,200]
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import tempfile
+import time
+
+import websockets
+from pycrdt import Doc, Text
+
+import yjs_utils
+
+
+def run_server(port, data_dir):
+    """子进程入口：启动服务器"""
+    os.environ['YJS_DATA_DIR'] = data_dir
+    # 按帧匹配发送和接收，关闭更新合并
+    os.environ['YJS_COALESCE_WINDOW_MS'] = '0'
+    os.environ['COLLAB_AUTH_REQUIRED'] = 'false'
+    import yjs_server
+    logging.getLogger().setLevel(logging.WARNING)
+    server = yjs_server.YjsWebSocketServer('127.0.0.1', port, yjs_utils.YjsSnapshotStore(data_dir))
+
+    async def serve():
+        websocket_server = await server.start_server()
+        await websocket_server.wait_closed()
+
+    asyncio.run(serve())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_server(uri, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with websockets.connect(uri):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def receive(websocket, sent_at, latencies, expected):
+    received = 0
+    while received < expected:
+        message = await websocket.recv()
+        started = sent_at.get(message)
+        if started is not None:
+            latencies.append(time.perf_counter() - started)
+            received += 1
+
+
+async def run_room(port, peers, updates, interval):
+    uri = f'ws://127.0.0.1:{port}/bench-{peers}-{time.time_ns()}'
+    receivers = [await websockets.connect(uri, max_size=None) for _ in range(peers - 1)]
+    sender = await websockets.connect(uri, max_size=None)
+    # 等待所有连接收到服务端的同步第一步
+    for websocket in receivers + [sender]:
+        await websocket.recv()
+
+    doc = Doc()
+    text = doc.get('content', type=Text)
+    sent_at = {}
+    latencies = []
+    tasks = [asyncio.create_task(receive(ws, sent_at, latencies, updates)) for ws in receivers]
+
+    for i in range(updates):
+        state = doc.get_state()
+        text.insert(len(text), f'{i} ')
+        update = doc.get_update(state)
+        frame = yjs_utils.encode_sync_update(update)
+        sent_at[frame] = time.perf_counter()
+        await sender.send(frame)
+        await asyncio.sleep(interval)
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=60)
+    except asyncio.TimeoutError:
+        print(f"  警告: {peers} 个连接的房间在超时前未收到全部更新")
+    for websocket in receivers + [sender]:
+        await websocket.close()
+    return latencies
+
+
+async def run(port, peer_counts, updates, interval):
+    await wait_for_server(f'ws://127.0.0.1:{port}/warmup')
+    print(f"{'连接数':>8} {'样本数':>8} {'p50(ms)':>10} {'p99(ms)':>10} {'平均(ms)':>10}")
+    for peers in peer_counts:
+        latencies = await run_room(port, peers, updates, interval)
+        if not latencies:
+            print(f"{peers:>8} {0:>8} {'-':>10} {'-':>10} {'-':>10}")
+            continue
+        print(f"{peers:>8} {len(latencies):>8} "
+              f"{percentile(latencies, 50) * 1000:>10.2f} "
+              f"{percentile(latencies, 99) * 1000:>10.2f} "
+              f"{statistics.mean(latencies) * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Y.js广播延迟基准测试')
+    parser.add_argument('--updates', type=int, default=200, help='每个房间发送的更新数')
+    parser.add_argument('--interval', type=float, default=0.005, help='两次更新之间的间隔（秒）')
+    parser.add_argument('--peers', default='2,20,200', help='房间连接数，逗号分隔')
+    args = parser.parse_args()
+    peer_counts = [int(p) for p in args.peers.split(',') if p]
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as data_dir:
+        process = multiprocessing.Process(target=run_server, args=(port, data_dir), daemon=True)
+        process.start()
+        try:
+            asyncio.run(run(port, peer_counts, args.updates, args.interval))
+        finally:
+            process.terminate()
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+协同编辑压力测试
+在本机子进程中启动 yjs_server.py 或 Flask Socket.IO 服务，模拟 N 个房间 × M 个客户端的
+编辑和光标流量，统计吞吐量、广播延迟分位数以及服务进程的CPU和内存占用，
+并可保存为基线供之后的版本对比。
+
+用法:
+    python loadtest_collaboration.py --target yjs --rooms 1,10 --clients 2,20 --duration 10
+    python loadtest_collaboration.py --target both --save-baseline loadtest_baseline.json
+    python loadtest_collaboration.py --target both --baseline loadtest_baseline.json
+
+Socket.IO 客户端需要 aiohttp；CPU和内存读取自 /proc，仅支持Linux。
+延迟在同一进程内的发送端和接收端之间测量，包含客户端自身的处理时间。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+from pycrdt import Doc, Text
+
+import yjs_utils
+from benchmark_yjs_fanout import free_port, percentile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 在子进程中启动 Socket.IO 服务，数据库默认使用临时SQLite
+SOCKETIO_SERVER = '''
+import logging, sys
+from app import create_app
+app = create_app()
+logging.disable(logging.WARNING)
+app.socketio.run(app, host='127.0.0.1', port=int(sys.argv[1]), allow_unsafe_werkzeug=True)
+'''
+
+MARKER = re.compile(r'\[(\d+)\]')
+
+
+def process_usage(pid):
+    """进程累计CPU时间（秒）和常驻内存（字节），无法读取时返回 (None, None)"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        return cpu, rss
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None, None
+
+
+async def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f'服务进程已退出，返回码 {process.returncode}')
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+def start_server(target, port, data_dir, database_uri):
+    # 压测客户端不携带令牌
+    env = dict(os.environ, YJS_DATA_DIR=data_dir, COLLAB_AUTH_REQUIRED='false')
+    if target == 'yjs':
+        command = [sys.executable, 'yjs_server.py', '--host', '127.0.0.1', '--port', str(port)]
+    else:
+        env['SQLALCHEMY_DATABASE_URI'] = database_uri or f"sqlite:///{os.path.join(data_dir, 'loadtest.db')}"
+        command = [sys.executable, '-c', SOCKETIO_SERVER, str(port)]
+    return subprocess.Popen(command, cwd=BASE_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class Recorder:
+    """记录每次编辑的发送时间和各接收端收到的延迟"""
+
+    def __init__(self):
+        self.sent_at = {}  # 编辑序号 -> (发送时间, 发送端)
+        self.latencies = []
+        self.frames = 0  # 客户端收到的文档更新帧数
+        self.edits = 0
+        self.cursors = 0
+        self._seq = 0
+
+    def next_edit(self, sender):
+        self._seq += 1
+        self.sent_at[self._seq] = (time.perf_counter(), sender)
+        self.edits += 1
+        return self._seq
+
+    def received(self, seq, receiver):
+        entry = self.sent_at.get(seq)
+        if entry is not None and entry[1] != receiver:
+            self.latencies.append(time.perf_counter() - entry[0])
+
+
+class YjsClient:
+    """模拟 y-websocket 客户端：本地Y.Doc插入带序号的文本，收到的更新应用到本地文档"""
+
+    def __init__(self, index, recorder):
+        self.index = index
+        self.recorder = recorder
+        self.doc = Doc()
+        self.text = self.doc.get('content', type=Text)
+        self.text.observe(self._on_change)
+        self.clock = 0
+
+    def _on_change(self, event):
+        for delta in event.delta:
+            inserted = delta.get('insert')
+            if isinstance(inserted, str):
+                for seq in MARKER.findall(inserted):
+                    self.recorder.received(int(seq), self.index)
+
+    async def connect(self, port, room):
+        self.websocket = await websockets.connect(f'ws://127.0.0.1:{port}/{room}', max_size=None)
+
+    async def edit(self):
+        state = self.doc.get_state()
+        seq = self.recorder.next_edit(self.index)
+        # 只在开头或末尾插入，避免把其他编辑的序号拆开
+        self.text.insert(random.choice((0, len(self.text))), f'[{seq}]')
+        await self.websocket.send(yjs_utils.encode_sync_update(self.doc.get_update(state)))
+
+    async def cursor(self):
+        self.clock += 1
+        self.recorder.cursors += 1
+        state = json.dumps({'cursor': {'anchor': random.randint(0, len(self.text))}, 'user': {'name': f'u{self.index}'}})
+        await self.websocket.send(yjs_utils.encode_awareness_message([(self.index, self.clock, state)]))
+
+    async def receive(self):
+        try:
+            async for message in self.websocket:
+                message_type, sync_type, payload = yjs_utils.decode_message(message)
+                if message_type == yjs_utils.MESSAGE_SYNC and sync_type != yjs_utils.SYNC_STEP1:
+                    self.recorder.frames += 1
+                    self.doc.apply_update(payload)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def close(self):
+        await self.websocket.close()
+
+
+class SocketIOClient:
+    """模拟前端 Socket.IO 客户端：发送 document_operation 和 cursor_position"""
+
+    def __init__(self, index, recorder):
+        import socketio
+        self.index = index
+        self.recorder = recorder
+        # 与浏览器一样在握手时请求 permessage-deflate
+        self.sio = socketio.AsyncClient(reconnection=False, websocket_extra_options={'compress': 15})
+        self.sio.on('document_operation', self._on_operation)
+
+    async def _on_operation(self, data):
+        self.recorder.frames += 1
+        operation = data.get('operation')
+        if isinstance(operation, dict) and 'seq' in operation:
+            self.recorder.received(operation['seq'], self.index)
+
+    async def connect(self, port, room):
+        self.room = room
+        await self.sio.connect(f'http://127.0.0.1:{port}', transports=['websocket'])
+        await self.sio.emit('join_document', {'document_id': room, 'user_info': {'name': f'u{self.index}'}})
+
+    async def edit(self):
+        seq = self.recorder.next_edit(self.index)
+        await self.sio.emit('document_operation', {
+            'document_id': self.room,
+            'operation': {'seq': seq, 'insert': f'[{seq}]', 'position': random.randint(0, 1000)}
+        })
+
+    async def cursor(self):
+        self.recorder.cursors += 1
+        await self.sio.emit('cursor_position', {
+            'document_id': self.room,
+            'position': random.randint(0, 1000),
+            'user_info': {'name': f'u{self.index}'}
+        })
+
+    async def receive(self):
+        await self.sio.wait()
+
+    async def close(self):
+        await self.sio.disconnect()
+
+
+async def drive(action, rate, end):
+    """按泊松过程以平均 rate 次/秒执行 action"""
+    if rate <= 0:
+        return
+    while True:
+        await asyncio.sleep(random.expovariate(rate))
+        if time.monotonic() >= end:
+            return
+        await action()
+
+
+async def sample_usage(pid, peak, stop):
+    while not stop.is_set():
+        _, rss = process_usage(pid)
+        if rss:
+            peak[0] = max(peak[0], rss)
+        await asyncio.sleep(0.5)
+
+
+async def run_config(target, rooms, clients, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as data_dir:
+        process = start_server(target, port, data_dir, args.database_uri)
+        try:
+            await wait_for_port(port, process)
+            recorder = Recorder()
+            client_class = YjsClient if target == 'yjs' else SocketIOClient
+            room_clients = []
+            for room in range(rooms):
+                room_name = f'loadtest-{room}' if target == 'yjs' else str(100000 + room)
+                for i in range(clients):
+                    client = client_class(room * clients + i + 1, recorder)
+                    await client.connect(port, room_name)
+                    room_clients.append(client)
+            receivers = [asyncio.create_task(client.receive()) for client in room_clients]
+            await asyncio.sleep(1)
+
+            cpu_start, _ = process_usage(process.pid)
+            peak = [0]
+            stop = asyncio.Event()
+            sampler = asyncio.create_task(sample_usage(process.pid, peak, stop))
+            started = time.monotonic()
+            end = started + args.duration
+            await asyncio.gather(*(
+                drive(action, rate, end)
+                for client in room_clients
+                for action, rate in ((client.edit, args.edit_rate), (client.cursor, args.cursor_rate))
+            ))
+            # 等待在途的更新送达
+            await asyncio.sleep(args.drain)
+            elapsed = time.monotonic() - started
+            cpu_end, _ = process_usage(process.pid)
+            stop.set()
+            await sampler
+
+            for client in room_clients:
+                await client.close()
+            for task in receivers:
+                task.cancel()
+        finally:
+            process.terminate()
+            process.wait()
+
+    latencies = recorder.latencies
+    expected = recorder.edits * (clients - 1)
+    return {
+        'target': target,
+        'rooms': rooms,
+        'clients': clients,
+        'edits': recorder.edits,
+        'cursors': recorder.cursors,
+        'deliveries': len(latencies),
+        'delivery_ratio': round(len(latencies) / expected, 4) if expected else None,
+        'edits_per_second': round(recorder.edits / args.duration, 1),
+        'deliveries_per_second': round(len(latencies) / args.duration, 1),
+        'frames_per_second': round(recorder.frames / args.duration, 1),
+        'latency_p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'latency_p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'cpu_percent': round((cpu_end - cpu_start) / elapsed * 100, 1) if cpu_start is not None else None,
+        'rss_mb': round(peak[0] / 1024 / 1024, 1) if peak[0] else None,
+    }
+
+
+def config_key(result):
+    return f"{result['target']}:{result['rooms']}x{result['clients']}"
+
+
+def print_results(results):
+    columns = ['edits_per_second', 'deliveries_per_second', 'frames_per_second', 'delivery_ratio',
+               'latency_p50_ms', 'latency_p99_ms', 'cpu_percent', 'rss_mb']
+    print(f"{'配置':<18}" + ''.join(f'{column:>24}' for column in columns))
+    for result in results:
+        print(f'{config_key(result):<18}' + ''.join(f'{str(result[column]):>24}' for column in columns))
+
+
+# 与基线对比的指标：名称 -> 数值越大越好
+COMPARED = {
+    'deliveries_per_second': True,
+    'latency_p99_ms': False,
+    'cpu_percent': False,
+    'rss_mb': False,
+}
+
+
+def compare(results, baseline, tolerance):
+    """与基线对比，返回变差超过 tolerance 的指标"""
+    regressions = []
+    for result in results:
+        previous = baseline.get(config_key(result))
+        if not previous:
+            continue
+        for name, higher_is_better in COMPARED.items():
+            old, new = previous.get(name), result.get(name)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            marker = ' <- 变差' if worse > tolerance else ''
+            print(f'{config_key(result):<18} {name:<24} {old:>10} -> {new:<10} ({change:+.1%}){marker}')
+            if marker:
+                regressions.append((config_key(result), name))
+    return regressions
+
+
+async def run(args):
+    targets = ['yjs', 'socketio'] if args.target == 'both' else [args.target]
+    results = []
+    for target in targets:
+        for rooms in args.rooms:
+            for clients in args.clients:
+                print(f'运行 {target} {rooms} 个房间 × {clients} 个客户端 ...', flush=True)
+                results.append(await run_config(target, rooms, clients, args))
+    return results
+
+
+def parse_counts(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='协同编辑压力测试')
+    parser.add_argument('--target', choices=['yjs', 'socketio', 'both'], default='both')
+    parser.add_argument('--rooms', type=parse_counts, default=[1, 10], help='房间数，逗号分隔')
+    parser.add_argument('--clients', type=parse_counts, default=[2, 10], help='每个房间的客户端数，逗号分隔')
+    parser.add_argument('--duration', type=float, default=10, help='每个配置的持续时间（秒）')
+    parser.add_argument('--drain', type=float, default=2, help='结束后等待在途消息的时间（秒）')
+    parser.add_argument('--edit-rate', type=float, default=5, help='每个客户端每秒编辑次数')
+    parser.add_argument('--cursor-rate', type=float, default=10, help='每个客户端每秒光标更新次数')
+    parser.add_argument('--database-uri', help='Socket.IO 服务使用的数据库，默认临时SQLite')
+    parser.add_argument('--save-baseline', help='把结果保存为基线JSON')
+    parser.add_argument('--baseline', help='与指定的基线JSON对比')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='判定变差的相对阈值')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({config_key(result): result for result in results}, f, ensure_ascii=False, indent=2)
+        print(f'基线已保存到 {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} 项指标相对基线变差超过 {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+本地模拟的大模型和OCR服务
+提供与 SiliconFlow/ChatGLM 兼容的 /v1/chat/completions（流式和非流式）以及 /ocr 接口，
+可设置首包延迟、逐token间隔和按比例返回 429/503，用于在本机测试和压测上游客户端。
+GET /stats 返回已接受的TCP连接数、请求数和被调用方中途取消的流式生成数，用于确认连接复用和取消。
+
+用法: python mock_ai_provider.py [--port 9100] [--latency 0.2] [--token-delay 0.02] [--fail-rate 0.1]
+然后设置 SILICONFLOW_BASE_URL / CHATGLM_API_URL 为 http://127.0.0.1:9100/v1/chat/completions，
+OCR_API_URL 为 http://127.0.0.1:9100/ocr
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+stats = {'connections': 0, 'requests': 0, 'failures': 0, 'cancelled': 0}
+stats_lock = threading.Lock()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持 keep-alive
+    options = None
+
+    def setup(self):
+        super().setup()
+        with stats_lock:
+            stats['connections'] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with stats_lock:
+                self._send_json(200, dict(stats))
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        with stats_lock:
+            stats['requests'] += 1
+        options = self.options
+        time.sleep(options.latency)
+        if random.random() < options.fail_rate:
+            with stats_lock:
+                stats['failures'] += 1
+            status = random.choice((429, 503))
+            self._send_json(status, {'error': 'mock failure'}, {'Retry-After': '0'} if status == 429 else None)
+            return
+        if self.path.startswith('/ocr'):
+            self._send_json(200, {'result': {'texts': [{'text': f'识别结果 {len(body.get("image", ""))} 字节'}]}})
+        elif self.path.startswith('/v1/chat/completions'):
+            self._chat(body, options)
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def _chat(self, body, options):
+        prompt = ''.join(str(m.get('content', '')) for m in body.get('messages', []))
+        tokens = [f'回复{i} ' for i in range(options.tokens)]
+        if options.echo:
+            tokens.insert(0, f'[{prompt.strip()[-options.echo:]}] ')
+        if not body.get('stream'):
+            time.sleep(options.token_delay * len(tokens))
+            self._send_json(200, {
+                'choices': [{'message': {'role': 'assistant', 'content': ''.join(tokens)}}],
+                'usage': {'prompt_tokens': len(prompt), 'completion_tokens': len(tokens)}
+            })
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for token in tokens:
+                chunk = {'choices': [{'delta': {'content': token}}]}
+                self._write_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+                time.sleep(options.token_delay)
+            self._write_chunk(b'data: [DONE]\n\n')
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            # 调用方取消了生成
+            self.close_connection = True
+            with stats_lock:
+                stats['cancelled'] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的大模型和OCR服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.2, help='首包延迟（秒）')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='流式响应两个token之间的间隔（秒）')
+    parser.add_argument('--tokens', type=int, default=50, help='每次回复的token数')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='返回 429/503 的请求比例')
+    parser.add_argument('--echo', type=int, default=0, help='回复开头附上 prompt 末尾的字符数，用于核对分块处理的顺序')
+    args = parser.parse_args()
+
+    MockHandler.options = args
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    print(f'模拟服务已启动: http://{args.host}:{args.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
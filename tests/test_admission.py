@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import ai_admission
+from ai_admission import PRIORITY_BULK, PRIORITY_INTERACTIVE, AdmissionController, AdmissionError
+
+
+def controller(**kwargs):
+    settings = dict(max_concurrency=1, rate=0, burst=1, max_queue=16, queue_timeout=5)
+    settings.update(kwargs)
+    return AdmissionController('test', **settings)
+
+
+def admit_in_order(admission, requests):
+    """在唯一名额被占用时依次排队 requests（(优先级, 客户端)），释放后记录放行顺序"""
+    holder = admission.acquire()
+    order = []
+    threads = []
+    for label, (priority, client) in enumerate(requests):
+        def wait(label=label, priority=priority, client=client):
+            with admission.acquire(priority, client):
+                order.append(label)
+        thread = threading.Thread(target=wait)
+        thread.start()
+        threads.append(thread)
+        # 按顺序进入队列
+        deadline = time.monotonic() + 2
+        while admission.waiting <= label and time.monotonic() < deadline:
+            time.sleep(0.001)
+    holder.release()
+    for thread in threads:
+        thread.join(5)
+    return order
+
+
+def test_concurrency_limit_and_release():
+    admission = controller(max_concurrency=2)
+    first, second = admission.acquire(), admission.acquire()
+    assert admission.active == 2
+    first.release()
+    first.release()  # 重复释放只归还一次
+    assert admission.active == 1
+    with admission.acquire():
+        assert admission.active == 2
+    second.release()
+    assert admission.active == 0 and admission.admitted == 3
+
+
+def test_interactive_requests_go_before_bulk():
+    admission = controller()
+    order = admit_in_order(admission, [(PRIORITY_BULK, 'a'), (PRIORITY_BULK, 'b'), (PRIORITY_INTERACTIVE, 'c')])
+    assert order == [2, 0, 1]
+
+
+def test_clients_take_turns_within_a_priority():
+    admission = controller()
+    order = admit_in_order(admission, [(PRIORITY_BULK, 'a')] * 3 + [(PRIORITY_BULK, 'b')] * 2)
+    # a 先到的三个请求不会排在 b 的请求前面连续放行
+    assert order == [0, 3, 1, 4, 2]
+
+
+def test_full_queue_is_rejected_with_429():
+    admission = controller(max_queue=1, queue_timeout=2)
+    holder = admission.acquire()
+    waiter = threading.Thread(target=lambda: admission.acquire().release())
+    waiter.start()
+    while admission.waiting < 1:
+        time.sleep(0.001)
+    with pytest.raises(AdmissionError) as error:
+        admission.acquire()
+    assert error.value.status == 429 and admission.rejected == 1
+    holder.release()
+    waiter.join(5)
+
+
+def test_queue_timeout_returns_503():
+    admission = controller(queue_timeout=0.05)
+    holder = admission.acquire()
+    with pytest.raises(AdmissionError) as error:
+        admission.acquire()
+    assert error.value.status == 503 and error.value.retry_after >= 1
+    assert admission.timeouts == 1 and admission.waiting == 0
+    holder.release()
+    assert admission.active == 0
+
+
+def test_token_bucket_limits_rate_after_burst():
+    admission = controller(max_concurrency=0, rate=20, burst=2)
+    started = time.monotonic()
+    for _ in range(4):
+        admission.acquire().release()
+    # 突发容量内的两个立即放行，其余两个各等待一个令牌（1/20 秒）
+    assert time.monotonic() - started >= 2 / 20 * 0.8
+    assert admission.admitted == 4
+
+
+def test_async_acquire_and_cancelled_waiter():
+    admission = controller()
+
+    async def scenario():
+        holder = await admission.acquire_async()
+        waiting = asyncio.ensure_future(admission.acquire_async(PRIORITY_BULK, 'x'))
+        await asyncio.sleep(0.05)
+        assert admission.waiting == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert admission.waiting == 0
+        holder.release()
+        permit = await asyncio.wait_for(admission.acquire_async(), 1)
+        permit.release()
+
+    asyncio.run(scenario())
+    assert admission.active == 0 and admission.waiting == 0
+
+
+def test_admission_args():
+    assert ai_admission.admission_args('bulk', 7, '1.2.3.4') == (PRIORITY_BULK, 'user:7')
+    assert ai_admission.admission_args(None, None, '1.2.3.4') == (PRIORITY_INTERACTIVE, 'ip:1.2.3.4')
+    assert ai_admission.admission_args(None, None, 'h', PRIORITY_BULK) == (PRIORITY_BULK, 'ip:h')
@@ -0,0 +1,125 @@
+import pytest
+
+import ai_utils
+from ai_utils import CACHE_INDEX_KEY, ResponseCache
+
+
+class FakeRedis:
+    """ResponseCache 用到的 Redis 命令的内存实现"""
+
+    def __init__(self):
+        self.values = {}
+        self.sorted = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def zadd(self, name, mapping):
+        self.sorted.setdefault(name, {}).update(mapping)
+
+    def zremrangebyscore(self, name, low, high):
+        members = self.sorted.get(name, {})
+        for member in [m for m, score in members.items() if low <= score <= high]:
+            del members[member]
+
+    def zcard(self, name):
+        return len(self.sorted.get(name, {}))
+
+    def zpopmin(self, name, count):
+        members = self.sorted.get(name, {})
+        popped = sorted(members.items(), key=lambda item: item[1])[:count]
+        for member, _ in popped:
+            del members[member]
+        return popped
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(ai_utils, 'time', Clock())
+    monkeypatch.setattr(ai_utils, 'AI_CACHE_MAX_ENTRIES', 2)
+    return ResponseCache(FakeRedis(), enabled=True)
+
+
+def test_key_depends_on_model_prompt_and_params():
+    key = ResponseCache.make_key('m', 'p', {'temperature': 0.7})
+    assert key.startswith(ai_utils.CACHE_KEY_PREFIX)
+    assert key == ResponseCache.make_key('m', 'p', {'temperature': 0.7})
+    assert key != ResponseCache.make_key('m', 'p', {'temperature': 0.8})
+    assert key != ResponseCache.make_key('m2', 'p', {'temperature': 0.7})
+
+
+def test_evicts_least_recently_used_entry(cache):
+    cache.set('a', 'A')
+    cache.set('b', 'B')
+    assert cache.get('a') == 'A'  # a 变为最近使用
+    cache.set('c', 'C')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A' and cache.get('c') == 'C'
+    assert set(cache.client.sorted[CACHE_INDEX_KEY]) == {'a', 'c'}
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_expired_index_entries_are_pruned(cache, monkeypatch):
+    monkeypatch.setattr(ai_utils, 'AI_CACHE_TTL', 5)
+    cache.set('old', 'X')
+    cache.client.values.pop('old')  # Redis 中的值已过期
+    ai_utils.time.now += 10
+    cache.set('new', 'Y')
+    assert set(cache.client.sorted[CACHE_INDEX_KEY]) == {'new'}
+
+
+def test_skips_empty_oversized_and_disabled(cache, monkeypatch):
+    monkeypatch.setattr(ai_utils, 'AI_CACHE_MAX_ENTRY_CHARS', 4)
+    cache.set('empty', '')
+    cache.set('big', 'x' * 5)
+    assert cache.client.values == {}
+
+    disabled = ResponseCache(cache.client, enabled=False)
+    disabled.set('a', 'A')
+    assert disabled.get('a') is None and cache.client.values == {}
+
+
+def test_redis_errors_are_treated_as_misses(cache):
+    class Broken:
+        def __getattr__(self, name):
+            raise ConnectionError('redis down')
+
+    broken = ResponseCache(Broken(), enabled=True)
+    broken.set('a', 'A')
+    assert broken.get('a') is None
+
+
+def test_replay_yields_fixed_size_chunks(monkeypatch):
+    monkeypatch.setattr(ai_utils, 'AI_CACHE_REPLAY_CHUNK', 3)
+    assert list(ResponseCache.replay('abcdefg')) == ['abc', 'def', 'g']
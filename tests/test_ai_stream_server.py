@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import ipaddress
+import threading
+from http.server import ThreadingHTTPServer
+
+import jwt
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import ai_stream_server
+import ai_utils
+import collab_auth
+import mock_ai_provider
+from app.function import upstream
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    """在后台线程中运行 mock_ai_provider，SiliconFlow 和 ChatGLM 都指向它"""
+    options = argparse.Namespace(latency=0.05, token_delay=0.005, tokens=10, fail_rate=0.0, echo=12)
+    monkeypatch.setattr(mock_ai_provider.MockHandler, 'options', options)
+    for key in mock_ai_provider.stats:
+        monkeypatch.setitem(mock_ai_provider.stats, key, 0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), mock_ai_provider.MockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/v1/chat/completions'
+    monkeypatch.setattr(ai_utils, 'SILICONFLOW_BASE_URL', url)
+    monkeypatch.setattr(ai_utils, 'CHATGLM_API_URL', url)
+    monkeypatch.setattr(ai_utils, 'CHATGLM_API_KEY', 'test')
+    yield options
+    server.shutdown()
+    server.server_close()
+
+
+def run(scenario):
+    async def main():
+        client = TestClient(TestServer(ai_stream_server.create_app()))
+        await client.start_server()
+        try:
+            return await scenario(client)
+        finally:
+            await client.close()
+    return asyncio.run(main())
+
+
+def test_identical_requests_share_one_generation(provider):
+    async def scenario(client):
+        async def ask():
+            response = await client.post('/function/AIFunc', json={'command': '润色', 'text': '同一段文字'})
+            return response.status, await response.text()
+        return await asyncio.gather(*(ask() for _ in range(3)))
+
+    results = run(scenario)
+    assert mock_ai_provider.stats['requests'] == 1
+    assert all(status == 200 for status, _ in results)
+    assert len({text for _, text in results}) == 1 and '回复9' in results[0][1]
+
+
+def test_long_text_chunks_are_streamed_in_order(provider):
+    # 每段约1000个估算token，按默认配置切成4块
+    paragraphs = [f'第{i}段' + '内容' * 500 + f'结尾{i}' for i in range(4)]
+
+    async def scenario(client):
+        response = await client.post('/function/AIFunc', json={'command': '润色', 'text': '\n\n'.join(paragraphs)})
+        return await response.text()
+
+    text = run(scenario)
+    assert mock_ai_provider.stats['requests'] == 4
+    positions = [text.index(f'结尾{i}') for i in range(4)]
+    assert positions == sorted(positions)
+
+
+def test_client_disconnect_cancels_upstream_generation(provider):
+    provider.token_delay = 0.2
+    provider.tokens = 50
+
+    async def scenario(client):
+        response = await client.post('/function/AIFunc', json={'command': '润色', 'text': '会被中途断开'})
+        assert (await response.content.readany()).decode('utf-8')
+        response.close()
+        proxy = client.app[ai_stream_server.PROXY_KEY]
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            if mock_ai_provider.stats['cancelled'] and not proxy.active:
+                break
+        return proxy
+
+    proxy = run(scenario)
+    assert mock_ai_provider.stats['cancelled'] == 1
+    assert proxy.cancelled == 1 and proxy.active == 0
+    assert not proxy.flights._flights
+    assert upstream.siliconflow.admission.active == 0
+
+
+def test_upstream_failure_is_returned_as_text(provider, monkeypatch):
+    provider.fail_rate = 1.0
+    monkeypatch.setattr(upstream.chatglm, 'max_retries', 0)
+
+    async def scenario(client):
+        response = await client.post('/function/chatglm/stream', json={'messages': [{'role': 'user', 'content': 'hi'}]})
+        return response.status, await response.text()
+
+    status, text = run(scenario)
+    assert status == 200
+    assert text.startswith('处理请求时发生错误')
+
+
+def test_cors_only_reflects_configured_origins(provider, monkeypatch):
+    monkeypatch.setattr(ai_stream_server, 'CORS_ORIGINS', ['https://editor.example'])
+
+    async def scenario(client):
+        headers = []
+        for origin in ('https://editor.example', 'https://evil.example'):
+            response = await client.get('/metrics', headers={'Origin': origin})
+            headers.append(response.headers)
+        return headers
+
+    allowed, other = run(scenario)
+    assert allowed['Access-Control-Allow-Origin'] == 'https://editor.example'
+    assert allowed['Access-Control-Allow-Credentials'] == 'true'
+    assert 'Access-Control-Allow-Origin' not in other
+
+    monkeypatch.setattr(ai_stream_server, 'CORS_ORIGINS', ['*'])
+    wildcard, = run(lambda client: asyncio.gather(client.get('/metrics', headers={'Origin': 'https://a.example'})))
+    assert wildcard.headers['Access-Control-Allow-Origin'] == '*'
+    assert 'Access-Control-Allow-Credentials' not in wildcard.headers
+
+
+def test_admission_uses_user_identity_when_authenticated():
+    class Request:
+        remote = '10.0.0.1'
+
+        def __init__(self, headers):
+            self.headers = headers
+
+    token = jwt.encode({'sub': '42', 'type': 'access'}, collab_auth.JWT_SECRET, algorithm=collab_auth.JWT_ALGORITHM)
+    assert ai_stream_server.request_admission_args(Request({'Authorization': f'Bearer {token}'}), {}) == (0, 'user:42')
+    assert ai_stream_server.request_admission_args(Request({'X-Priority': 'bulk'}), {}) == (1, 'ip:10.0.0.1')
+    assert ai_stream_server.request_admission_args(Request({'Authorization': 'Bearer bad'}), {})[1] == 'ip:10.0.0.1'
+
+
+def test_forwarded_for_is_only_trusted_from_configured_proxies(monkeypatch):
+    class Request:
+        def __init__(self, remote, forwarded):
+            self.remote = remote
+            self.headers = {'X-Forwarded-For': forwarded}
+
+    assert ai_stream_server.client_address(Request('203.0.113.9', '1.1.1.1')) == '203.0.113.9'
+    monkeypatch.setattr(ai_stream_server, 'AI_STREAM_TRUSTED_PROXIES',
+                        [ipaddress.ip_network('127.0.0.1'), ipaddress.ip_network('10.0.0.0/8')])
+    assert ai_stream_server.client_address(Request('203.0.113.9', '1.1.1.1')) == '203.0.113.9'
+    # 客户端自己伪造的前缀被跳过，取可信代理之前的第一个地址
+    assert ai_stream_server.client_address(Request('127.0.0.1', '1.1.1.1, 198.51.100.7, 10.1.2.3')) == '198.51.100.7'
+    assert ai_stream_server.client_address(Request('127.0.0.1', '')) == '127.0.0.1'
+    assert ai_stream_server.request_admission_args(Request('10.0.0.5', '198.51.100.7'), {}) == (0, 'ip:198.51.100.7')
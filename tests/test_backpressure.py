@@ -0,0 +1,158 @@
+import asyncio
+
+import pycrdt
+import pytest
+
+import yjs_server
+import yjs_utils
+from app.collaboration import backpressure
+from app.collaboration.backpressure import DROP, RESYNC, SEND, SKIP, OutboundRegulator
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(backpressure, 'time', clock)
+    monkeypatch.setattr(yjs_server, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def regulator(monkeypatch, clock):
+    monkeypatch.setattr(backpressure, 'OUTBOUND_HIGH_WATERMARK', 100)
+    monkeypatch.setattr(backpressure, 'OUTBOUND_LOW_WATERMARK', 10)
+    monkeypatch.setattr(backpressure, 'OUTBOUND_HARD_LIMIT', 1000)
+    monkeypatch.setattr(backpressure, 'OUTBOUND_MAX_LAG_SECONDS', 30)
+    regulator = OutboundRegulator()
+    regulator.depths = {}
+    regulator.queue_depth = lambda sid, namespace='/': regulator.depths.get(sid, 0)
+    return regulator
+
+
+def test_skip_until_drained_below_low_watermark_then_resync(regulator):
+    regulator.depths['a'] = 100
+    assert regulator.check('a') == SEND
+    regulator.depths['a'] = 101
+    assert regulator.check('a') == SKIP and regulator.is_lagging('a')
+    # 回落到高水位以下但仍高于低水位时继续跳过
+    regulator.depths['a'] = 50
+    assert regulator.check('a') == SKIP
+    regulator.depths['a'] = 10
+    assert regulator.check('a') == RESYNC and not regulator.is_lagging('a')
+    assert regulator.check('a') == SEND
+    assert (regulator.skipped, regulator.resynced, regulator.dropped) == (2, 1, 0)
+
+
+def test_hard_limit_drops_lagging_connection(regulator):
+    regulator.depths['a'] = 5000
+    # 第一次超过高水位只是开始跳过
+    assert regulator.check('a') == SKIP
+    assert regulator.check('a') == DROP
+    assert not regulator.is_lagging('a') and regulator.dropped == 1
+
+
+def test_max_lag_drops_connection(regulator, clock):
+    regulator.depths['a'] = 200
+    assert regulator.check('a') == SKIP
+    clock.now += 30
+    assert regulator.check('a') == SKIP
+    clock.now += 1
+    assert regulator.check('a') == DROP
+
+
+def test_partition_excludes_sender(regulator):
+    regulator.depths.update({'lagging': 200, 'recovered': 200, 'dead': 200})
+    for sid in ('lagging', 'recovered', 'dead'):
+        regulator.check(sid)
+    regulator.depths.update({'recovered': 0, 'dead': 2000})
+    sids = ['sender', 'fine', 'lagging', 'recovered', 'dead']
+    assert regulator.partition(sids, exclude='sender') == (['lagging'], ['recovered'], ['dead'])
+    regulator.forget('lagging')
+    assert not regulator.is_lagging('lagging')
+
+
+class Peer:
+    def __init__(self, websocket, pending=0):
+        self.websocket = websocket
+        self.pending = pending
+        self.closed = False
+        self.sent = []
+
+    def pending_bytes(self):
+        return self.pending
+
+    def enqueue(self, message):
+        self.sent.append(message)
+        return True
+
+
+class WebSocket:
+    def __init__(self):
+        self.close_code = None
+
+    async def close(self, code=1000, reason=''):
+        self.close_code = code
+
+
+@pytest.fixture
+def server(monkeypatch, clock):
+    monkeypatch.setattr(yjs_server, 'YJS_OUTBOUND_HIGH_WATERMARK', 100)
+    monkeypatch.setattr(yjs_server, 'YJS_OUTBOUND_LOW_WATERMARK', 10)
+    monkeypatch.setattr(yjs_server, 'YJS_OUTBOUND_MAX_LAG_SECONDS', 30)
+    server = yjs_server.YjsWebSocketServer(store=object(), authenticate=False)
+    doc = pycrdt.Doc()
+    doc['t'] = text = pycrdt.Text()
+    text += 'state'
+    yjs_server.documents['bp'] = {'doc': doc}
+    yield server
+    yjs_server.documents.pop('bp', None)
+    yjs_server.connections.pop('bp', None)
+
+
+def test_server_peer_transitions(server, clock):
+    peer = Peer(WebSocket(), pending=101)
+    assert server.check_backpressure(peer) == 'skip'
+    peer.pending = 11
+    assert server.check_backpressure(peer) == 'skip'
+    peer.pending = 10
+    assert server.check_backpressure(peer) == 'resync'
+    assert server.check_backpressure(peer) == 'send'
+
+    peer.pending = 101
+    assert server.check_backpressure(peer) == 'skip'
+    clock.now += 31
+    assert server.check_backpressure(peer) == 'drop'
+    assert peer.websocket not in server.lagging
+
+
+def test_fan_out_skips_resyncs_and_drops(server, clock):
+    fine, slow, recovered, dead = (WebSocket() for _ in range(4))
+    peers = {ws: Peer(ws) for ws in (fine, slow, recovered, dead)}
+    server.peers.update(peers)
+    yjs_server.connections['bp'] = set(peers)
+    for ws in (slow, recovered, dead):
+        peers[ws].pending = 500
+        server.check_backpressure(peers[ws])
+    peers[recovered].pending = 0
+    # dead 已落后超过最长时间
+    server.lagging[dead] = clock.now - 31
+
+    async def scenario():
+        server.fan_out('bp', list(peers), b'update')
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert peers[fine].sent == [b'update']
+    assert peers[slow].sent == []
+    # 已追上的连接收到完整状态而不是本次增量
+    assert peers[recovered].sent == [yjs_utils.encode_sync_update(server.encode_state('bp'))]
+    assert peers[dead].sent == [] and dead.close_code == 1013
+    assert yjs_server.connections['bp'] == {fine, slow, recovered}
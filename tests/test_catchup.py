@@ -0,0 +1,57 @@
+import pycrdt
+
+from app.collaboration import state as collab_state
+from app.collaboration.state import new_document_state, append_operation, operations_since, all_operations
+
+
+def yjs_updates(count):
+    """依次产生 count 个Y.js增量更新，JSON客户端以数字数组发送"""
+    doc = pycrdt.Doc()
+    doc['t'] = text = pycrdt.Text()
+    updates = []
+    for index in range(count):
+        before = doc.get_state()
+        text += str(index)
+        updates.append(list(doc.get_update(before)))
+    return updates
+
+
+def test_returns_only_missing_operations():
+    state = new_document_state()
+    updates = yjs_updates(5)
+    for update in updates:
+        append_operation(state, update)
+    assert operations_since(state, 5) == []
+    assert operations_since(state, 3) == updates[3:]
+    assert operations_since(state, 0) == updates
+
+
+def test_invalid_versions_fall_back_to_full_state():
+    state = new_document_state()
+    append_operation(state, yjs_updates(1)[0])
+    assert operations_since(state, None) is None
+    assert operations_since(state, '1') is None
+    assert operations_since(state, -1) is None
+    assert operations_since(state, 2) is None
+
+
+def test_versions_folded_into_snapshot_need_full_state():
+    state = new_document_state()
+    updates = yjs_updates(11)
+    for update in updates:
+        append_operation(state, update)
+    assert collab_state.compact(state, retain=4)
+    assert state['base_version'] == 7
+    assert operations_since(state, 6) is None
+    assert operations_since(state, 7) == updates[7:]
+    # 完整状态为快照加剩余操作
+    operations = all_operations(state)
+    assert len(operations) == 5 and isinstance(operations[0], bytes)
+
+
+def test_restored_state_keeps_version_numbering():
+    state = new_document_state('', 10, None, [{'op': 9}, {'op': 10}])
+    assert state['base_version'] == 8
+    assert operations_since(state, 9) == [{'op': 10}]
+    assert append_operation(state, {'op': 11}) == 11
+    assert operations_since(state, 10) == [{'op': 11}]
@@ -0,0 +1,231 @@
+import asyncio
+import functools
+import sqlite3
+import time
+
+import jwt
+import pycrdt
+import pytest
+import websockets
+from flask import Flask
+from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token
+from flask_socketio import SocketIO
+
+import collab_auth
+import yjs_server
+import yjs_utils
+from app.collaboration import state as collab_state
+from app.collaboration import views as collab_views
+from app.collaboration import wire
+from app.collaboration.snapshots import snapshotter
+from app.collaboration.state import document_states
+from app.document.models import Documents
+from database import db
+
+SECRET = 'test-secret'
+
+
+def token(sub='1', token_type='access', expires_in=60, secret=SECRET):
+    claims = {'sub': sub, 'type': token_type, 'exp': int(time.time()) + expires_in}
+    return jwt.encode(claims, secret, algorithm='HS256')
+
+
+@pytest.fixture
+def secret(monkeypatch):
+    monkeypatch.setattr(collab_auth, 'JWT_SECRET', SECRET)
+    monkeypatch.setattr(collab_auth, 'JWT_ALGORITHM', 'HS256')
+
+
+def test_token_source_precedence():
+    headers = {'Authorization': 'Bearer from-header'}
+    assert collab_auth.extract_token({'token': 'from-auth'}, 'token=from-query', headers) == 'from-auth'
+    assert collab_auth.extract_token({'token': ''}, 'token=from-query', headers) == 'from-query'
+    assert collab_auth.extract_token(None, 'a=1', headers) == 'from-header'
+    assert collab_auth.extract_token(None, '', {'Authorization': 'Basic abc'}) is None
+    assert collab_auth.extract_token() is None
+
+
+def test_decode_identity_accepts_access_token(secret):
+    assert collab_auth.decode_identity(token('42')) == '42'
+
+
+@pytest.mark.parametrize('bad_token', [
+    None,
+    '',
+    'not-a-jwt',
+    token(expires_in=-10),
+    token(secret='forged-secret'),
+    token(token_type='refresh'),
+    jwt.encode({'type': 'access', 'exp': int(time.time()) + 60}, SECRET, algorithm='HS256'),
+])
+def test_decode_identity_rejects_invalid_tokens(secret, bad_token):
+    with pytest.raises(collab_auth.AuthError) as e:
+        collab_auth.decode_identity(bad_token)
+    assert e.value.status == 401
+
+
+def test_permission_for_owner_deleted_and_missing(monkeypatch):
+    monkeypatch.setattr(collab_auth, 'DEFAULT_PERMISSION', 'editor')
+    assert collab_auth.permission_for(1, False, '1') == 'owner'
+    assert collab_auth.permission_for(1, True, '1') is None
+    assert collab_auth.permission_for(None, None, '1') is None
+
+
+@pytest.mark.parametrize('default, expected', [
+    ('editor', 'editor'), ('viewer', 'viewer'), ('none', None), ('admin', None),
+])
+def test_permission_for_other_users_follows_default(monkeypatch, default, expected):
+    monkeypatch.setattr(collab_auth, 'DEFAULT_PERMISSION', default)
+    assert collab_auth.permission_for(1, False, '2') == expected
+    assert collab_auth.can_write(expected) == (expected == 'editor')
+    assert collab_auth.can_write('owner')
+
+
+def test_document_id_from_room(monkeypatch):
+    assert collab_auth.document_id_from_room('12') == 12
+    assert collab_auth.document_id_from_room('doc-12') is None
+    monkeypatch.setattr(collab_auth, 'ROOM_PREFIX', 'doc-')
+    assert collab_auth.document_id_from_room('doc-12') == 12
+    assert collab_auth.document_id_from_room('doc-x') is None
+    assert collab_auth.document_id_from_room('12') is None
+
+
+def test_document_lookup_reads_owner_and_deleted_flag(tmp_path):
+    path = tmp_path / 'documents.db'
+    with sqlite3.connect(path) as connection:
+        connection.execute('CREATE TABLE documents (id INTEGER PRIMARY KEY, user_id INTEGER, is_deleted BOOLEAN)')
+        connection.executemany('INSERT INTO documents VALUES (?, ?, ?)', [(1, 7, 0), (2, 8, 1)])
+    lookup = collab_auth.DocumentLookup(f'sqlite:///{path}')
+    assert lookup(1) == (7, 0)
+    assert lookup(2) == (8, 1)
+    assert lookup(3) == (None, None)
+
+
+def handshake(path, lookup, monkeypatch):
+    """启动认证的 WebSocket 服务并连接 path，返回 (状态码, 服务端看到的 (用户ID, 权限))"""
+    monkeypatch.setattr(yjs_server, 'document_lookup', lookup)
+    accepted = []
+
+    async def handler(websocket, _):
+        accepted.append((websocket.user_id, websocket.permission))
+        await websocket.close()
+
+    async def scenario():
+        server = await websockets.serve(
+            handler, 'localhost', 0,
+            create_protocol=functools.partial(yjs_server.AuthenticatingProtocol, authenticate=True))
+        port = server.sockets[0].getsockname()[1]
+        try:
+            async with websockets.connect(f'ws://localhost:{port}{path}') as websocket:
+                await websocket.wait_closed()
+            return 101
+        except websockets.exceptions.InvalidStatusCode as e:
+            return e.status_code
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(scenario()), accepted
+
+
+def test_handshake_accepts_owner_and_records_permission(secret, monkeypatch):
+    status, accepted = handshake(f'/5?token={token("7")}', lambda document_id: (7, False), monkeypatch)
+    assert status == 101
+    assert accepted == [('7', 'owner')]
+
+
+@pytest.mark.parametrize('path, lookup, expected', [
+    ('/5', lambda document_id: (7, False), 401),
+    (f'/5?token={token(expires_in=-10)}', lambda document_id: (1, False), 401),
+    (f'/5?token={token(token_type="refresh")}', lambda document_id: (1, False), 401),
+    (f'/5?token={token("2")}', lambda document_id: (7, False), 403),
+    (f'/5?token={token("1")}', lambda document_id: (1, True), 403),
+    (f'/5?token={token("1")}', lambda document_id: (None, None), 403),
+    (f'/not-a-document?token={token("1")}', lambda document_id: (1, False), 403),
+])
+def test_handshake_rejects_unauthorized_requests(secret, monkeypatch, path, lookup, expected):
+    monkeypatch.setattr(collab_auth, 'DEFAULT_PERMISSION', 'none')
+    status, accepted = handshake(path, lookup, monkeypatch)
+    assert status == expected
+    assert accepted == []
+
+
+def test_viewer_updates_are_dropped_by_yjs_server(monkeypatch):
+    class Peer:
+        permission = 'viewer'
+
+    server = yjs_server.YjsWebSocketServer.__new__(yjs_server.YjsWebSocketServer)
+    applied = []
+    monkeypatch.setattr(server, 'apply_update', lambda *args, **kwargs: applied.append(args))
+    doc = pycrdt.Doc()
+    doc['t'] = text = pycrdt.Text()
+    text += 'x'
+    message = yjs_utils.encode_sync_update(doc.get_update())
+    asyncio.run(server.handle_message(Peer(), 'doc', message))
+    assert applied == []
+    assert yjs_server.is_write_message(message)
+
+
+@pytest.fixture
+def collab_app(monkeypatch):
+    monkeypatch.setattr(collab_auth, 'AUTH_REQUIRED', True)
+    monkeypatch.setattr(collab_auth, 'DEFAULT_PERMISSION', 'viewer')
+    monkeypatch.setattr(snapshotter, 'mark_dirty', lambda *args, **kwargs: None)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SECRET_KEY'] = 'test'
+    app.config['JWT_SECRET_KEY'] = SECRET
+    JWTManager(app)
+    db.init_app(app)
+    socketio = SocketIO(app, async_mode='threading')
+    collab_views.init_socketio_events(socketio)
+    with app.app_context():
+        db.create_all()
+        db.session.add(Documents(id=81, title='t', content='', user_id=1))
+        db.session.add(Documents(id=82, title='t', content='', user_id=1, is_deleted=True))
+        db.session.commit()
+    yield app, socketio
+    for document_id in (81, 82):
+        document_states.pop(document_id, None)
+        collab_state.room_users.pop(f'doc_{document_id}', None)
+
+
+def flask_token(app, identity, refresh=False):
+    with app.app_context():
+        return (create_refresh_token if refresh else create_access_token)(identity=identity)
+
+
+def test_socketio_connect_requires_valid_access_token(collab_app):
+    app, socketio = collab_app
+    assert not socketio.test_client(app).is_connected()
+    assert not socketio.test_client(app, auth={'token': 'garbage'}).is_connected()
+    assert not socketio.test_client(app, auth={'token': flask_token(app, '1', refresh=True)}).is_connected()
+    # 握手时指定了无权访问的文档
+    assert not socketio.test_client(app, auth={'token': flask_token(app, '1'), 'document_id': 82}).is_connected()
+
+    client = socketio.test_client(app, auth={'token': flask_token(app, '1'), 'document_id': 81})
+    assert client.is_connected()
+    client.disconnect()
+
+
+def test_viewer_operations_are_dropped_on_both_wire_formats(collab_app):
+    app, socketio = collab_app
+    owner = socketio.test_client(app, auth={'token': flask_token(app, '1')})
+    viewer = socketio.test_client(app, auth={'token': flask_token(app, '2')})
+    try:
+        for client in (owner, viewer):
+            client.emit('join_document', {'document_id': 81})
+            client.get_received()
+
+        viewer.emit('document_operation', {'document_id': 81, 'operation': [1, 2, 3]})
+        viewer.emit('document_operation_bin', wire.pack_operation(81, 0, 0, b'\x01\x02\x03'))
+        errors = [event['args'][0]['message'] for event in viewer.get_received() if event['name'] == 'error']
+        assert errors == ['无权编辑该文档', '无权编辑该文档']
+        assert document_states[81]['operations'] == []
+        assert not any(event['name'].startswith('document_operation') for event in owner.get_received())
+
+        owner.emit('document_operation', {'document_id': 81, 'operation': [1, 2, 3]})
+        assert len(document_states[81]['operations']) == 1
+    finally:
+        owner.disconnect()
+        viewer.disconnect()
@@ -0,0 +1,109 @@
+import pytest
+from flask import Flask
+from flask_socketio import SocketIO
+
+import collab_auth
+from app.collaboration import collaboration
+from app.collaboration import state as collab_state
+from app.collaboration import views as collab_views
+from app.collaboration.metrics import CollaborationMetrics
+from app.collaboration.state import document_states
+
+
+def sample(text, name):
+    """指标文本中名称（含标签）为 name 的样本值"""
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split(' ')[-1])
+    raise AssertionError(f'{name} 不在指标中')
+
+
+def test_operations_and_joins_are_rendered_globally_and_per_room():
+    metrics = CollaborationMetrics()
+    metrics.record_operation('doc_1', 100, 2, 0.002)
+    metrics.record_operation('doc_1', 5000, 3, 0.02)
+    metrics.record_operation('doc_2', 10, 0, 0.0001)
+    metrics.record_join('doc_1', 0.003)
+    text = metrics.render()
+
+    assert sample(text, 'collab_operations_total') == 3
+    assert sample(text, 'collab_room_operations_total{room="doc_1"}') == 2
+    assert sample(text, 'collab_room_operations_total{room="doc_2"}') == 1
+    assert '# TYPE collab_payload_bytes histogram' in text
+    assert sample(text, 'collab_payload_bytes_bucket{le="256"}') == 2
+    assert sample(text, 'collab_payload_bytes_bucket{le="+Inf"}') == 3
+    assert sample(text, 'collab_payload_bytes_sum') == 5110
+    assert sample(text, 'collab_room_payload_bytes_bucket{room="doc_1",le="4096"}') == 1
+    assert sample(text, 'collab_room_payload_bytes_count{room="doc_1"}') == 2
+    assert sample(text, 'collab_fanout_size_bucket{le="2"}') == 2
+    assert sample(text, 'collab_room_fanout_size_sum{room="doc_1"}') == 5
+    assert sample(text, 'collab_emit_seconds_bucket{le="0.0025"}') == 2
+    assert sample(text, 'collab_join_seconds_count') == 1
+    assert sample(text, 'collab_room_join_seconds_count{room="doc_1"}') == 1
+    assert 'collab_room_join_seconds_count{room="doc_2"}' not in text
+
+
+def test_socket_counters_forget_room_and_extra():
+    metrics = CollaborationMetrics()
+    metrics.socket_connected()
+    metrics.socket_connected()
+    metrics.socket_disconnected()
+    metrics.socket_rejected()
+    metrics.record_operation('doc_9', 1, 1, 0.001)
+    metrics.forget_room('doc_9')
+    for _ in range(3):
+        metrics.socket_disconnected()
+    text = metrics.render({'collab_rooms': ('房间数', 'gauge', 4)})
+
+    assert sample(text, 'collab_connected_sockets') == 0
+    assert sample(text, 'collab_rejected_sockets_total') == 1
+    assert sample(text, 'collab_operations_total') == 1
+    assert 'room="doc_9"' not in text
+    assert '# TYPE collab_rooms gauge' in text and sample(text, 'collab_rooms') == 4
+
+
+@pytest.fixture
+def collab_app(monkeypatch):
+    monkeypatch.setattr(collab_auth, 'AUTH_REQUIRED', False)
+    monkeypatch.setattr(collab_views, 'metrics', CollaborationMetrics())
+    monkeypatch.setattr(collab_views.snapshotter, 'load', lambda document_id: None)
+    monkeypatch.setattr(collab_views.snapshotter, 'mark_dirty', lambda *args, **kwargs: None)
+    monkeypatch.setattr(collab_views.snapshotter, 'request_flush', lambda document_id: None)
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    app.register_blueprint(collaboration, url_prefix='/collaboration')
+    socketio = SocketIO(app, async_mode='threading')
+    collab_views.init_socketio_events(socketio)
+    yield app, socketio
+    document_states.pop('metrics-doc', None)
+    collab_state.room_users.pop('doc_metrics-doc', None)
+
+
+def test_metrics_and_stats_endpoints(collab_app):
+    app, socketio = collab_app
+    first = socketio.test_client(app)
+    second = socketio.test_client(app)
+    try:
+        for client in (first, second):
+            client.emit('join_document', {'document_id': 'metrics-doc'})
+        first.emit('document_operation', {'document_id': 'metrics-doc', 'operation': [1, 2, 3]})
+
+        response = app.test_client().get('/collaboration/metrics')
+        assert response.content_type.startswith('text/plain; version=0.0.4')
+        text = response.get_data(as_text=True)
+        assert sample(text, 'collab_connected_sockets') == 2
+        assert sample(text, 'collab_operations_total') == 1
+        assert sample(text, 'collab_room_operations_total{room="doc_metrics-doc"}') == 1
+        assert sample(text, 'collab_room_fanout_size_sum{room="doc_metrics-doc"}') == 1
+        assert sample(text, 'collab_room_payload_bytes_sum{room="doc_metrics-doc"}') == 3
+        assert sample(text, 'collab_join_seconds_count') == 2
+        assert sample(text, 'collab_participants') >= 2
+        assert '# TYPE collab_backpressure_dropped_total counter' in text
+
+        stats = app.test_client().get('/collaboration/stats').get_json()
+        assert stats['code'] == '200'
+        assert stats['stats']['participants'] == sample(text, 'collab_participants')
+        assert stats['stats']['documents'] >= 1
+    finally:
+        first.disconnect()
+        second.disconnect()
@@ -0,0 +1,102 @@
+import pycrdt
+import pytest
+from flask import Flask
+from flask_socketio import SocketIO
+
+import collab_auth
+from database import db
+from app.document.models import Documents
+from app.collaboration import state as collab_state
+from app.collaboration import views as collab_views
+from app.collaboration.snapshots import snapshotter
+from app.collaboration.state import document_states, new_document_state, append_operation, compact, needs_reset
+
+
+def yjs_updates(count):
+    doc = pycrdt.Doc()
+    doc['t'] = text = pycrdt.Text()
+    updates = []
+    for index in range(count):
+        before = doc.get_state()
+        text += str(index)
+        updates.append(doc.get_update(before))
+    return updates
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(collab_state, 'OPLOG_MAX_OPERATIONS', 10)
+    monkeypatch.setattr(collab_state, 'OPLOG_RETAIN_OPERATIONS', 4)
+    monkeypatch.setattr(collab_state, 'OPLOG_MAX_UNCOMPACTED', 20)
+
+
+def test_yjs_log_is_compacted(limits):
+    state = new_document_state()
+    for update in yjs_updates(11):
+        append_operation(state, update)
+    assert state['compactable'] and len(state['operations']) == 4 and state['snapshot']
+    assert state['base_version'] == 7
+    assert not compact(state)
+
+
+def test_unconvertible_log_is_marked_once(limits, monkeypatch):
+    state = new_document_state()
+    append_operation(state, {'type': 'insert'})
+    for update in yjs_updates(10):
+        append_operation(state, update)
+    assert not state['compactable']
+
+    calls = []
+    monkeypatch.setattr(collab_state.wire, 'operation_to_bytes', lambda op: calls.append(op))
+    for index in range(5):
+        append_operation(state, {'type': 'insert', 'index': index})
+    assert calls == []
+    assert len(state['operations']) == 16
+
+
+def test_unconvertible_log_needs_reset_beyond_cap(limits):
+    state = new_document_state()
+    for index in range(20):
+        append_operation(state, {'index': index})
+    assert not needs_reset(state)
+    append_operation(state, {'index': 20})
+    assert needs_reset(state)
+
+    assert collab_state.reset(state, '<p>saved</p>') == 22
+    assert state['operations'] == [] and state['base_version'] == 22 and state['compactable']
+    assert collab_state.operations_since(state, 21) is None
+
+
+def test_room_resyncs_from_saved_content(limits, monkeypatch):
+    monkeypatch.setattr(collab_auth, 'AUTH_REQUIRED', False)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SECRET_KEY'] = 'test'
+    db.init_app(app)
+    socketio = SocketIO(app, async_mode='threading')
+    collab_views.init_socketio_events(socketio)
+    monkeypatch.setattr(snapshotter, 'mark_dirty', lambda *args, **kwargs: None)
+    with app.app_context():
+        db.create_all()
+        db.session.add(Documents(id=77, title='t', content='<p>saved</p>', user_id=1))
+        db.session.commit()
+
+    try:
+        first = socketio.test_client(app)
+        second = socketio.test_client(app)
+        for client in (first, second):
+            client.emit('join_document', {'document_id': 77})
+            client.get_received()
+        for index in range(21):
+            first.emit('document_operation', {'document_id': 77, 'operation': {'index': index}})
+
+        state = document_states[77]
+        assert state['operations'] == [] and state['content'] == '<p>saved</p>'
+        for client in (first, second):
+            resyncs = [event for event in client.get_received() if event['name'] == 'document_state']
+            assert len(resyncs) == 1
+            assert resyncs[0]['args'][0]['resync'] is True
+            assert resyncs[0]['args'][0]['state']['version'] == state['version']
+    finally:
+        document_states.pop(77, None)
+        collab_state.room_users.pop('doc_77', None)
@@ -0,0 +1,37 @@
+import logging
+
+import pytest
+
+pytest.importorskip('simple_websocket')
+from simple_websocket import ws
+from wsproto import extensions
+
+from app.collaboration import compression
+
+
+@pytest.fixture(autouse=True)
+def restore_extension(monkeypatch):
+    monkeypatch.setattr(ws, 'PerMessageDeflate', ws.PerMessageDeflate)
+
+
+def test_installs_policy_extension():
+    stock = ws.PerMessageDeflate
+    assert compression.install_websocket_compression()
+    assert ws.PerMessageDeflate is not stock
+    assert issubclass(ws.PerMessageDeflate, extensions.PerMessageDeflate)
+
+
+def test_falls_back_when_wsproto_internals_change(monkeypatch, caplog):
+    monkeypatch.delattr(extensions.PerMessageDeflate, '_compressible_opcode')
+    stock = ws.PerMessageDeflate
+    with caplog.at_level(logging.WARNING):
+        assert not compression.install_websocket_compression()
+    assert ws.PerMessageDeflate is stock
+    assert '默认的压缩行为' in caplog.text
+
+
+def test_falls_back_when_simple_websocket_has_no_extension_hook(monkeypatch, caplog):
+    monkeypatch.delattr(ws, 'PerMessageDeflate')
+    with caplog.at_level(logging.WARNING):
+        assert not compression.install_websocket_compression()
+    assert '压缩策略未生效' in caplog.text
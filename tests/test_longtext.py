@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from ai_admission import AdmissionError
+from ai_utils import build_prompt, estimate_tokens, split_text
+from app.function.longtext import AsyncLongTextJob, LongTextJob
+from app.function.singleflight import FlightError
+
+
+class Permit:
+    def release(self):
+        pass
+
+
+def chunk_of(prompt):
+    return prompt.split('\n', 1)[1]
+
+
+def test_split_text_round_trips_within_budget():
+    text = ''.join(f'第{i}段。' + '内容' * 30 + '\n' for i in range(20))
+    chunks = split_text(text, budget=100)
+    assert ''.join(chunks) == text
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 100 for chunk in chunks)
+
+
+def test_split_text_starts_chunks_at_headings():
+    section = '# 标题{}\n' + '正文' * 20 + '\n'
+    text = ''.join(section.format(i) for i in range(3))
+    chunks = split_text(text, budget=60)
+    assert [chunk.splitlines()[0] for chunk in chunks] == ['# 标题0', '# 标题1', '# 标题2']
+
+
+def test_split_text_splits_oversized_paragraph_by_sentence():
+    text = '。'.join('句子' * 10 for _ in range(6)) + '。'
+    chunks = split_text(text, budget=30)
+    assert ''.join(chunks) == text
+    assert all(chunk.endswith('。') for chunk in chunks)
+    assert all(estimate_tokens(chunk) <= 30 for chunk in chunks)
+
+
+def test_split_text_short_text_is_one_chunk():
+    assert split_text('短文本') == ['短文本']
+    assert split_text('') == ['']
+
+
+def delayed_generate(delays, failures=()):
+    """各块按 delays 指定的秒数产出 <块>，failures 中的块出错"""
+    def generate(prompt):
+        text = chunk_of(prompt)
+        index = int(text[len('part'):]) if text.startswith('part') else None
+        if index is not None:
+            time.sleep(delays[index])
+            if index in failures:
+                raise RuntimeError(f'{text} failed')
+        yield f'<{text}>'
+    return generate
+
+
+def test_results_are_yielded_in_chunk_order():
+    chunks = [f'part{i}' for i in range(4)]
+    # 后面的块先完成
+    job = LongTextJob('X', chunks, {}, delayed_generate([0.15, 0.1, 0.05, 0]), Permit)
+    assert ''.join(job) == '<part0>\n<part1>\n<part2>\n<part3>'
+    assert not job.failed
+
+
+def test_failed_chunk_is_reported_in_place():
+    chunks = [f'part{i}' for i in range(3)]
+    job = LongTextJob('X', chunks, {}, delayed_generate([0, 0, 0], failures={1}), Permit)
+    output = ''.join(job)
+    assert output.startswith('<part0>\n（第2部分处理失败: part1 failed）<part2>')
+    assert job.failed
+
+
+def test_reduce_uses_chunk_results_in_order():
+    prompts = []
+
+    def generate(prompt):
+        prompts.append(prompt)
+        text = chunk_of(prompt)
+        if text.startswith('part'):
+            time.sleep(0.05 * (3 - int(text[4:])))
+            yield f'摘要{text[4:]}'
+        else:
+            yield '全文摘要'
+
+    job = LongTextJob('摘要', [f'part{i}' for i in range(3)], {}, generate, Permit)
+    assert ''.join(job) == '全文摘要'
+    reduce_prompt = prompts[-1]
+    assert reduce_prompt.index('摘要0') < reduce_prompt.index('摘要1') < reduce_prompt.index('摘要2')
+
+
+def test_reduce_fails_when_every_chunk_fails():
+    job = LongTextJob('摘要', ['part0', 'part1'], {}, delayed_generate([0, 0], failures={0, 1}), Permit)
+    with pytest.raises(FlightError):
+        ''.join(job)
+
+
+def test_workers_without_admission_leave_chunks_to_others():
+    def acquire():
+        raise AdmissionError('busy', 503, 1)
+
+    threads = []
+    lock = threading.Lock()
+
+    def generate(prompt):
+        with lock:
+            threads.append(threading.get_ident())
+        yield chunk_of(prompt)
+
+    job = LongTextJob('X', [f'part{i}' for i in range(4)], {}, generate, acquire)
+    assert ''.join(job) == 'part0\npart1\npart2\npart3'
+    # 只有使用请求自身准入的第一个工作线程处理了全部块
+    assert len(set(threads)) == 1
+
+
+def test_async_job_keeps_order():
+    delays = [0.15, 0.1, 0.05, 0]
+
+    async def generate(prompt):
+        text = chunk_of(prompt)
+        await asyncio.sleep(delays[int(text[4:])])
+        yield f'<{text}>'
+
+    async def acquire():
+        return Permit()
+
+    async def scenario():
+        job = AsyncLongTextJob('X', [f'part{i}' for i in range(4)], {}, generate, acquire)
+        return ''.join([piece async for piece in job])
+
+    assert asyncio.run(scenario()) == '<part0>\n<part1>\n<part2>\n<part3>'
+
+
+def test_build_prompt_for_known_and_unknown_commands():
+    assert build_prompt('翻译', '你好', {'language': '日文'}).endswith('日文，只输出译文：\n你好')
+    assert build_prompt('X', 'text', {}) == 'X：\ntext'
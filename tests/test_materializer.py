@@ -0,0 +1,60 @@
+import pytest
+from flask import Flask
+
+import yjs_utils
+from database import db
+from app.collaboration import materializer as materializer_module
+from app.collaboration.materializer import DocumentMaterializer
+from app.document import utils as document_utils
+from app.document.models import Documents, DocumentVersions
+
+pycrdt = pytest.importorskip('pycrdt')
+
+
+class FakeRedis:
+    def set(self, *args, **kwargs):
+        pass
+
+
+def paragraph_state(*nodes):
+    doc = pycrdt.Doc()
+    fragment = doc.get(yjs_utils.DEFAULT_FRAGMENT, type=pycrdt.XmlFragment)
+    for node in nodes:
+        fragment.children.append(node)
+    return doc.get_update()
+
+
+@pytest.fixture
+def materializer(monkeypatch):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(Documents(id=1, user_id=1, title='文档', content='<p>原内容</p>'))
+        db.session.commit()
+    monkeypatch.setattr(document_utils, 'redis_client', FakeRedis())
+    monkeypatch.setattr(materializer_module, 'MATERIALIZE_DEBOUNCE', 0)
+    materializer = DocumentMaterializer()
+    materializer.app = app
+    return materializer
+
+
+def stored(materializer):
+    with materializer.app.app_context():
+        return db.session.get(Documents, 1).content, DocumentVersions.query.count()
+
+
+def test_round_trippable_state_is_written_back(materializer):
+    materializer.submit(1, paragraph_state(pycrdt.XmlElement('paragraph', {}, [pycrdt.XmlText('新内容')])))
+    assert materializer.materialize() == 1
+    assert stored(materializer) == ('<p>新内容</p>', 1)
+
+
+def test_lossy_state_never_overwrites_content(materializer):
+    materializer.submit(1, paragraph_state(
+        pycrdt.XmlElement('paragraph', {}, [pycrdt.XmlText('新内容')]),
+        pycrdt.XmlElement('mention', {'id': '7'}),
+    ))
+    assert materializer.materialize() == 0
+    assert stored(materializer) == ('<p>原内容</p>', 0)
@@ -0,0 +1,23 @@
+from app.metrics import Histogram, describe, format_labels
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram((1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+    assert histogram.render('latency', {'provider': 'ocr'}) == [
+        'latency_bucket{provider="ocr",le="1"} 2',
+        'latency_bucket{provider="ocr",le="5"} 3',
+        'latency_bucket{provider="ocr",le="+Inf"} 4',
+        'latency_sum{provider="ocr"} 14.5',
+        'latency_count{provider="ocr"} 4',
+    ]
+
+
+def test_labels_are_escaped():
+    assert format_labels({}) == ''
+    assert format_labels({'room': 'a"b\\c\n'}) == '{room="a\\"b\\\\c\\n"}'
+
+
+def test_describe():
+    assert describe('x_total', 'counter', '说明') == ['# HELP x_total 说明', '# TYPE x_total counter']
@@ -0,0 +1,116 @@
+import io
+import threading
+import time
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from ai_admission import AdmissionController
+from app.function import ocr_pipeline
+from app.function.ocr_pipeline import Upload, UploadTooLarge
+from app.function.singleflight import SingleFlight
+
+
+def test_upload_stops_reading_past_limit():
+    stream = io.BytesIO(b'x' * 1000)
+    with pytest.raises(UploadTooLarge):
+        Upload(FileStorage(stream, filename='big.png'), limit=100, chunk_size=64)
+    # 超出上限后不再继续读取
+    assert stream.tell() <= 101
+
+
+def test_upload_at_limit_is_spooled():
+    upload = Upload(FileStorage(io.BytesIO(b'x' * 100), filename='ok.png'), limit=100, chunk_size=64)
+    upload.spool.seek(0)
+    assert upload.size == 100 and upload.spool.read() == b'x' * 100
+    upload.close()
+
+
+@pytest.fixture
+def ocr_app(monkeypatch):
+    from flask import Flask
+    from flask_jwt_extended import JWTManager
+
+    from app.function import function, upstream, views
+
+    admission = AdmissionController('ocr', max_concurrency=2, rate=0, max_queue=16, queue_timeout=5)
+    monkeypatch.setattr(upstream.ocr, 'admission', admission)
+    monkeypatch.setattr(views, 'flights', SingleFlight(None, shared=False))
+    monkeypatch.setattr(views, 'cached_result', lambda upload: None)
+    app = Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = 'test'
+    JWTManager(app)
+    app.register_blueprint(function, url_prefix='/function')
+    return app, admission, views
+
+
+def post_batch(app, contents):
+    files = [(io.BytesIO(content), f'page{index}.png') for index, content in enumerate(contents)]
+    return app.test_client().post('/function/ocr/batch', data={'files': files}, content_type='multipart/form-data')
+
+
+def test_batch_concurrency_is_bounded_by_admission(ocr_app, monkeypatch):
+    app, admission, views = ocr_app
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def recognize(upload):
+        with lock:
+            running.append(upload)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(upload)
+        upload.spool.seek(0)
+        return upload.spool.read().decode()
+
+    monkeypatch.setattr(views, 'recognize', recognize)
+    response = post_batch(app, [f'page{index}'.encode() for index in range(6)])
+    assert [result['message'] for result in response.get_json()['message']] == [f'page{index}' for index in range(6)]
+    assert max(peak) == 2
+    assert admission.active == 0 and admission.admitted == 6
+
+
+def test_batch_pages_report_admission_rejection(ocr_app, monkeypatch):
+    app, admission, views = ocr_app
+    admission.max_concurrency = 1
+    admission.queue_timeout = 0.05
+    monkeypatch.setattr(views, 'recognize', lambda upload: 'text')
+    held = admission.acquire()
+    try:
+        response = post_batch(app, [b'a', b'b', b'c'])
+    finally:
+        held.release()
+    results = response.get_json()['message']
+    assert [result['code'] for result in results] == [503, 503, 503]
+    # 第一页排队超时后其余页不再逐页等待
+    assert admission.timeouts == 1
+    assert admission.active == 0
+
+
+def test_batch_rejects_oversized_totals(ocr_app, monkeypatch):
+    app, admission, views = ocr_app
+    monkeypatch.setattr(views, 'OCR_MAX_FILE_BYTES', 100)
+    monkeypatch.setattr(views, 'OCR_BATCH_MAX_BYTES', 250)
+    monkeypatch.setattr(views, 'recognize', lambda upload: 'text')
+
+    response = post_batch(app, [b'x' * 101])
+    assert response.status_code == 413 and 'page0.png' in response.get_json()['message']
+
+    response = post_batch(app, [b'x' * 100, b'x' * 100, b'x' * 100])
+    assert response.status_code == 413 and '合计' in response.get_json()['message']
+
+    assert post_batch(app, [b'x' * 100, b'x' * 100]).status_code == 200
+    assert admission.admitted == 2
+
+
+def test_content_length_is_checked_before_parsing(ocr_app, monkeypatch):
+    app, admission, views = ocr_app
+    monkeypatch.setattr(views, 'OCR_BATCH_MAX_BYTES', 100)
+    parsed = []
+    monkeypatch.setattr(views, 'Upload', lambda *args: parsed.append(args))
+
+    response = post_batch(app, [b'x' * (ocr_pipeline.OCR_FORM_OVERHEAD + 200)])
+    assert response.status_code == 413
+    assert parsed == []
@@ -0,0 +1,143 @@
+import pytest
+from flask import Flask
+from flask_socketio import SocketIO
+
+import collab_auth
+from app.collaboration import state as collab_state
+from app.collaboration import views as collab_views
+from app.collaboration.presence import PRESENCE_BATCH, PRESENCE_LEGACY, PresenceBroadcaster, presence
+from app.collaboration.state import room_users
+
+
+class FakeSocketIO:
+    """记录 emit 调用，不启动后台任务"""
+
+    def __init__(self):
+        self.emitted = []
+
+    def start_background_task(self, target):
+        return object()
+
+    def emit(self, event, data, room=None, skip_sid=None):
+        self.emitted.append((event, data, room, skip_sid))
+
+
+@pytest.fixture
+def broadcaster():
+    broadcaster = PresenceBroadcaster(tick_ms=40)
+    broadcaster.init_app(FakeSocketIO())
+    yield broadcaster
+    for room in ('doc_1', 'doc_2'):
+        room_users.pop(room, None)
+
+
+def join(broadcaster, room, sid, mode=PRESENCE_BATCH):
+    room_users.setdefault(room, set()).add(sid)
+    return broadcaster.negotiate(sid, mode)
+
+
+def test_negotiation_is_opt_in():
+    broadcaster = PresenceBroadcaster(tick_ms=40)
+    assert broadcaster.negotiate('a', None) == PRESENCE_LEGACY
+    assert broadcaster.negotiate('a', PRESENCE_BATCH) == PRESENCE_BATCH
+    assert broadcaster.negotiate('a', 'other') == PRESENCE_LEGACY
+    broadcaster.negotiate('a', PRESENCE_BATCH)
+    broadcaster.forget('a')
+    assert broadcaster.batch_sids == set()
+    # 关闭合并时只能逐条接收
+    assert PresenceBroadcaster(tick_ms=0).negotiate('a', PRESENCE_BATCH) == PRESENCE_LEGACY
+
+
+def test_keeps_only_latest_state_per_participant(broadcaster):
+    for sid in ('a', 'b', 'c'):
+        join(broadcaster, 'doc_1', sid)
+    for position in range(10):
+        broadcaster.submit('doc_1', 1, 'a', 'cursor', {'position': position})
+    broadcaster.submit('doc_1', 1, 'a', 'awareness', {'name': 'A'})
+    broadcaster.submit('doc_1', 1, 'b', 'cursor', {'position': 3})
+    broadcaster.flush()
+
+    assert broadcaster.received == 12
+    frames = {room: (data, skip) for _, data, room, skip in broadcaster.socketio.emitted}
+    # 没有发送状态的参与者收到完整的帧
+    data, skip = frames['doc_1']
+    assert sorted(skip) == ['a', 'b']
+    assert data['document_id'] == 1
+    assert sorted(data['cursors'], key=lambda c: c['user_id']) == [
+        {'position': 9, 'user_id': 'a'}, {'position': 3, 'user_id': 'b'}]
+    assert data['awareness'] == [{'user_id': 'a', 'awareness': {'name': 'A'}}]
+    # 发送者收到的帧中没有自己的状态
+    assert frames['a'][0]['cursors'] == [{'position': 3, 'user_id': 'b'}] and frames['a'][0]['awareness'] == []
+    assert frames['b'][0]['cursors'] == [{'position': 9, 'user_id': 'a'}]
+
+
+def test_legacy_members_are_skipped_and_lone_sender_gets_nothing(broadcaster):
+    join(broadcaster, 'doc_1', 'a')
+    join(broadcaster, 'doc_1', 'old', mode=None)
+    broadcaster.submit('doc_1', 1, 'a', 'cursor', {'position': 1})
+    broadcaster.flush()
+    assert broadcaster.socketio.emitted == []
+
+
+def test_one_frame_per_room_and_nothing_after_flush(broadcaster):
+    for room, sid in (('doc_1', 'x'), ('doc_2', 'y')):
+        join(broadcaster, room, sid)
+    broadcaster.submit('doc_1', 1, 'a', 'cursor', {'position': 1})
+    broadcaster.submit('doc_2', 2, 'b', 'cursor', {'position': 2})
+    broadcaster.flush()
+    assert sorted(room for _, _, room, _ in broadcaster.socketio.emitted) == ['doc_1', 'doc_2']
+
+    broadcaster.flush()
+    assert broadcaster.emitted == 2
+
+
+def test_discard_drops_pending_state(broadcaster):
+    join(broadcaster, 'doc_1', 'x')
+    broadcaster.submit('doc_1', 1, 'a', 'cursor', {'position': 1})
+    broadcaster.submit('doc_1', 1, 'b', 'cursor', {'position': 2})
+    broadcaster.discard('doc_1', 'a')
+    broadcaster.flush()
+    _, data, _, _ = broadcaster.socketio.emitted[0]
+    assert data['cursors'] == [{'position': 2, 'user_id': 'b'}]
+
+    broadcaster.submit('doc_1', 1, 'a', 'cursor', {'position': 1})
+    broadcaster.discard_room('doc_1')
+    broadcaster.flush()
+    assert broadcaster.emitted == 1
+
+
+def test_legacy_and_batch_clients_see_each_other(monkeypatch):
+    monkeypatch.setattr(collab_auth, 'AUTH_REQUIRED', False)
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    socketio = SocketIO(app, async_mode='threading')
+    collab_views.init_socketio_events(socketio)
+    monkeypatch.setattr(presence, 'interval', 0.04)
+    monkeypatch.setattr(collab_views.snapshotter, 'load', lambda document_id: None)
+    monkeypatch.setattr(collab_views.snapshotter, 'request_flush', lambda document_id: None)
+
+    legacy = socketio.test_client(app)
+    batched = socketio.test_client(app, auth={'presence': PRESENCE_BATCH})
+    try:
+        connected = [event for event in batched.get_received() if event['name'] == 'connected']
+        assert connected[0]['args'][0]['presence'] == PRESENCE_BATCH
+        for client in (legacy, batched):
+            client.emit('join_document', {'document_id': 'presence-doc'})
+        legacy.get_received()
+        batched.get_received()
+
+        legacy.emit('cursor_position', {'document_id': 'presence-doc', 'position': 1})
+        batched.emit('cursor_position', {'document_id': 'presence-doc', 'position': 2})
+        presence.flush()
+
+        legacy_events = legacy.get_received()
+        assert [event['name'] for event in legacy_events] == ['cursor_position']
+        assert legacy_events[0]['args'][0]['position'] == 2
+        batch_events = batched.get_received()
+        assert [event['name'] for event in batch_events] == ['presence_batch']
+        assert [cursor['position'] for cursor in batch_events[0]['args'][0]['cursors']] == [1]
+    finally:
+        legacy.disconnect()
+        batched.disconnect()
+        collab_state.document_states.pop('presence-doc', None)
+        room_users.pop('doc_presence-doc', None)
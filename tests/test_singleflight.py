@@ -0,0 +1,128 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.function.singleflight import FlightError, SingleFlight
+
+
+class Permit:
+    def __init__(self):
+        self.released = 0
+
+    def release(self):
+        self.released += 1
+
+
+def blocking_source(started, finish):
+    """produce()：产出一块后等待 finish"""
+    def produce():
+        started.set()
+        yield 'a'
+        finish.wait(5)
+        yield 'b'
+    return produce
+
+
+def test_coalesced_requests_read_the_same_generation():
+    flights = SingleFlight(None, shared=False)
+    started, finish = threading.Event(), threading.Event()
+    calls = []
+
+    def produce():
+        calls.append(1)
+        yield from blocking_source(started, finish)()
+
+    first = flights.stream('k', produce)
+    started.wait(5)
+    second = flights.stream('k', produce)
+    finish.set()
+    assert list(first) == ['a', 'b'] and list(second) == ['a', 'b']
+    assert calls == [1] and flights.coalesced == 1
+
+
+def test_closing_before_first_next_releases_subscriber():
+    flights = SingleFlight(None, shared=False)
+    started, finish = threading.Event(), threading.Event()
+    subscription = flights.stream('k', blocking_source(started, finish))
+    started.wait(5)
+    flight = flights._flights['k']
+    # werkzeug 在客户端断开时直接调用 close()，可能从未迭代过
+    subscription.close()
+    subscription.close()
+    assert flight.subscribers == 0 and flight.cancelled
+    assert 'k' not in flights._flights
+    finish.set()
+
+
+def test_permit_released_when_closed_before_iteration():
+    permit = Permit()
+    for flights in (SingleFlight(None, enabled=False), SingleFlight(None, shared=False)):
+        started, finish = threading.Event(), threading.Event()
+        finish.set()
+        subscription = flights.stream(None, blocking_source(started, finish), lambda: permit)
+        subscription.close()
+    assert permit.released == 2
+
+
+def test_flight_error_becomes_text_when_requested():
+    flights = SingleFlight(None, shared=False)
+
+    def produce():
+        yield 'partial'
+        raise RuntimeError('upstream down')
+
+    assert list(flights.stream('k', produce, error_text=lambda e: f'error: {e}')) == ['partial', 'error: upstream down']
+    with pytest.raises(FlightError):
+        list(flights.stream('k2', produce))
+
+
+def test_async_subscription_cancels_generation_when_closed_early():
+    flights = SingleFlight(None, shared=False)
+    permit = Permit()
+    closed = []
+
+    async def produce():
+        try:
+            yield 'a'
+            await asyncio.sleep(10)
+            yield 'b'
+        finally:
+            closed.append(True)
+
+    async def admit():
+        return permit
+
+    async def scenario():
+        subscription = await flights.stream_async('k', produce, admit)
+        flight = flights._flights['k']
+        await asyncio.sleep(0.05)
+        await subscription.aclose()
+        await asyncio.sleep(0.05)
+        return flight
+
+    flight = asyncio.run(scenario())
+    assert flight.subscribers == 0 and flight.done and flight.error == '生成已取消'
+    assert closed == [True] and permit.released == 1
+
+
+def test_chatglm_stream_reports_upstream_failure_in_band(monkeypatch):
+    from flask import Flask
+    from flask_jwt_extended import JWTManager
+
+    from app.function import function, upstream, views
+
+    def failing_post(*args, **kwargs):
+        raise ConnectionError('chatglm unreachable')
+
+    monkeypatch.setattr(views, 'CHATGLM_API_KEY', 'test')
+    monkeypatch.setattr(upstream.chatglm, 'post', failing_post)
+    app = Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = 'test'
+    JWTManager(app)
+    app.register_blueprint(function, url_prefix='/function')
+
+    response = app.test_client().post('/function/chatglm/stream', json={'messages': [{'role': 'user', 'content': 'hi'}]})
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == '处理请求时发生错误: chatglm unreachable'
+    assert upstream.chatglm.admission.active == 0
@@ -0,0 +1,87 @@
+import pytest
+from flask import Flask
+
+from database import db
+from app.collaboration import snapshots
+from app.collaboration.snapshots import build_snapshot, dump_operations, load_operations, snapshotter
+from app.collaboration.state import document_states, new_document_state, append_operation, operations_since
+
+pycrdt = pytest.importorskip('pycrdt')
+
+
+def yjs_update(text):
+    doc = pycrdt.Doc()
+    doc['t'] = pycrdt.Text()
+    doc['t'] += text
+    return doc.get_update()
+
+
+@pytest.fixture
+def app(monkeypatch):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    submitted = []
+    monkeypatch.setattr(snapshots.materializer, 'submit', lambda document_id, state: submitted.append(document_id))
+    monkeypatch.setattr(snapshotter, 'app', app)
+    app.submitted = submitted
+    yield app
+    snapshotter.forget(9001)
+    document_states.pop(9001, None)
+
+
+def test_operations_serialization_round_trip():
+    operations = [b'\x00\x01', {'type': 'insert', 'text': '中文'}, [1, 2], 'AAE=']
+    assert load_operations(dump_operations(operations)) == operations
+    assert load_operations(None) == []
+
+
+def test_build_snapshot_merges_yjs_updates():
+    state = new_document_state('<p>old</p>')
+    append_operation(state, yjs_update('hello'))
+    version, _, merged, operations = build_snapshot(state)
+    assert version == 1
+    assert operations is None
+    assert merged
+
+
+def test_build_snapshot_keeps_unconvertible_operations():
+    state = new_document_state('<p>old</p>')
+    append_operation(state, yjs_update('hello'))
+    append_operation(state, {'type': 'insert'})
+    version, content, merged, operations = build_snapshot(state)
+    assert (version, content, merged) == (2, '<p>old</p>', None)
+    assert len(operations) == 2
+
+
+def test_json_operation_log_survives_eviction(app):
+    state = document_states[9001] = new_document_state('<p>base</p>')
+    for index in range(3):
+        append_operation(state, {'type': 'insert', 'index': index})
+    assert snapshotter.flush([9001]) == 1
+    assert snapshotter.is_persisted(9001, state)
+    assert app.submitted == []
+
+    # 模拟淘汰后重新加入
+    document_states.pop(9001)
+    with app.app_context():
+        restored = snapshotter.load(9001)
+    assert restored['version'] == 3
+    assert operations_since(restored, 1) == [{'type': 'insert', 'index': 1}, {'type': 'insert', 'index': 2}]
+    assert operations_since(restored, 0) == state['operations']
+
+
+def test_yjs_state_is_materialized_and_restored(app):
+    state = document_states[9001] = new_document_state()
+    append_operation(state, yjs_update('hello'))
+    snapshotter.flush([9001])
+    assert app.submitted == [9001]
+
+    with app.app_context():
+        restored = snapshotter.load(9001)
+    assert restored['version'] == 1 and restored['operations'] == []
+    doc = pycrdt.Doc()
+    doc.apply_update(restored['snapshot'])
+    assert str(doc.get('t', type=pycrdt.Text)) == 'hello'
@@ -0,0 +1,73 @@
+import base64
+
+import pytest
+
+from app.collaboration import wire
+
+
+def test_pack_unpack_round_trip():
+    frame = wire.pack_operation(42, 7, 3, b'\x01\x02\x03')
+    assert len(frame) == wire.FRAME_HEADER.size + 3
+    assert wire.unpack_operation(frame) == (42, 7, 3, b'\x01\x02\x03')
+    assert wire.unpack_operation(bytearray(frame)) == (42, 7, 3, b'\x01\x02\x03')
+
+
+def test_pack_wraps_version_and_sender_index():
+    frame = wire.pack_operation(1, 2 ** 32 + 5, 2 ** 16 + 1, b'')
+    assert wire.unpack_operation(frame) == (1, 5, 1, b'')
+
+
+def test_unpack_rejects_short_frame():
+    with pytest.raises(ValueError):
+        wire.unpack_operation(b'\x00' * (wire.FRAME_HEADER.size - 1))
+
+
+def test_supports_binary_only_for_uint32_ids():
+    assert wire.supports_binary(0)
+    assert wire.supports_binary(wire.MAX_DOCUMENT_ID)
+    assert not wire.supports_binary(wire.MAX_DOCUMENT_ID + 1)
+    assert not wire.supports_binary(-1)
+    assert not wire.supports_binary('12')
+
+
+@pytest.mark.parametrize('operation', [
+    b'\x01\x02\xff',
+    bytearray(b'\x01\x02\xff'),
+    [1, 2, 255],
+    {'0': 1, '1': 2, '2': 255},
+    base64.b64encode(b'\x01\x02\xff').decode('ascii'),
+])
+def test_operation_to_bytes_accepts_json_encodings(operation):
+    assert wire.operation_to_bytes(operation) == b'\x01\x02\xff'
+
+
+@pytest.mark.parametrize('operation', [
+    [1, 256], ['a'], {'0': 1, '2': 2}, {'type': 'insert'}, {}, 'not base64!', 12, None,
+])
+def test_operation_to_bytes_rejects_other_values(operation):
+    assert wire.operation_to_bytes(operation) is None
+
+
+def test_bytes_to_operation_round_trip():
+    assert wire.operation_to_bytes(wire.bytes_to_operation(b'\x00\x10')) == b'\x00\x10'
+
+
+def test_negotiate_and_forget():
+    assert wire.negotiate('sid-1', wire.WIRE_BINARY) == wire.WIRE_BINARY
+    assert wire.wire_format('sid-1') == wire.WIRE_BINARY
+    assert wire.negotiate('sid-1', None) == wire.WIRE_JSON
+    assert wire.wire_format('sid-1') == wire.WIRE_JSON
+    wire.negotiate('sid-1', wire.WIRE_BINARY)
+    wire.forget('sid-1')
+    assert wire.wire_format('sid-1') == wire.WIRE_JSON
+
+
+def test_assign_index_reuses_smallest_free_slot():
+    room = 'test_wire_room'
+    assert [wire.assign_index(room, sid) for sid in ('a', 'b', 'c')] == [0, 1, 2]
+    assert wire.assign_index(room, 'b') == 1
+    wire.release_index(room, 'b')
+    assert wire.assign_index(room, 'd') == 1
+    for sid in ('a', 'c', 'd'):
+        wire.release_index(room, sid)
+    assert room not in wire.participant_indexes
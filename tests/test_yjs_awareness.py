@@ -0,0 +1,119 @@
+import pytest
+
+import yjs_server
+import yjs_utils
+from yjs_server import YjsWebSocketServer
+
+DOCUMENT = 'awareness-doc'
+
+
+class Peer:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def enqueue(self, message):
+        self.sent.append(message)
+        return True
+
+    def received(self):
+        """收到的感知消息中的 [(clientID, clock, 状态)]"""
+        entries = []
+        for message in self.sent:
+            message_type, _, payload = yjs_utils.decode_message(message)
+            assert message_type == yjs_utils.MESSAGE_AWARENESS
+            entries.extend(yjs_utils.decode_awareness_update(payload))
+        return entries
+
+
+@pytest.fixture
+def server():
+    server = YjsWebSocketServer(store=object(), authenticate=False)
+    yield server
+    yjs_server.awareness.pop(DOCUMENT, None)
+    yjs_server.connections.pop(DOCUMENT, None)
+
+
+def connect(server, count):
+    websockets = [object() for _ in range(count)]
+    for websocket in websockets:
+        server.peers[websocket] = Peer()
+        yjs_server.connections.setdefault(DOCUMENT, set()).add(websocket)
+    return websockets
+
+
+def update(server, websocket, *entries):
+    _, _, payload = yjs_utils.decode_message(yjs_utils.encode_awareness_message(list(entries)))
+    server.apply_awareness(websocket, DOCUMENT, payload)
+
+
+def states(server):
+    return {client_id: (entry['clock'], entry['state']) for client_id, entry in yjs_server.awareness[DOCUMENT].items()}
+
+
+def test_stale_clock_updates_are_ignored(server):
+    a, = connect(server, 1)
+    update(server, a, (1, 5, '{"cursor":5}'))
+    update(server, a, (1, 4, '{"cursor":4}'))
+    update(server, a, (1, 5, '{"cursor":"again"}'))
+    assert states(server) == {1: (5, '{"cursor":5}')}
+    update(server, a, (1, 6, '{"cursor":6}'))
+    assert states(server) == {1: (6, '{"cursor":6}')}
+    assert server.awareness_pending[DOCUMENT][1][:2] == (6, '{"cursor":6}')
+
+
+def test_null_state_removes_client(server):
+    a, b = connect(server, 2)
+    update(server, a, (1, 3, '{"name":"A"}'))
+    update(server, b, (2, 1, '{"name":"B"}'))
+    server.flush_awareness()
+    # 同一 clock 的 null 表示客户端离开
+    update(server, a, (1, 3, 'null'))
+    assert states(server) == {2: (1, '{"name":"B"}')}
+    server.flush_awareness()
+    assert server.peers[b].received()[-1] == (1, 3, 'null')
+
+
+def test_expired_state_is_removed_with_next_clock(server, monkeypatch):
+    monkeypatch.setattr(yjs_server, 'YJS_AWARENESS_TIMEOUT', 30)
+    a, b = connect(server, 2)
+    update(server, a, (1, 7, '{"name":"A"}'))
+    update(server, b, (2, 1, '{"name":"B"}'))
+    server.flush_awareness()
+    yjs_server.awareness[DOCUMENT][1]['updated'] -= 31
+
+    server.expire_awareness()
+    assert states(server) == {2: (1, '{"name":"B"}')}
+    server.flush_awareness()
+    # 客户端只接受更大的 clock，移除消息使用 clock + 1
+    assert server.peers[a].received()[-1] == (1, 8, 'null')
+    assert server.peers[b].received()[-1] == (1, 8, 'null')
+
+
+def test_peer_does_not_receive_its_own_state(server):
+    a, b, c = connect(server, 3)
+    update(server, a, (1, 1, '{"name":"A"}'))
+    server.flush_awareness()
+    assert server.peers[a].sent == []
+    assert server.peers[b].received() == [(1, 1, '{"name":"A"}')]
+
+    # 同一周期内多个连接上报时各自只收到其他连接的状态
+    for peer in server.peers.values():
+        peer.sent.clear()
+    update(server, a, (1, 2, '{"name":"A2"}'))
+    update(server, b, (2, 1, '{"name":"B"}'))
+    server.flush_awareness()
+    assert server.peers[a].received() == [(2, 1, '{"name":"B"}')]
+    assert server.peers[b].received() == [(1, 2, '{"name":"A2"}')]
+    assert sorted(server.peers[c].received()) == [(1, 2, '{"name":"A2"}'), (2, 1, '{"name":"B"}')]
+
+
+def test_lagging_peer_is_skipped(server):
+    a, b = connect(server, 2)
+    server.lagging[b] = 0
+    update(server, a, (1, 1, '{"name":"A"}'))
+    server.flush_awareness()
+    assert server.peers[b].sent == []
+    # 追上后新连接的握手或查询返回完整状态
+    assert yjs_utils.decode_awareness_update(yjs_utils.decode_message(server.encode_awareness(DOCUMENT))[2]) == [
+        (1, 1, '{"name":"A"}')]
@@ -0,0 +1,134 @@
+import asyncio
+
+import pycrdt
+import pytest
+
+import yjs_server
+import yjs_utils
+from yjs_server import YjsWebSocketServer
+
+DOCUMENT = 'coalesce-doc'
+
+
+class Store:
+    def __init__(self):
+        self.appended = []
+
+    def append(self, document_id, update):
+        self.appended.append((document_id, update))
+
+
+class Peer:
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.closed = False
+        self.sent = []
+
+    def pending_bytes(self):
+        return 0
+
+    def enqueue(self, message):
+        self.sent.append(message)
+        return True
+
+    def text(self):
+        """按收到的更新重建的文本"""
+        doc = pycrdt.Doc()
+        for message in self.sent:
+            _, _, update = yjs_utils.decode_message(message)
+            doc.apply_update(update)
+        return str(doc.get('t', type=pycrdt.Text))
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(yjs_server, 'YJS_COALESCE_WINDOW_MS', 50)
+    monkeypatch.setattr(yjs_server, 'YJS_COALESCE_MAX_BYTES', 64 * 1024)
+    server = YjsWebSocketServer(store=Store(), authenticate=False)
+    yjs_server.documents[DOCUMENT] = {'doc': pycrdt.Doc(), 'dirty': False, 'size': 0}
+    websockets = [object() for _ in range(3)]
+    for websocket in websockets:
+        server.peers[websocket] = Peer(websocket)
+    yjs_server.connections[DOCUMENT] = set(websockets)
+    server.clients = websockets
+    yield server
+    yjs_server.documents.pop(DOCUMENT, None)
+    yjs_server.connections.pop(DOCUMENT, None)
+
+
+class Writer:
+    """各自独立的Y.js客户端，产生增量更新"""
+
+    def __init__(self, client_id):
+        self.doc = pycrdt.Doc(client_id=client_id)
+        self.text = self.doc.get('t', type=pycrdt.Text)
+
+    def type(self, content):
+        before = self.doc.get_state()
+        self.text.insert(len(self.text), content)
+        return self.doc.get_update(before)
+
+
+def server_text():
+    return str(yjs_server.documents[DOCUMENT]['doc'].get('t', type=pycrdt.Text))
+
+
+def test_window_is_merged_per_origin_and_logged_once(server):
+    a, b, c = server.clients
+    alice, bob = Writer(1), Writer(2)
+
+    async def scenario():
+        for _ in range(3):
+            server.coalesce_update(a, DOCUMENT, alice.type('a'))
+        server.coalesce_update(b, DOCUMENT, bob.type('b'))
+        # 更新立即并入服务端文档，但窗口结束前不广播也不写日志
+        assert server_text().count('a') == 3
+        assert all(not peer.sent for peer in server.peers.values())
+        assert server.store.appended == []
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert DOCUMENT not in server.coalescing
+    assert len(server.store.appended) == 1
+    # 旁观者收到一条合并的更新，两个写入者各收到一条只含对方修改的更新
+    assert len(server.peers[c].sent) == 1 and sorted(server.peers[c].text()) == sorted('aaab')
+    assert server.peers[a].text() == 'b'
+    assert server.peers[b].text() == 'aaa'
+    assert yjs_server.documents[DOCUMENT]['dirty']
+
+
+def test_window_flushes_at_size_cap(server, monkeypatch):
+    a, _, c = server.clients
+    writer = Writer(1)
+    first = writer.type('x' * 40)
+    second = writer.type('y' * 40)
+    monkeypatch.setattr(yjs_server, 'YJS_COALESCE_MAX_BYTES', len(first) + len(second))
+
+    async def scenario():
+        server.coalesce_update(a, DOCUMENT, first)
+        assert not server.peers[c].sent
+        server.coalesce_update(a, DOCUMENT, second)
+        # 达到上限立即发出，不等待窗口结束
+        assert DOCUMENT not in server.coalescing
+        assert server.peers[c].text() == 'x' * 40 + 'y' * 40
+        assert len(server.store.appended) == 1
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    # 已取消的定时器不会再次发出
+    assert len(server.peers[c].sent) == 1 and len(server.store.appended) == 1
+    assert server.peers[a].sent == []
+
+
+def test_handle_message_uses_window_when_enabled(server):
+    a, _, c = server.clients
+    writer = Writer(1)
+
+    async def scenario():
+        await server.handle_message(a, DOCUMENT, yjs_utils.encode_sync_update(writer.type('hi')))
+        assert DOCUMENT in server.coalescing
+        server.flush_coalesced(DOCUMENT)
+        server.flush_coalesced(DOCUMENT)
+
+    asyncio.run(scenario())
+    assert server.peers[c].text() == 'hi' and len(server.store.appended) == 1
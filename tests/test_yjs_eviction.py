@@ -0,0 +1,161 @@
+import asyncio
+import time
+
+import pycrdt
+import pytest
+
+import yjs_server
+from yjs_server import YjsWebSocketServer
+from yjs_utils import YjsSnapshotStore
+
+
+def text_of(state):
+    doc = pycrdt.Doc()
+    doc.apply_update(state)
+    return str(doc.get('t', type=pycrdt.Text))
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = YjsWebSocketServer(store=YjsSnapshotStore(str(tmp_path)), authenticate=False)
+    yield server
+    for registry in (yjs_server.documents, yjs_server.connections, yjs_server.awareness):
+        for document_id in [key for key in registry if key.startswith('evict-')]:
+            del registry[document_id]
+
+
+async def write(server, document_id, content):
+    """加载文档并写入一段文本，返回该文本的更新"""
+    await server.load_document(document_id)
+    doc = pycrdt.Doc()
+    doc.get('t', type=pycrdt.Text).insert(0, content)
+    update = doc.get_update()
+    server.apply_update(document_id, update)
+    return update
+
+
+def test_evicted_document_reloads_identical_state(server):
+    async def scenario():
+        await write(server, 'evict-a', 'hello')
+        before = server.encode_state('evict-a')
+        assert await server.evict_document('evict-a')
+        assert 'evict-a' not in yjs_server.documents and server.evicted == 1
+        await server.load_document('evict-a')
+        after = server.encode_state('evict-a')
+        assert text_of(after) == text_of(before) == 'hello'
+        restored = pycrdt.Doc()
+        restored.apply_update(after)
+        original = pycrdt.Doc()
+        original.apply_update(before)
+        assert restored.get_state() == original.get_state()
+        assert not yjs_server.documents['evict-a']['dirty']
+
+    asyncio.run(scenario())
+
+
+def test_eviction_abandoned_when_peer_reconnects_during_flush(server, monkeypatch):
+    flush = server.flush_documents
+
+    async def flush_then_reconnect(document_ids):
+        await flush(document_ids)
+        yjs_server.connections.setdefault('evict-b', set()).add(object())
+
+    async def scenario():
+        await write(server, 'evict-b', 'kept')
+        monkeypatch.setattr(server, 'flush_documents', flush_then_reconnect)
+        assert not await server.evict_document('evict-b')
+        assert 'evict-b' in yjs_server.documents and server.evicted == 0
+
+    asyncio.run(scenario())
+
+
+def test_eviction_abandoned_when_document_is_dirty(server, monkeypatch):
+    flush = server.flush_documents
+
+    async def flush_then_update(document_ids):
+        await flush(document_ids)
+        doc = pycrdt.Doc()
+        doc.get('t', type=pycrdt.Text).insert(0, 'late')
+        server.apply_update('evict-c', doc.get_update())
+
+    async def scenario():
+        await write(server, 'evict-c', 'early')
+        monkeypatch.setattr(server, 'flush_documents', flush_then_update)
+        assert not await server.evict_document('evict-c')
+        assert yjs_server.documents['evict-c']['dirty']
+
+    asyncio.run(scenario())
+
+
+def test_failed_snapshot_keeps_document_in_memory(server, monkeypatch):
+    def failing_save(*args, **kwargs):
+        raise OSError('disk full')
+
+    async def scenario():
+        await write(server, 'evict-d', 'unsaved')
+        monkeypatch.setattr(server.store, 'save', failing_save)
+        assert not await server.evict_document('evict-d')
+        assert text_of(server.encode_state('evict-d')) == 'unsaved'
+
+    asyncio.run(scenario())
+
+
+def test_lru_eviction_under_memory_budget(server, monkeypatch):
+    monkeypatch.setattr(yjs_server, 'YJS_DOCUMENT_IDLE_SECONDS', 3600)
+
+    async def scenario():
+        for index, document_id in enumerate(['evict-old', 'evict-connected', 'evict-mid', 'evict-new']):
+            await write(server, document_id, document_id * 20)
+            await server.flush_documents([document_id])
+            yjs_server.documents[document_id]['last_used'] = time.monotonic() - 10 + index
+        yjs_server.connections['evict-connected'] = {object()}
+        sizes = {document_id: document['size'] for document_id, document in yjs_server.documents.items()
+                 if document_id.startswith('evict-')}
+        others = sum(document['size'] for document_id, document in yjs_server.documents.items()
+                     if not document_id.startswith('evict-'))
+        # 预算只够再淘汰一个文档
+        monkeypatch.setattr(yjs_server, 'YJS_MEMORY_BUDGET', others + sum(sizes.values()) - sizes['evict-old'])
+
+        assert await server.evict_idle_documents() == 1
+        assert 'evict-old' not in yjs_server.documents
+        assert {'evict-connected', 'evict-mid', 'evict-new'} <= set(yjs_server.documents)
+
+        # 有连接的文档即使最久未用也不淘汰
+        monkeypatch.setattr(yjs_server, 'YJS_MEMORY_BUDGET', 0)
+        assert await server.evict_idle_documents() == 2
+        assert 'evict-connected' in yjs_server.documents
+
+    asyncio.run(scenario())
+
+
+def test_idle_documents_are_evicted_after_timeout(server, monkeypatch):
+    monkeypatch.setattr(yjs_server, 'YJS_DOCUMENT_IDLE_SECONDS', 60)
+    monkeypatch.setattr(yjs_server, 'YJS_MEMORY_BUDGET', 1 << 30)
+
+    async def scenario():
+        await write(server, 'evict-idle', 'idle')
+        await write(server, 'evict-recent', 'recent')
+        yjs_server.documents['evict-idle']['last_used'] -= 61
+        assert await server.evict_idle_documents() == 1
+        assert 'evict-idle' not in yjs_server.documents and 'evict-recent' in yjs_server.documents
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_loads_share_one_read(server, monkeypatch):
+    calls = []
+    load = server.store.load
+
+    def slow_load(document_id):
+        calls.append(document_id)
+        return load(document_id)
+
+    async def scenario():
+        monkeypatch.setattr(server.store, 'load', slow_load)
+        await asyncio.gather(*(server.load_document('evict-e') for _ in range(5)))
+        assert calls == ['evict-e']
+        assert not server.loading
+        await server.load_document('evict-e')
+        assert calls == ['evict-e']
+
+    asyncio.run(scenario())
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+import websockets
+
+import yjs_server
+from yjs_server import PeerSender, YjsWebSocketServer
+
+DOCUMENT = 'peer-doc'
+
+
+class WebSocket:
+    """记录发出的消息；stalled 时 send 一直等待，dead 时 send 抛出连接已关闭"""
+
+    def __init__(self, stalled=False, dead=False):
+        self.sent = []
+        self.stalled = stalled
+        self.dead = dead
+        self.release = asyncio.Event()
+
+    async def send(self, message):
+        if self.dead:
+            raise websockets.exceptions.ConnectionClosedError(None, None)
+        if self.stalled:
+            await self.release.wait()
+        self.sent.append(message)
+
+
+@pytest.fixture
+def cleanup():
+    yield
+    yjs_server.connections.pop(DOCUMENT, None)
+
+
+def register(server, websocket):
+    yjs_server.connections.setdefault(DOCUMENT, set()).add(websocket)
+    server.peers[websocket] = PeerSender(websocket, DOCUMENT)
+
+
+def test_stalled_peer_does_not_delay_others(cleanup):
+    async def scenario():
+        server = YjsWebSocketServer(store=object(), authenticate=False)
+        stalled = WebSocket(stalled=True)
+        fast = [WebSocket() for _ in range(3)]
+        for websocket in [stalled] + fast:
+            register(server, websocket)
+
+        for index in range(5):
+            server.fan_out(DOCUMENT, [stalled] + fast, b'update-%d' % index)
+        await asyncio.sleep(0.01)
+        for websocket in fast:
+            assert websocket.sent == [b'update-%d' % index for index in range(5)]
+        # 慢连接的帧留在它自己的队列中
+        assert stalled.sent == []
+        assert server.peers[stalled].pending_bytes() == sum(len(b'update-%d' % index) for index in range(1, 5))
+
+        stalled.release.set()
+        await asyncio.sleep(0.01)
+        assert stalled.sent == fast[0].sent
+        assert server.peers[stalled].pending_bytes() == 0
+        for peer in server.peers.values():
+            peer.close()
+
+    asyncio.run(scenario())
+
+
+def test_dead_peer_task_is_reaped_and_queue_released(cleanup):
+    async def scenario():
+        server = YjsWebSocketServer(store=object(), authenticate=False)
+        dead = WebSocket(stalled=True)
+        alive = WebSocket()
+        for websocket in (dead, alive):
+            register(server, websocket)
+        peer = server.peers[dead]
+
+        server.fan_out(DOCUMENT, [dead, alive], b'first')
+        server.fan_out(DOCUMENT, [dead, alive], b'second')
+        await asyncio.sleep(0)
+        dead.dead = True
+        dead.release.set()
+        await asyncio.sleep(0.01)
+
+        assert peer.task.done() and peer.closed
+        assert peer.queue.empty() and peer.pending_bytes() == 0
+        assert dead not in yjs_server.connections[DOCUMENT]
+        assert not peer.enqueue(b'third')
+
+        server.fan_out(DOCUMENT, [dead, alive], b'third')
+        assert dead not in server.peers
+        await asyncio.sleep(0.01)
+        assert alive.sent == [b'first', b'second', b'third']
+        server.peers[alive].close()
+
+    asyncio.run(scenario())
+
+
+def test_close_cancels_sender_task(cleanup):
+    async def scenario():
+        websocket = WebSocket(stalled=True)
+        peer = PeerSender(websocket, DOCUMENT)
+        peer.enqueue(b'pending')
+        await asyncio.sleep(0)
+        peer.close()
+        await asyncio.sleep(0)
+        assert peer.task.cancelled() and not peer.enqueue(b'more')
+
+    asyncio.run(scenario())
@@ -0,0 +1,311 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pycrdt
+import pytest
+import websockets
+
+import yjs_server
+import yjs_utils
+from yjs_server import HashRing, YjsShardRouter, YjsWebSocketServer
+from yjs_utils import YjsSnapshotStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_owner_is_stable_and_covers_all_shards():
+    ring = HashRing(['shard-0', 'shard-1', 'shard-2'])
+    again = HashRing(['shard-2', 'shard-0', 'shard-1'])
+    owners = [ring.owner(f'doc-{i}') for i in range(3000)]
+    assert owners == [again.owner(f'doc-{i}') for i in range(3000)]
+    for shard in ('shard-0', 'shard-1', 'shard-2'):
+        assert 600 < owners.count(shard) < 1400
+
+
+def test_adding_a_shard_moves_only_to_the_new_shard():
+    before = HashRing(['shard-0', 'shard-1', 'shard-2'])
+    after = HashRing(['shard-0', 'shard-1', 'shard-2', 'shard-3'])
+    documents = [f'doc-{i}' for i in range(4000)]
+    moved = [doc for doc in documents if before.owner(doc) != after.owner(doc)]
+    assert all(after.owner(doc) == 'shard-3' for doc in moved)
+    # 约 1/4 的文档改变归属
+    assert 600 < len(moved) < 1400
+
+
+def documents_by_move(before, after, count=200):
+    """返回 (归属改变的文档, 归属不变的文档)"""
+    documents = [f'doc-{i}' for i in range(count)]
+    moved = [doc for doc in documents if before.owner(doc) != after.owner(doc)]
+    kept = [doc for doc in documents if before.owner(doc) == after.owner(doc)]
+    return moved, kept
+
+
+class FakeProcess:
+    def terminate(self):
+        self.terminated = True
+
+    def join(self, timeout=None):
+        pass
+
+
+def fake_router(monkeypatch):
+    """分片进程替换为控制通道的另一端，由测试扮演分片"""
+    router = YjsShardRouter('127.0.0.1', 20000, shards=2)
+    ends = {}
+
+    async def start_shard():
+        name = f'shard-{len(router.shards)}'
+        ours, theirs = multiprocessing.Pipe()
+        ends[name] = theirs
+        router.shards[name] = {'port': 20001 + len(router.shards), 'process': FakeProcess(), 'control': ours}
+        return name
+
+    monkeypatch.setattr(router, 'start_shard', start_shard)
+    return router, ends, start_shard
+
+
+def test_router_swaps_ring_only_after_old_shards_release(monkeypatch):
+    router, ends, start_shard = fake_router(monkeypatch)
+
+    async def scenario():
+        await start_shard()
+        await start_shard()
+        router.ring = HashRing(router.shards)
+        moved, kept = documents_by_move(router.ring, HashRing(['shard-0', 'shard-1', 'shard-2']))
+
+        adding = asyncio.create_task(router.add_shard())
+        await asyncio.sleep(0.1)
+        assert router.ring.shards == ['shard-0', 'shard-1']
+        # 归属不变的文档照常转发，将要迁移的文档等待确认
+        assert await asyncio.wait_for(router.route(kept[0]), 1) == \
+            router.shards[router.ring.owner(kept[0])]['port']
+        held = asyncio.create_task(router.route(moved[0]))
+        await asyncio.sleep(0.1)
+        assert not held.done()
+
+        for name in ('shard-0', 'shard-1'):
+            command, (generation, shards) = ends[name].recv()
+            assert command == 'shards' and shards == ['shard-0', 'shard-1', 'shard-2']
+            assert not held.done()
+            ends[name].send(('released', generation, []))
+        await asyncio.wait_for(adding, 5)
+        assert router.ring.shards == ['shard-0', 'shard-1', 'shard-2']
+        assert await asyncio.wait_for(held, 1) == router.shards['shard-2']['port']
+
+    asyncio.run(scenario())
+
+
+def test_router_rolls_back_when_a_shard_does_not_release(monkeypatch):
+    monkeypatch.setattr(yjs_server, 'YJS_HANDOFF_TIMEOUT', 0.3)
+    router, ends, start_shard = fake_router(monkeypatch)
+
+    async def scenario():
+        await start_shard()
+        await start_shard()
+        router.ring = HashRing(router.shards)
+        moved, _ = documents_by_move(router.ring, HashRing(['shard-0', 'shard-1', 'shard-2']))
+        adding = asyncio.create_task(router.add_shard())
+        await asyncio.sleep(0.1)
+        held = asyncio.create_task(router.route(moved[0]))
+
+        _, (generation, _) = ends['shard-0'].recv()
+        ends['shard-0'].send(('released', generation, []))
+        await asyncio.wait_for(adding, 5)
+        assert list(router.shards) == ['shard-0', 'shard-1']
+        assert router.ring.shards == ['shard-0', 'shard-1']
+        assert await asyncio.wait_for(held, 1) == router.shards[router.ring.owner(moved[0])]['port']
+        # 旧分片收到恢复原哈希环的通知
+        _, (_, shards) = ends['shard-1'].recv()
+        _, (_, restored) = ends['shard-1'].recv()
+        assert shards == ['shard-0', 'shard-1', 'shard-2'] and restored == ['shard-0', 'shard-1']
+
+    asyncio.run(scenario())
+
+
+def test_shard_commits_log_before_acknowledging(tmp_path, monkeypatch):
+    monkeypatch.setattr(yjs_server, 'YJS_COALESCE_WINDOW_MS', 1000)
+    before = HashRing(['shard-0'])
+    moved, _ = documents_by_move(before, HashRing(['shard-0', 'shard-1']))
+    document_id = moved[0]
+    ours, theirs = multiprocessing.Pipe()
+
+    async def scenario():
+        server = YjsWebSocketServer(store=YjsSnapshotStore(str(tmp_path)), shard_name='shard-0', shards=['shard-0'])
+        await server.load_document(document_id)
+        doc = pycrdt.Doc()
+        text = doc.get('t', type=pycrdt.Text)
+        text += 'logged;'
+        server.apply_update(document_id, doc.get_update())
+        before_coalesced = doc.get_state()
+        text += 'coalesced;'
+        server.coalesce_update(None, document_id, doc.get_update(before_coalesced))
+
+        await server.hand_off(ours, 7, ['shard-0', 'shard-1'])
+        assert theirs.recv() == ('released', 7, [document_id])
+        assert document_id not in yjs_server.documents
+        assert not server.owns(document_id)
+
+    asyncio.run(scenario())
+    # 另一个进程此时从磁盘加载到全部更新
+    assert text_of(YjsSnapshotStore(str(tmp_path)).load(document_id)) == 'logged;coalesced;'
+
+
+def free_port_block(size):
+    """返回连续 size 个空闲端口中的第一个"""
+    for _ in range(50):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            base = probe.getsockname()[1]
+        if base + size > 65535:
+            continue
+        try:
+            sockets = []
+            for port in range(base, base + size):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(('127.0.0.1', port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+    raise RuntimeError('没有可用的连续端口')
+
+
+async def wait_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+class Writer:
+    """持续写入一个文档的客户端，连接被关闭后重连，并在同步握手中补发服务端缺失的更新"""
+
+    def __init__(self, url, document_id, count):
+        self.url = url
+        self.document_id = document_id
+        self.count = count
+        self.doc = pycrdt.Doc()
+        self.text = self.doc.get('t', type=pycrdt.Text)
+        self.reconnects = 0
+        self.finished = asyncio.Event()
+        self.done = asyncio.Event()
+
+    def tokens(self):
+        return [f'{self.document_id}:{n};' for n in range(self.count)]
+
+    async def _read(self, websocket):
+        async for message in websocket:
+            message_type, sync_type, payload = yjs_utils.decode_message(message)
+            if message_type != yjs_utils.MESSAGE_SYNC:
+                continue
+            if sync_type == yjs_utils.SYNC_STEP1:
+                await websocket.send(yjs_utils.encode_sync_step2(self.doc.get_update(payload)))
+            else:
+                self.doc.apply_update(payload)
+
+    async def run(self):
+        written = 0
+        while True:
+            try:
+                async with websockets.connect(f'{self.url}/{self.document_id}') as websocket:
+                    reader = asyncio.create_task(self._read(websocket))
+                    try:
+                        while written < self.count:
+                            before = self.doc.get_state()
+                            self.text += f'{self.document_id}:{written};'
+                            written += 1
+                            await websocket.send(yjs_utils.encode_sync_update(self.doc.get_update(before)))
+                            await asyncio.sleep(0.01)
+                        # 等待最后的更新送达，连接保持打开直到 done 被设置
+                        await asyncio.sleep(0.5)
+                        if not reader.done():
+                            self.finished.set()
+                            await self.done.wait()
+                            return
+                    finally:
+                        reader.cancel()
+            except (websockets.exceptions.ConnectionClosed, OSError):
+                pass
+            self.reconnects += 1
+            await asyncio.sleep(0.05)
+
+
+async def read_state(url, document_id):
+    """以空状态向量请求文档的完整状态"""
+    async with websockets.connect(f'{url}/{document_id}') as websocket:
+        await websocket.send(yjs_utils.encode_sync_step1(pycrdt.Doc().get_state()))
+        async for message in websocket:
+            message_type, sync_type, payload = yjs_utils.decode_message(message)
+            if message_type == yjs_utils.MESSAGE_SYNC and sync_type == yjs_utils.SYNC_STEP2:
+                return payload
+
+
+def text_of(state):
+    doc = pycrdt.Doc()
+    doc.apply_update(state)
+    return str(doc.get('t', type=pycrdt.Text))
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='需要 SIGUSR1')
+def test_rebalance_during_writes_keeps_every_update(tmp_path):
+    port = free_port_block(4)
+    env = dict(os.environ, COLLAB_AUTH_REQUIRED='False', YJS_DATA_DIR=str(tmp_path / 'data'),
+               YJS_SNAPSHOT_INTERVAL='0.05', YJS_SNAPSHOT_DEBOUNCE='0', YJS_HANDOFF_TIMEOUT='20')
+    with open(tmp_path / 'server.log', 'wb') as log:
+        # 路由和分片在同一个进程组中，测试结束时一起强制结束
+        router = subprocess.Popen(
+            [sys.executable, 'yjs_server.py', '--host', '127.0.0.1', '--port', str(port), '--shards', '2'],
+            cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    url = f'ws://127.0.0.1:{port}'
+    writers = [Writer(url, f'doc-{i}', 250) for i in range(16)]
+    after = HashRing(['shard-0', 'shard-1', 'shard-2'])
+    moving = [w for w in writers if after.owner(w.document_id) == 'shard-2']
+    assert moving, '没有文档会迁移到新分片'
+
+    async def scenario():
+        await wait_port(port)
+        tasks = [asyncio.create_task(writer.run()) for writer in writers]
+        await asyncio.sleep(0.5)
+        router.send_signal(signal.SIGUSR1)
+        await asyncio.wait_for(asyncio.gather(*[writer.finished.wait() for writer in writers]), 60)
+        states = {writer.document_id: await read_state(url, writer.document_id) for writer in writers}
+        # 写入方的连接仍然打开时模拟崩溃：不经过断开时的快照，只依赖已提交的日志和快照
+        os.killpg(router.pid, signal.SIGKILL)
+        for writer in writers:
+            writer.done.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return states
+
+    try:
+        states = asyncio.run(scenario())
+    finally:
+        try:
+            os.killpg(router.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        router.wait(30)
+
+    # 迁移的文档都经历了断开重连，新分片拿到了全部更新，且全部更新都已写入磁盘
+    assert all(writer.reconnects > 0 for writer in moving)
+    store = YjsSnapshotStore(str(tmp_path / 'data'))
+    for writer in writers:
+        live = text_of(states[writer.document_id])
+        persisted = text_of(store.load(writer.document_id))
+        for token in writer.tokens():
+            assert token in live, f'{writer.document_id} 缺少 {token}'
+            assert token in persisted, f'{writer.document_id} 的日志缺少 {token}'
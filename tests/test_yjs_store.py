@@ -0,0 +1,150 @@
+import os
+
+import pycrdt
+import pytest
+
+import yjs_utils
+from yjs_utils import YjsSnapshotStore, write_var_uint
+
+
+def text_updates(*parts):
+    doc = pycrdt.Doc()
+    doc['t'] = text = pycrdt.Text()
+    updates = []
+    for part in parts:
+        before = doc.get_state()
+        text += part
+        updates.append(doc.get_update(before))
+    return updates
+
+
+def text_of(state):
+    doc = pycrdt.Doc()
+    doc.apply_update(state)
+    return str(doc.get('t', type=pycrdt.Text))
+
+
+def record(update):
+    return write_var_uint(len(update)) + update
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    calls = []
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        calls.append(fd)
+        real_fsync(fd)
+    monkeypatch.setattr(yjs_utils.os, 'fsync', fsync)
+    return calls
+
+
+def test_appends_are_group_committed_with_one_fsync_per_file(tmp_path, fsyncs):
+    store = YjsSnapshotStore(str(tmp_path))
+    a = text_updates('a1', 'a2', 'a3')
+    b = text_updates('b1')
+    for update in a:
+        store.append('doc-a', update)
+    store.append('doc-b', b[0])
+    # 提交前不写文件
+    assert not os.path.exists(store._path('doc-a', '.ylog'))
+    assert store.mark('doc-a') == sum(len(record(update)) for update in a)
+
+    assert store.commit() == 2
+    assert len(fsyncs) == 2
+    with open(store._path('doc-a', '.ylog'), 'rb') as f:
+        assert f.read() == b''.join(record(update) for update in a)
+    assert store.commit() == 0 and len(fsyncs) == 2
+    assert text_of(YjsSnapshotStore(str(tmp_path)).load('doc-a')) == 'a1a2a3'
+
+
+def test_failed_commit_keeps_records_for_retry(tmp_path, monkeypatch):
+    store = YjsSnapshotStore(str(tmp_path))
+    updates = text_updates('x', 'y')
+    store.append('doc', updates[0])
+    real_fsync = os.fsync
+
+    def failing_fsync(fd):
+        raise OSError('disk full')
+    monkeypatch.setattr(yjs_utils.os, 'fsync', failing_fsync)
+    with pytest.raises(OSError):
+        store.commit()
+    monkeypatch.setattr(yjs_utils.os, 'fsync', real_fsync)
+    # 失败的写入已从日志中去掉
+    assert os.path.getsize(store._path('doc', '.ylog')) == 0
+    store.append('doc', updates[1])
+    assert store.commit() == 1
+    with open(store._path('doc', '.ylog'), 'rb') as f:
+        assert f.read() == record(updates[0]) + record(updates[1])
+    assert text_of(YjsSnapshotStore(str(tmp_path)).load('doc')) == 'xy'
+
+
+def test_torn_tail_is_repaired_on_load(tmp_path):
+    store = YjsSnapshotStore(str(tmp_path))
+    updates = text_updates('one', 'two', 'three')
+    for update in updates:
+        store.append('doc', update)
+    store.commit()
+    path = store._path('doc', '.ylog')
+    complete = len(record(updates[0])) + len(record(updates[1]))
+    # 模拟写最后一条记录时崩溃
+    os.truncate(path, complete + len(record(updates[2])) // 2)
+
+    # 只读访问不修改文件
+    assert text_of(YjsSnapshotStore(str(tmp_path)).peek('doc')) == 'onetwo'
+    assert os.path.getsize(path) > complete
+
+    reloaded = YjsSnapshotStore(str(tmp_path))
+    assert text_of(reloaded.load('doc')) == 'onetwo'
+    assert os.path.getsize(path) == complete
+    assert reloaded.mark('doc') == complete
+
+    # 修复后追加的记录紧接在有效部分之后
+    reloaded.append('doc', updates[2])
+    reloaded.commit()
+    assert text_of(YjsSnapshotStore(str(tmp_path)).load('doc')) == 'onetwothree'
+
+
+def test_truncation_at_mark_keeps_later_appends(tmp_path):
+    store = YjsSnapshotStore(str(tmp_path))
+    updates = text_updates('a', 'b', 'c', 'd', 'e')
+    path = store._path('doc', '.ylog')
+
+    store.append('doc', updates[0])
+    store.append('doc', updates[1])
+    store.commit()
+    mark = store.mark('doc')
+    snapshot = yjs_utils.merge_updates(updates[:2])
+    # 取得 mark 之后、写入快照之前又收到的更新（尚未提交）
+    store.append('doc', updates[2])
+    store.save('doc', snapshot, '<p>ab</p>', mark)
+    with open(path, 'rb') as f:
+        assert f.read() == record(updates[2])
+    assert text_of(YjsSnapshotStore(str(tmp_path)).load('doc')) == 'abc'
+
+    # 第二次截断按日志文件开头对应的偏移计算
+    store.append('doc', updates[3])
+    store.commit()
+    second_mark = store.mark('doc')
+    store.append('doc', updates[4])
+    store.commit()
+    store.save('doc', yjs_utils.merge_updates(updates[:4]), '<p>abcd</p>', second_mark)
+    with open(path, 'rb') as f:
+        assert f.read() == record(updates[4])
+    assert text_of(YjsSnapshotStore(str(tmp_path)).load('doc')) == 'abcde'
+
+    # 已截断过的 mark 不再截断
+    store.save('doc', yjs_utils.merge_updates(updates[:4]), '<p>abcd</p>', mark)
+    assert os.path.getsize(path) == len(record(updates[4]))
+    with open(store._path('doc', '.html'), encoding='utf-8') as f:
+        assert f.read() == '<p>abcd</p>'
+
+
+def test_release_commits_and_forgets_offsets(tmp_path):
+    store = YjsSnapshotStore(str(tmp_path))
+    update, = text_updates('handoff')
+    store.append('doc', update)
+    store.release(['doc'])
+    assert store.mark('doc') == 0
+    assert text_of(YjsSnapshotStore(str(tmp_path)).load('doc')) == 'handoff'
@@ -0,0 +1,147 @@
+import pycrdt
+import pytest
+
+import yjs_utils
+
+
+@pytest.mark.parametrize('value, encoded', [
+    (0, b'\x00'),
+    (127, b'\x7f'),
+    (128, b'\x80\x01'),
+    (300, b'\xac\x02'),
+    (2 ** 32, b'\x80\x80\x80\x80\x10'),
+])
+def test_var_uint_matches_lib0(value, encoded):
+    assert yjs_utils.write_var_uint(value) == encoded
+    assert yjs_utils.read_var_uint(encoded) == (value, len(encoded))
+
+
+def test_var_uint_reads_from_offset():
+    data = b'\xff' + yjs_utils.write_var_uint(300) + b'\x05'
+    assert yjs_utils.read_var_uint(data, 1) == (300, 3)
+    assert yjs_utils.read_var_uint(data, 3) == (5, 4)
+
+
+def test_truncated_values_raise():
+    with pytest.raises(ValueError):
+        yjs_utils.read_var_uint(b'\x80')
+    with pytest.raises(ValueError):
+        yjs_utils.read_var_bytes(b'\x05abc')
+
+
+def test_var_string_round_trip():
+    encoded = yjs_utils.write_var_string('协同 edit')
+    assert yjs_utils.read_var_string(encoded) == ('协同 edit', len(encoded))
+
+
+@pytest.mark.parametrize('encode, sync_type', [
+    (yjs_utils.encode_sync_step1, yjs_utils.SYNC_STEP1),
+    (yjs_utils.encode_sync_step2, yjs_utils.SYNC_STEP2),
+    (yjs_utils.encode_sync_update, yjs_utils.SYNC_UPDATE),
+])
+def test_sync_messages_round_trip(encode, sync_type):
+    payload = bytes(range(200))
+    message = encode(payload)
+    assert yjs_utils.decode_message(message) == (yjs_utils.MESSAGE_SYNC, sync_type, payload)
+
+
+def test_extract_update_only_returns_document_changes():
+    assert yjs_utils.extract_update(yjs_utils.encode_sync_update(b'\x01')) == b'\x01'
+    assert yjs_utils.extract_update(yjs_utils.encode_sync_step2(b'\x02')) == b'\x02'
+    assert yjs_utils.extract_update(yjs_utils.encode_sync_step1(b'\x03')) is None
+    assert yjs_utils.extract_update(yjs_utils.encode_awareness_message([])) is None
+    assert yjs_utils.extract_update(b'\x00\x02\x05') is None
+
+
+def test_awareness_round_trip():
+    entries = [(1, 3, '{"user":{"name":"甲"}}'), (2 ** 31, 0, 'null')]
+    message = yjs_utils.encode_awareness_message(entries)
+    message_type, _, payload = yjs_utils.decode_message(message)
+    assert message_type == yjs_utils.MESSAGE_AWARENESS
+    assert yjs_utils.decode_awareness_update(payload) == entries
+
+
+def test_other_message_types_keep_remaining_bytes():
+    message = yjs_utils.write_var_uint(yjs_utils.MESSAGE_QUERY_AWARENESS) + b'rest'
+    assert yjs_utils.decode_message(message) == (yjs_utils.MESSAGE_QUERY_AWARENESS, None, b'rest')
+
+
+def text_doc(content=''):
+    doc = pycrdt.Doc()
+    doc['t'] = text = pycrdt.Text()
+    if content:
+        text += content
+    return doc
+
+
+def test_merge_updates():
+    doc = text_doc()
+    updates = []
+    for piece in ('a', 'b', 'c'):
+        before = doc.get_state()
+        doc['t'] += piece
+        updates.append(doc.get_update(before))
+    assert yjs_utils.merge_updates([]) == b''
+    assert yjs_utils.merge_updates([b'', updates[0]]) == updates[0]
+
+    replica = pycrdt.Doc()
+    replica.apply_update(yjs_utils.merge_updates(updates))
+    assert str(replica.get('t', type=pycrdt.Text)) == 'abc'
+
+
+def test_state_vector_handshake_sends_only_missing_updates():
+    server = text_doc('hello' * 100)
+    client = pycrdt.Doc()
+    client.apply_update(server.get_update())
+    server['t'] += ' world'
+
+    # 客户端发送状态向量，服务端只回复缺失的部分
+    _, sync_type, state_vector = yjs_utils.decode_message(yjs_utils.encode_sync_step1(client.get_state()))
+    reply = yjs_utils.encode_sync_step2(server.get_update(state_vector))
+    assert b'hello' not in reply
+
+    client.apply_update(yjs_utils.extract_update(reply))
+    assert str(client.get('t', type=pycrdt.Text)) == 'hello' * 100 + ' world'
+
+
+def tiptap_state(*nodes):
+    doc = pycrdt.Doc()
+    fragment = doc.get(yjs_utils.DEFAULT_FRAGMENT, type=pycrdt.XmlFragment)
+    for node in nodes:
+        fragment.children.append(node)
+    return doc.get_update()
+
+
+def test_render_html_strict_accepts_round_trippable_content():
+    state = tiptap_state(
+        pycrdt.XmlElement('heading', {'level': 2}, [pycrdt.XmlText('标题')]),
+        pycrdt.XmlElement('paragraph', {'textAlign': 'center'}, [pycrdt.XmlText('a<b')]),
+    )
+    html = yjs_utils.render_html(state, strict=True)
+    assert html == '<h2>标题</h2><p style="text-align: center">a&lt;b</p>'
+
+
+def test_render_html_strict_rejects_lossy_content():
+    unknown_node = tiptap_state(pycrdt.XmlElement('mention', {'id': '7'}))
+    assert 'data-type="mention"' in yjs_utils.render_html(unknown_node)
+    with pytest.raises(yjs_utils.UnsupportedContent):
+        yjs_utils.render_html(unknown_node, strict=True)
+
+    extra_attribute = tiptap_state(pycrdt.XmlElement('image', {'src': 'a.png', 'width': 320}))
+    assert yjs_utils.render_html(extra_attribute) == '<img src="a.png">'
+    with pytest.raises(yjs_utils.UnsupportedContent):
+        yjs_utils.render_html(extra_attribute, strict=True)
+
+
+def test_render_html_strict_checks_marks():
+    doc = pycrdt.Doc()
+    fragment = doc.get(yjs_utils.DEFAULT_FRAGMENT, type=pycrdt.XmlFragment)
+    text = pycrdt.XmlText('粗体')
+    fragment.children.append(pycrdt.XmlElement('paragraph', {}, [text]))
+    text.format(0, 2, {'bold': {}})
+    assert yjs_utils.render_html(doc.get_update(), strict=True) == '<p><strong>粗体</strong></p>'
+
+    text.format(0, 2, {'comment': {'id': 'c1'}})
+    assert yjs_utils.render_html(doc.get_update()) == '<p><strong>粗体</strong></p>'
+    with pytest.raises(yjs_utils.UnsupportedContent):
+        yjs_utils.render_html(doc.get_update(), strict=True)
@@ -4,77 +4,702 @@ Y.js WebSocket服务器
 用于处理Tiptap协同编辑的Y.js协议
 """
 
+import argparse
 import asyncio
+import bisect
+import functools
+import hashlib
+import multiprocessing
+import os
+import signal
+import time
 import websockets
+from http import HTTPStatus
 import json
 import logging
 from typing import Dict, Set
 
+from dotenv import load_dotenv
+from pycrdt import Doc
+from websockets import frames
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+
+# 独立运行，不经过 Flask 应用，在导入读取配置的模块前加载 .env
+load_dotenv()
+
+import collab_auth
+import yjs_utils
+from yjs_utils import YJS_DATA_DIR, YjsSnapshotStore
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 快照任务检查周期（秒）
+YJS_SNAPSHOT_INTERVAL = float(os.getenv('YJS_SNAPSHOT_INTERVAL', '5'))
+# 同一文档两次写入之间的最小间隔（秒）
+YJS_SNAPSHOT_DEBOUNCE = float(os.getenv('YJS_SNAPSHOT_DEBOUNCE', '30'))
+# 每个周期最多写入的文档数
+YJS_SNAPSHOT_BATCH_SIZE = int(os.getenv('YJS_SNAPSHOT_BATCH_SIZE', '100'))
+# 无人连接的文档在内存中保留的最长时间（秒）
+YJS_DOCUMENT_IDLE_SECONDS = float(os.getenv('YJS_DOCUMENT_IDLE_SECONDS', '300'))
+# 内存中文档状态的总预算（字节），超出时按最近最少使用淘汰无人连接的文档
+YJS_MEMORY_BUDGET = int(os.getenv('YJS_MEMORY_BUDGET', str(256 * 1024 * 1024)))
+# 淘汰任务的检查周期（秒）
+YJS_EVICTION_INTERVAL = float(os.getenv('YJS_EVICTION_INTERVAL', '10'))
+# 更新日志组提交的收集窗口（秒），窗口内的更新合并为一次写入和一次fsync
+YJS_LOG_COMMIT_INTERVAL = float(os.getenv('YJS_LOG_COMMIT_INTERVAL', '0.01'))
+# 单个连接未发出数据（出站队列和写缓冲）的高/低水位（字节）：超过高水位后跳过中间更新，回落到低水位后补发完整状态
+YJS_OUTBOUND_HIGH_WATERMARK = int(os.getenv('YJS_OUTBOUND_HIGH_WATERMARK', str(32 * 1024)))
+YJS_OUTBOUND_LOW_WATERMARK = int(os.getenv('YJS_OUTBOUND_LOW_WATERMARK', str(4 * 1024)))
+# 连接持续落后超过该时间（秒）即断开
+YJS_OUTBOUND_MAX_LAG_SECONDS = float(os.getenv('YJS_OUTBOUND_MAX_LAG_SECONDS', '30'))
+
+# 文档更新的合并窗口（毫秒），窗口内同一文档的更新合并为一个再广播和写日志，0 表示关闭
+YJS_COALESCE_WINDOW_MS = float(os.getenv('YJS_COALESCE_WINDOW_MS', '0'))
+# 合并窗口内累计的更新超过该大小（字节）时立即发出
+YJS_COALESCE_MAX_BYTES = int(os.getenv('YJS_COALESCE_MAX_BYTES', str(64 * 1024)))
+# 感知状态（光标、在线用户）的合并转发周期（秒）
+YJS_AWARENESS_INTERVAL = float(os.getenv('YJS_AWARENESS_INTERVAL', '0.05'))
+# 感知状态超过该时间（秒）未更新即视为客户端已离开，客户端默认每15秒续期一次
+YJS_AWARENESS_TIMEOUT = float(os.getenv('YJS_AWARENESS_TIMEOUT', '30'))
+# permessage-deflate 压缩策略：off 不压缩；always 全部压缩；adaptive 只压缩超过阈值的消息
+YJS_COMPRESSION = os.getenv('YJS_COMPRESSION', 'adaptive')
+# adaptive 策略下压缩的最小消息大小（字节），按键产生的小更新压缩后反而更慢
+YJS_COMPRESSION_THRESHOLD = int(os.getenv('YJS_COMPRESSION_THRESHOLD', '256'))
+# 压缩上下文的窗口大小（9-15）和 zlib memLevel（1-9），决定每个连接保留的压缩内存
+YJS_COMPRESSION_WINDOW_BITS = int(os.getenv('YJS_COMPRESSION_WINDOW_BITS', '12'))
+YJS_COMPRESSION_MEM_LEVEL = int(os.getenv('YJS_COMPRESSION_MEM_LEVEL', '5'))
+# 分片进程数，大于1时由路由进程按文档ID把连接转发到各分片
+YJS_SHARDS = int(os.getenv('YJS_SHARDS', '1'))
+# 一致性哈希环上每个分片的虚拟节点数
+YJS_SHARD_VNODES = int(os.getenv('YJS_SHARD_VNODES', '64'))
+# 增加分片时等待旧分片交出文档的最长时间（秒），超时则撤销本次增加
+YJS_HANDOFF_TIMEOUT = float(os.getenv('YJS_HANDOFF_TIMEOUT', '30'))
+
 # 存储文档和连接
 documents: Dict[str, Dict] = {}
 connections: Dict[str, Set] = {}
+# 感知状态只保留每个客户端的最新值，不写入文档也不持久化
+awareness: Dict[str, Dict[int, Dict]] = {}
+
+
+def document_id_from_path(path):
+    """从连接路径中提取文档ID，忽略查询参数（如 token）"""
+    return collab_auth.split_path(path)[0].strip('/') or 'default'
+
+
+def is_write_message(message):
+    """是否为修改文档的同步消息（step2 或 update）"""
+    try:
+        message_type, sync_type, _ = yjs_utils.decode_message(message)
+    except ValueError:
+        return False
+    return message_type == yjs_utils.MESSAGE_SYNC and sync_type in (yjs_utils.SYNC_STEP2, yjs_utils.SYNC_UPDATE)
+
+
+document_lookup = collab_auth.DocumentLookup()
+
+
+async def authorize(path, request_headers):
+    """校验握手请求中的JWT并查询文档权限，返回 (用户ID, 权限)，失败时抛出 collab_auth.AuthError"""
+    _, query = collab_auth.split_path(path)
+    user_id = collab_auth.decode_identity(collab_auth.extract_token(query=query, headers=request_headers))
+    document_id = collab_auth.document_id_from_room(document_id_from_path(path))
+    if document_id is None:
+        raise collab_auth.AuthError('无权访问该文档', 403)
+    owner_id, is_deleted = await asyncio.get_running_loop().run_in_executor(None, document_lookup, document_id)
+    permission = collab_auth.permission_for(owner_id, is_deleted, user_id)
+    if permission is None:
+        raise collab_auth.AuthError('无权访问该文档', 403)
+    return user_id, permission
+
+
+class AuthenticatingProtocol(websockets.WebSocketServerProtocol):
+    """在HTTP升级之前完成认证，用户ID和权限保存在连接上供之后的每条消息使用
+
+    未通过认证的请求直接以 401/403 响应，不会占用房间和文档资源。
+    """
+
+    def __init__(self, *args, authenticate=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.authenticate = authenticate
+        self.user_id = None
+        self.permission = 'owner'
+
+    async def process_request(self, path, request_headers):
+        response = await super().process_request(path, request_headers)
+        if response is not None or not self.authenticate:
+            return response
+        try:
+            self.user_id, self.permission = await authorize(path, request_headers)
+        except collab_auth.AuthError as e:
+            logger.warning(f"拒绝未授权的连接: {document_id_from_path(path)}, {e}")
+            return HTTPStatus(e.status), [], f'{e}\n'.encode('utf-8')
+        except Exception as e:
+            logger.error(f"查询文档权限失败: {e}")
+            return HTTPStatus.SERVICE_UNAVAILABLE, [], b'permission lookup failed\n'
+        return None
+
+
+class HashRing:
+    """一致性哈希环，增加分片时只有约 1/N 的文档改变归属"""
+
+    def __init__(self, shards, vnodes=YJS_SHARD_VNODES):
+        self.shards = list(shards)
+        self._points = sorted(
+            (self._hash(f"{shard}#{i}"), shard) for shard in self.shards for i in range(vnodes)
+        )
+        self._keys = [point for point, _ in self._points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def owner(self, document_id):
+        index = bisect.bisect(self._keys, self._hash(document_id)) % len(self._keys)
+        return self._points[index][1]
+
+
+class AdaptivePerMessageDeflate(PerMessageDeflate):
+    """小于阈值的消息不压缩直接发出，RFC 7692 允许逐条消息决定是否压缩"""
+
+    def encode(self, frame):
+        if (frame.opcode in (frames.OP_TEXT, frames.OP_BINARY) and frame.fin
+                and len(frame.data) < YJS_COMPRESSION_THRESHOLD):
+            return frame
+        return super().encode(frame)
+
+
+class AdaptiveDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response, extension = super().process_request_params(params, accepted_extensions)
+        return response, AdaptivePerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings
+        )
+
+
+def compression_extensions(policy=YJS_COMPRESSION):
+    """按压缩策略返回 websockets.serve 的扩展列表，窗口和memLevel限制每个连接的压缩内存"""
+    if policy == 'off':
+        return []
+    if policy not in ('always', 'adaptive'):
+        raise ValueError(f"不支持的压缩策略: {policy}")
+    factory = AdaptiveDeflateFactory if policy == 'adaptive' else ServerPerMessageDeflateFactory
+    return [factory(
+        server_max_window_bits=YJS_COMPRESSION_WINDOW_BITS,
+        client_max_window_bits=YJS_COMPRESSION_WINDOW_BITS,
+        compress_settings={'memLevel': YJS_COMPRESSION_MEM_LEVEL}
+    )]
+
+
+class PeerSender:
+    """单个连接的出站队列和发送任务
+
+    广播时只把帧放入各连接的队列，由各自的发送任务写出，一个慢连接不会阻塞其他连接。
+    """
+
+    def __init__(self, websocket, document_id):
+        self.websocket = websocket
+        self.document_id = document_id
+        self.queue = asyncio.Queue()
+        self.queued_bytes = 0
+        self.closed = False
+        self.task = asyncio.create_task(self._run())
+
+    def enqueue(self, message):
+        if self.closed:
+            return False
+        self.queue.put_nowait(message)
+        self.queued_bytes += len(message)
+        return True
+
+    def pending_bytes(self):
+        """队列中和传输层写缓冲中尚未发出的字节数"""
+        transport = getattr(self.websocket, 'transport', None)
+        buffered = transport.get_write_buffer_size() if transport is not None else 0
+        return self.queued_bytes + buffered
+
+    async def _run(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                self.queued_bytes -= len(message)
+                await self.websocket.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            # 发送失败即视为连接已断开，从文档连接中移除，并释放队列中不会再发出的帧
+            self.closed = True
+            connections.get(self.document_id, set()).discard(self.websocket)
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queued_bytes = 0
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+
 
 class YjsWebSocketServer:
-    def __init__(self, host='localhost', port=1234):
+    def __init__(self, host='localhost', port=1234, store=None, shard_name=None, shards=None,
+                 compression=YJS_COMPRESSION, authenticate=collab_auth.AUTH_REQUIRED):
         self.host = host
         self.port = port
+        self.store = store or YjsSnapshotStore()
+        self.compression = compression
+        # 分片进程只接受路由转发的连接，认证已在路由完成
+        self.authenticate = authenticate
+        # 分片模式下本进程的名称和当前的哈希环
+        self.shard_name = shard_name
+        self.ring = HashRing(shards) if shards else None
+        self.lagging = {}  # 落后的连接 -> 开始落后的时间
+        self.peers = {}  # 连接 -> PeerSender
+        self.log_event = asyncio.Event()  # 有待提交的日志记录
+        self.loading = {}  # document_id -> 正在从磁盘加载的任务
+        self.coalescing = {}  # document_id -> 合并窗口内的 {'updates': [(来源连接, 更新)], 'bytes', 'timer'}
+        self.awareness_pending = {}  # document_id -> {clientID: (clock, 状态, 来源连接)}，等待下次合并转发
+        self.evicted = 0
         
     async def register_client(self, websocket, document_id):
         """注册客户端连接"""
         if document_id not in connections:
             connections[document_id] = set()
         connections[document_id].add(websocket)
+        self.peers[websocket] = PeerSender(websocket, document_id)
         
-        if document_id not in documents:
-            documents[document_id] = {
-                'state': b'',  # Y.js文档状态
-                'updates': []  # 更新历史
-            }
+        await self.load_document(document_id)
+        documents[document_id]['last_used'] = time.monotonic()
         
         logger.info(f"客户端连接到文档 {document_id}，当前连接数: {len(connections[document_id])}")
         
-        # 发送当前文档状态给新连接的客户端
-        if documents[document_id]['state']:
-            await websocket.send(documents[document_id]['state'])
+        # 同步第一步：发送服务端状态向量，客户端据此回复服务端缺失的更新
+        self.send(websocket, yjs_utils.encode_sync_step1(documents[document_id]['doc'].get_state()))
+        # 新连接立即收到房间内其他客户端的感知状态
+        if awareness.get(document_id):
+            self.send(websocket, self.encode_awareness(document_id))
     
+    async def load_document(self, document_id):
+        """文档不在内存中时从磁盘加载，同一文档的并发加载共用一个任务"""
+        if document_id in documents:
+            return
+        task = self.loading.get(document_id)
+        if task is None:
+            task = asyncio.create_task(self._load(document_id))
+            self.loading[document_id] = task
+            task.add_done_callback(lambda _: self.loading.pop(document_id, None))
+        await task
+
+    async def _load(self, document_id):
+        loop = asyncio.get_running_loop()
+        state = await loop.run_in_executor(None, self.store.load, document_id)
+        ydoc = Doc()
+        if state:
+            ydoc.apply_update(state)
+        documents[document_id] = {
+            'doc': ydoc,  # 合并了所有更新的Y.js文档，内存占用与文档大小成正比
+            'dirty': False,
+            'last_flush': 0.0,
+            'last_used': time.monotonic(),
+            'size': len(state)  # 估算的内存占用（字节）
+        }
+
     async def unregister_client(self, websocket, document_id):
         """注销客户端连接"""
         if document_id in connections:
             connections[document_id].discard(websocket)
+            self.lagging.pop(websocket, None)
+            peer = self.peers.pop(websocket, None)
+            if peer is not None:
+                peer.close()
+            # 该连接上报的感知状态随连接一起移除
+            for client_id, entry in list(awareness.get(document_id, {}).items()):
+                if entry['websocket'] is websocket:
+                    self.remove_awareness(document_id, client_id)
             if not connections[document_id]:
-                # 如果没有连接了，可以选择清理文档状态
-                pass
+                # 最后一个连接离开时立即写入快照，空闲计时从此开始
+                if document_id in documents:
+                    documents[document_id]['last_used'] = time.monotonic()
+                await self.flush_documents([document_id])
         logger.info(f"客户端断开文档 {document_id}，当前连接数: {len(connections.get(document_id, set()))}")
     
+    async def handle_message(self, websocket, document_id, message):
+        """按 y-protocols 消息类型处理客户端消息"""
+        try:
+            message_type, sync_type, payload = yjs_utils.decode_message(message)
+        except ValueError as e:
+            logger.warning(f"无法解析的消息: {e}")
+            return
+
+        if message_type == yjs_utils.MESSAGE_AWARENESS:
+            self.apply_awareness(websocket, document_id, payload)
+        elif message_type == yjs_utils.MESSAGE_QUERY_AWARENESS:
+            self.send(websocket, self.encode_awareness(document_id))
+        elif message_type != yjs_utils.MESSAGE_SYNC:
+            # 其他非文档消息直接转发，不写入文档
+            await self.broadcast_update(websocket, document_id, message)
+        elif sync_type == yjs_utils.SYNC_STEP1:
+            # 只回复客户端状态向量之后缺失的部分
+            diff = documents[document_id]['doc'].get_update(payload)
+            self.send(websocket, yjs_utils.encode_sync_step2(diff))
+        elif sync_type in (yjs_utils.SYNC_STEP2, yjs_utils.SYNC_UPDATE):
+            if not collab_auth.can_write(getattr(websocket, 'permission', 'owner')):
+                # 只读连接的修改直接丢弃
+                return
+            if YJS_COALESCE_WINDOW_MS > 0:
+                self.coalesce_update(websocket, document_id, payload)
+            else:
+                self.apply_update(document_id, payload)
+                await self.broadcast_update(websocket, document_id, yjs_utils.encode_sync_update(payload))
+
+    def apply_update(self, document_id, update, log=True):
+        """把更新合并进服务端文档并写入更新日志"""
+        documents[document_id]['doc'].apply_update(update)
+        documents[document_id]['dirty'] = True
+        documents[document_id]['size'] += len(update)
+        if log:
+            self.log_update(document_id, update)
+
+    def log_update(self, document_id, update):
+        self.store.append(document_id, update)
+        self.log_event.set()
+
+    def coalesce_update(self, websocket, document_id, update):
+        """更新立即并入服务端文档，广播和写日志推迟到合并窗口结束或累计大小超限"""
+        self.apply_update(document_id, update, log=False)
+        batch = self.coalescing.get(document_id)
+        if batch is None:
+            timer = asyncio.get_running_loop().call_later(
+                YJS_COALESCE_WINDOW_MS / 1000, self.flush_coalesced, document_id
+            )
+            batch = self.coalescing[document_id] = {'updates': [], 'bytes': 0, 'timer': timer}
+        batch['updates'].append((websocket, update))
+        batch['bytes'] += len(update)
+        if batch['bytes'] >= YJS_COALESCE_MAX_BYTES:
+            self.flush_coalesced(document_id)
+
+    def flush_coalesced(self, document_id):
+        """合并窗口内的更新并发出，每个来源连接只收到其他连接的更新"""
+        batch = self.coalescing.pop(document_id, None)
+        if not batch:
+            return
+        batch['timer'].cancel()
+        updates = batch['updates']
+        merged = yjs_utils.merge_updates([update for _, update in updates])
+        self.log_update(document_id, merged)
+
+        origins = {origin for origin, _ in updates}
+        clients = list(connections.get(document_id, ()))
+        self.fan_out(document_id, [client for client in clients if client not in origins],
+                     yjs_utils.encode_sync_update(merged))
+        if len(origins) > 1:
+            for origin in origins:
+                others = [update for source, update in updates if source is not origin]
+                if origin in clients and others:
+                    self.fan_out(document_id, [origin],
+                                 yjs_utils.encode_sync_update(yjs_utils.merge_updates(others)))
+
+    def apply_awareness(self, websocket, document_id, payload):
+        """记录客户端的最新感知状态，等待下次合并转发"""
+        try:
+            entries = yjs_utils.decode_awareness_update(payload)
+        except ValueError as e:
+            logger.warning(f"无法解析的感知消息: {e}")
+            return
+        states = awareness.setdefault(document_id, {})
+        pending = self.awareness_pending.setdefault(document_id, {})
+        now = time.monotonic()
+        for client_id, clock, state in entries:
+            current = states.get(client_id)
+            if current is not None and (clock < current['clock'] or (clock == current['clock'] and state != 'null')):
+                continue  # 过期的状态
+            if state == 'null':
+                states.pop(client_id, None)
+            else:
+                states[client_id] = {'clock': clock, 'state': state, 'updated': now, 'websocket': websocket}
+            pending[client_id] = (clock, state, websocket)
+
+    def remove_awareness(self, document_id, client_id):
+        """移除客户端的感知状态并通知其他客户端"""
+        entry = awareness.get(document_id, {}).pop(client_id, None)
+        if entry is not None:
+            self.awareness_pending.setdefault(document_id, {})[client_id] = (entry['clock'] + 1, 'null', None)
+
+    def encode_awareness(self, document_id):
+        """房间内所有客户端当前的感知状态"""
+        states = awareness.get(document_id, {})
+        return yjs_utils.encode_awareness_message(
+            [(client_id, entry['clock'], entry['state']) for client_id, entry in states.items()]
+        )
+
+    def flush_awareness(self):
+        """把一个周期内变化的感知状态合并成一条消息转发，落后的连接直接跳过
+
+        各连接收到的消息中不含它自己上报的状态，上报了状态的连接单独编码一条去掉自己状态的消息。
+        """
+        pending, self.awareness_pending = self.awareness_pending, {}
+        for document_id, changes in pending.items():
+            if not changes:
+                continue
+            entries = [(client_id, clock, state, origin) for client_id, (clock, state, origin) in changes.items()]
+            message = yjs_utils.encode_awareness_message([entry[:3] for entry in entries])
+            origins = {origin for _, _, _, origin in entries}
+            for client in list(connections.get(document_id, ())):
+                if client in self.lagging:
+                    continue
+                if client in origins:
+                    others = [entry[:3] for entry in entries if entry[3] is not client]
+                    if others:
+                        self.send(client, yjs_utils.encode_awareness_message(others))
+                    continue
+                self.send(client, message)
+
+    def expire_awareness(self):
+        """移除超时未续期的感知状态"""
+        deadline = time.monotonic() - YJS_AWARENESS_TIMEOUT
+        for document_id, states in list(awareness.items()):
+            for client_id, entry in list(states.items()):
+                if entry['updated'] < deadline:
+                    self.remove_awareness(document_id, client_id)
+            if not states:
+                del awareness[document_id]
+
+    async def awareness_loop(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(YJS_AWARENESS_INTERVAL)
+            try:
+                if time.monotonic() - last_expire >= 1:
+                    self.expire_awareness()
+                    last_expire = time.monotonic()
+                self.flush_awareness()
+            except Exception as e:
+                logger.error(f"转发感知状态时出错: {e}")
+
+    def send(self, websocket, message):
+        """把消息放入连接的出站队列，不等待发送完成"""
+        peer = self.peers.get(websocket)
+        return peer is not None and peer.enqueue(message)
+
     async def broadcast_update(self, websocket, document_id, update):
         """广播更新给其他客户端"""
         if document_id in connections:
-            # 保存更新到文档历史
-            documents[document_id]['updates'].append(update)
-            
-            # 广播给除发送者外的所有客户端
-            disconnected = set()
-            for client in connections[document_id]:
-                if client != websocket:
-                    try:
-                        await client.send(update)
-                    except websockets.exceptions.ConnectionClosed:
-                        disconnected.add(client)
-            
-            # 清理断开的连接
-            for client in disconnected:
-                connections[document_id].discard(client)
+            self.fan_out(document_id, [client for client in connections[document_id] if client != websocket], update)
+
+    def fan_out(self, document_id, clients, update):
+        """把帧放入各连接的出站队列，积压的连接跳过本次更新"""
+        disconnected = set()
+        for client in clients:
+            peer = self.peers.get(client)
+            if peer is None or peer.closed:
+                disconnected.add(client)
+                # 发送任务已结束的连接不再保留其 PeerSender
+                self.peers.pop(client, None)
+                continue
+            decision = self.check_backpressure(peer)
+            if decision == 'skip':
+                continue
+            if decision == 'drop':
+                disconnected.add(client)
+                asyncio.create_task(client.close(1013, 'client too slow'))
+                continue
+            message = update
+            if decision == 'resync':
+                message = yjs_utils.encode_sync_update(self.encode_state(document_id))
+            peer.enqueue(message)
+
+        # 清理断开的连接
+        for client in disconnected:
+            connections.get(document_id, set()).discard(client)
+
+    def check_backpressure(self, peer):
+        """根据连接未发出的字节数返回 'send'、'skip'、'resync'（已追上，需补发完整状态）或 'drop'"""
+        client = peer.websocket
+        buffered = peer.pending_bytes()
+        since = self.lagging.get(client)
+        if since is None:
+            if buffered <= YJS_OUTBOUND_HIGH_WATERMARK:
+                return 'send'
+            self.lagging[client] = time.monotonic()
+            logger.warning(f"连接写缓冲积压 {buffered} 字节，暂停增量更新")
+            return 'skip'
+        if time.monotonic() - since > YJS_OUTBOUND_MAX_LAG_SECONDS:
+            del self.lagging[client]
+            logger.warning("连接长时间无法跟上更新，断开连接")
+            return 'drop'
+        if buffered <= YJS_OUTBOUND_LOW_WATERMARK:
+            del self.lagging[client]
+            return 'resync'
+        return 'skip'
+
+    def encode_state(self, document_id):
+        """文档当前的完整状态（单个紧凑更新）"""
+        return documents[document_id]['doc'].get_update()
+
+    async def flush_documents(self, document_ids):
+        """合并并写入指定文档的快照"""
+        loop = asyncio.get_running_loop()
+        for document_id in document_ids:
+            document = documents.get(document_id)
+            if document is None or not document['dirty']:
+                continue
+            document['dirty'] = False
+            try:
+                state = self.encode_state(document_id)
+                mark = self.store.mark(document_id)
+                html = yjs_utils.render_html(state)
+                await loop.run_in_executor(None, self.store.save, document_id, state, html, mark)
+                document['last_flush'] = time.monotonic()
+                document['size'] = len(state)
+            except Exception as e:
+                document['dirty'] = True
+                logger.error(f"写入文档 {document_id} 快照失败: {e}")
+
+    async def snapshot_loop(self):
+        """周期性写入有变化的文档，同一文档受防抖间隔限制"""
+        while True:
+            await asyncio.sleep(YJS_SNAPSHOT_INTERVAL)
+            now = time.monotonic()
+            due = [
+                document_id for document_id, document in documents.items()
+                if document['dirty'] and now - document['last_flush'] >= YJS_SNAPSHOT_DEBOUNCE
+            ][:YJS_SNAPSHOT_BATCH_SIZE]
+            if due:
+                await self.flush_documents(due)
+                logger.info(f"已写入 {len(due)} 个文档快照")
     
+    async def evict_document(self, document_id):
+        """写入快照后把文档移出内存，期间有客户端连接或新的更新时放弃"""
+        if connections.get(document_id) or document_id not in documents:
+            return False
+        await self.flush_documents([document_id])
+        document = documents.get(document_id)
+        if document is None or connections.get(document_id) or document['dirty']:
+            return False
+        del documents[document_id]
+        connections.pop(document_id, None)
+        awareness.pop(document_id, None)
+        self.evicted += 1
+        return True
+
+    async def evict_idle_documents(self):
+        """淘汰空闲超时的文档，总占用超出预算时再按LRU淘汰无人连接的文档"""
+        now = time.monotonic()
+        idle = sorted(
+            (document['last_used'], document_id) for document_id, document in documents.items()
+            if not connections.get(document_id)
+        )
+        evicted = 0
+        for last_used, document_id in idle:
+            if now - last_used >= YJS_DOCUMENT_IDLE_SECONDS and await self.evict_document(document_id):
+                evicted += 1
+
+        retained = sum(document['size'] for document in documents.values())
+        for _, document_id in idle:
+            if retained <= YJS_MEMORY_BUDGET:
+                break
+            size = documents.get(document_id, {}).get('size', 0)
+            if await self.evict_document(document_id):
+                evicted += 1
+                retained -= size
+        if retained > YJS_MEMORY_BUDGET:
+            logger.warning(f"文档状态超出内存预算: {retained} > {YJS_MEMORY_BUDGET} 字节")
+        if evicted:
+            logger.info(f"已从内存淘汰 {evicted} 个空闲文档，剩余 {len(documents)} 个")
+        return evicted
+
+    async def eviction_loop(self):
+        while True:
+            await asyncio.sleep(YJS_EVICTION_INTERVAL)
+            try:
+                await self.evict_idle_documents()
+            except Exception as e:
+                logger.error(f"淘汰空闲文档时出错: {e}")
+
+    def owns(self, document_id):
+        """分片模式下文档是否归属本分片"""
+        return self.ring is None or self.ring.owner(document_id) == self.shard_name
+
+    async def release_documents(self):
+        """哈希环变化后交出不再属于本分片的文档，返回交出的文档ID
+
+        断开这些文档的连接，发出合并窗口内的更新，写入快照并把日志提交到磁盘后移出内存。
+        返回后本分片不再写这些文档的日志和快照，路由进程收到确认后才把它们的连接转到新分片；
+        客户端重连后在同步握手中补发尚未送达的更新。
+        """
+        moved = [document_id for document_id in set(documents) | set(connections) if not self.owns(document_id)]
+        closing = [websocket.close(1012, 'document moved')
+                   for document_id in moved for websocket in list(connections.get(document_id, ()))]
+        await asyncio.gather(*closing, return_exceptions=True)
+        for document_id in moved:
+            # 等待连接处理协程完成注销
+            for _ in range(20):
+                if not connections.get(document_id):
+                    break
+                await asyncio.sleep(0.05)
+            self.flush_coalesced(document_id)
+            await self.flush_documents([document_id])
+            documents.pop(document_id, None)
+            connections.pop(document_id, None)
+            awareness.pop(document_id, None)
+            self.awareness_pending.pop(document_id, None)
+        await asyncio.get_running_loop().run_in_executor(None, self.store.release, moved)
+        if moved:
+            logger.info(f"分片 {self.shard_name} 交出 {len(moved)} 个文档")
+        return moved
+
+    async def hand_off(self, control, generation, shards):
+        """切换到新的哈希环，交出文档后向路由进程确认"""
+        self.ring = HashRing(shards)
+        try:
+            moved = await self.release_documents()
+        except Exception as e:
+            logger.error(f"分片 {self.shard_name} 交出文档失败: {e}")
+            control.send(('failed', generation, str(e)))
+            return
+        control.send(('released', generation, moved))
+
+    def watch_control(self, control):
+        """监听路由进程发来的分片列表"""
+        loop = asyncio.get_running_loop()
+
+        def on_readable():
+            try:
+                command, payload = control.recv()
+            except EOFError:
+                logger.warning("与路由进程的控制通道已关闭")
+                loop.remove_reader(control.fileno())
+                return
+            if command == 'shards':
+                generation, shards = payload
+                asyncio.create_task(self.hand_off(control, generation, shards))
+
+        loop.add_reader(control.fileno(), on_readable)
+
+    async def commit_loop(self):
+        """组提交：收集一个窗口内的更新后一次性写入日志"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.log_event.wait()
+            await asyncio.sleep(YJS_LOG_COMMIT_INTERVAL)
+            self.log_event.clear()
+            try:
+                await loop.run_in_executor(None, self.store.commit)
+            except Exception as e:
+                logger.error(f"写入更新日志失败: {e}")
+                self.log_event.set()
+
     async def handle_client(self, websocket, path):
         """处理客户端连接"""
-        # 从路径中提取文档ID
-        document_id = path.strip('/')
-        if not document_id:
-            document_id = 'default'
+        document_id = document_id_from_path(path)
+        if not self.owns(document_id):
+            # 文档已交给其他分片，客户端经路由重连
+            await websocket.close(1012, 'document moved')
+            return
         
         try:
             await self.register_client(websocket, document_id)
@@ -82,7 +707,7 @@ class YjsWebSocketServer:
             async for message in websocket:
                 # Y.js发送的是二进制数据
                 if isinstance(message, bytes):
-                    await self.broadcast_update(websocket, document_id, message)
+                    await self.handle_message(websocket, document_id, message)
                 else:
                     # 处理文本消息（如果有的话）
                     logger.info(f"收到文本消息: {message}")
@@ -103,15 +728,238 @@ class YjsWebSocketServer:
             self.host,
             self.port,
             ping_interval=20,
-            ping_timeout=10
+            ping_timeout=10,
+            compression=None,
+            extensions=compression_extensions(self.compression),
+            create_protocol=functools.partial(AuthenticatingProtocol, authenticate=self.authenticate)
         )
+        self.snapshot_task = asyncio.create_task(self.snapshot_loop())
+        self.commit_task = asyncio.create_task(self.commit_loop())
+        self.eviction_task = asyncio.create_task(self.eviction_loop())
+        self.awareness_task = asyncio.create_task(self.awareness_loop())
         
         logger.info(f"Y.js WebSocket服务器已启动: ws://{self.host}:{self.port}")
         return server
 
+class YjsShardRouter:
+    """多进程模式的路由：按文档ID的一致性哈希把连接转发到对应的分片进程
+
+    分片进程监听本机 port+1 起的端口，共享同一个数据目录。
+    收到 SIGUSR1 时增加一个分片并分两阶段重新平衡：先通知旧分片交出不再归属自己的文档，
+    旧分片写入快照、提交日志后通过控制通道确认，全部确认后路由才切换哈希环。
+    切换前到达的、归属将要改变的文档的连接暂缓转发，同一文档任何时刻只有一个分片写入。
+    """
+
+    def __init__(self, host='localhost', port=1234, shards=YJS_SHARDS):
+        self.host = host
+        self.port = port
+        self.initial_shards = shards
+        self.shards = {}  # 分片名 -> {'port', 'process', 'control'}
+        self.ring = None
+        self.handoff = None  # 进行中的重新平衡：(新哈希环, 完成事件)
+        self.generation = 0  # 重新平衡的序号，用于丢弃过期的确认
+        self._rebalance_lock = asyncio.Lock()
+        self._context = multiprocessing.get_context('spawn')
+
+    async def start_shard(self):
+        name = f'shard-{len(self.shards)}'
+        port = self.port + 1 + len(self.shards)
+        control, child_control = self._context.Pipe()
+        process = self._context.Process(
+            target=run_shard,
+            args=(name, port, list(self.shards) + [name], child_control),
+            daemon=True
+        )
+        process.start()
+        self.shards[name] = {'port': port, 'process': process, 'control': control}
+        try:
+            await self._wait_ready(port)
+        except OSError:
+            self._stop_shard(name)
+            raise
+        logger.info(f"分片 {name} 已启动: 127.0.0.1:{port}")
+        return name
+
+    def _stop_shard(self, name):
+        shard = self.shards.pop(name)
+        shard['process'].terminate()
+        shard['process'].join()
+
+    async def _wait_ready(self, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def add_shard(self):
+        """增加一个分片并重新平衡，旧分片未能全部确认交出时撤销"""
+        async with self._rebalance_lock:
+            previous = list(self.shards)
+            try:
+                name = await self.start_shard()
+            except OSError as e:
+                logger.error(f"新分片启动失败: {e}")
+                return
+            ring = HashRing(self.shards)
+            done = asyncio.Event()
+            self.handoff = (ring, done)
+            try:
+                if await self._hand_off(previous, list(self.shards)):
+                    self.ring = ring
+                    logger.info(f"已增加分片，当前分片数: {len(self.shards)}")
+                    return
+                # 恢复原来的哈希环，旧分片重新接受这些文档的连接
+                self._stop_shard(name)
+                await self._hand_off(previous, previous)
+                logger.error(f"分片 {name} 未能接手文档，已撤销本次增加")
+            finally:
+                self.handoff = None
+                done.set()
+
+    async def _hand_off(self, names, shards):
+        """通知分片 names 切换到分片列表 shards，等待全部确认交出文档，返回是否全部确认"""
+        self.generation += 1
+        generation = self.generation
+        for name in names:
+            self.shards[name]['control'].send(('shards', (generation, shards)))
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + YJS_HANDOFF_TIMEOUT
+        results = await asyncio.gather(*[
+            loop.run_in_executor(None, self._wait_released, name, generation, deadline) for name in names
+        ])
+        return all(results)
+
+    def _wait_released(self, name, generation, deadline):
+        """在线程池中等待分片的确认，忽略之前重新平衡遗留的确认"""
+        control = self.shards[name]['control']
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or not control.poll(remaining):
+                    logger.error(f"等待分片 {name} 交出文档超时")
+                    return False
+                command, acked, payload = control.recv()
+            except (EOFError, OSError) as e:
+                logger.error(f"分片 {name} 的控制通道已关闭: {e}")
+                return False
+            if acked != generation:
+                continue
+            if command == 'released':
+                if payload:
+                    logger.info(f"分片 {name} 已交出 {len(payload)} 个文档")
+                return True
+            logger.error(f"分片 {name} 交出文档失败: {payload}")
+            return False
+
+    async def route(self, document_id):
+        """文档所属分片的端口；文档的归属正在改变时等待旧分片确认交出后再转发"""
+        while self.handoff is not None:
+            ring, done = self.handoff
+            if ring.owner(document_id) == self.ring.owner(document_id):
+                break
+            await done.wait()
+        return self.shards[self.ring.owner(document_id)]['port']
+
+    async def _pipe(self, source, target, read_only=False):
+        try:
+            async for message in source:
+                if read_only and is_write_message(message):
+                    continue
+                await target.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def handle_client(self, websocket, path):
+        """把客户端连接双向转发到文档所属的分片"""
+        document_id = document_id_from_path(path)
+        port = await self.route(document_id)
+        try:
+            # 本机转发不压缩，压缩只发生在路由与客户端之间
+            upstream = await websockets.connect(f'ws://127.0.0.1:{port}{path}', max_size=None,
+                                                ping_interval=None, compression=None)
+        except OSError as e:
+            logger.error(f"无法连接文档 {document_id} 所在的分片: {e}")
+            await websocket.close(1013, 'shard unavailable')
+            return
+        read_only = not collab_auth.can_write(websocket.permission)
+        tasks = [asyncio.create_task(self._pipe(websocket, upstream, read_only)),
+                 asyncio.create_task(self._pipe(upstream, websocket))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await upstream.close()
+        # 分片交出文档时以1012关闭，客户端据此重连到新分片
+        await websocket.close(upstream.close_code or 1000, upstream.close_reason or '')
+
+    async def start_server(self):
+        for _ in range(self.initial_shards):
+            await self.start_shard()
+        self.ring = HashRing(self.shards)
+        server = await websockets.serve(
+            self.handle_client,
+            self.host,
+            self.port,
+            ping_interval=20,
+            ping_timeout=10,
+            compression=None,
+            extensions=compression_extensions(),
+            create_protocol=functools.partial(AuthenticatingProtocol, authenticate=collab_auth.AUTH_REQUIRED)
+        )
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, 'SIGUSR1'):
+            loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.create_task(self.add_shard()))
+        logger.info(f"Y.js分片路由已启动: ws://{self.host}:{self.port}，分片数: {len(self.shards)}")
+        return server
+
+    def stop(self):
+        for shard in self.shards.values():
+            shard['process'].terminate()
+        for shard in self.shards.values():
+            shard['process'].join()
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_shard(name, port, shards, control):
+    """分片进程入口"""
+    # 路由进程结束分片时同样提交最后一个窗口内的更新
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    server = YjsWebSocketServer('127.0.0.1', port, shard_name=name, shards=shards, compression='off',
+                                authenticate=False)
+
+    async def run_server():
+        websocket_server = await server.start_server()
+        server.watch_control(control)
+        await websocket_server.wait_closed()
+
+    try:
+        asyncio.run(run_server())
+    except KeyboardInterrupt:
+        server.store.commit()
+
+
 def main():
     """主函数"""
-    server = YjsWebSocketServer()
+    parser = argparse.ArgumentParser(description='Y.js WebSocket服务器')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--shards', type=int, default=YJS_SHARDS, help='分片进程数，大于1时启用多进程模式')
+    args = parser.parse_args()
+
+    if args.shards > 1:
+        server = YjsShardRouter(args.host, args.port, args.shards)
+    else:
+        server = YjsWebSocketServer(args.host, args.port)
     
     async def run_server():
         websocket_server = await server.start_server()
@@ -120,7 +968,12 @@ def main():
     try:
         asyncio.run(run_server())
     except KeyboardInterrupt:
+        if isinstance(server, YjsShardRouter):
+            server.stop()
+        else:
+            # 提交最后一个窗口内的更新
+            server.store.commit()
         logger.info("服务器已停止")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
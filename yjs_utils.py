@@ -0,0 +1,476 @@
+"""
+Y.js 协议与文档状态工具
+供 yjs_server.py 与 Flask 协同编辑模块共用：解析 y-protocols 消息、合并更新、渲染HTML，
+以及 Y.js 服务器数据目录的读写（YjsSnapshotStore）
+"""
+
+import os
+import html
+import mmap
+import logging
+import threading
+from typing import Dict
+from urllib.parse import quote
+
+from pycrdt import Doc, XmlElement, XmlFragment, XmlText, merge_updates as _merge_updates
+
+# y-protocols 消息类型
+MESSAGE_SYNC = 0
+MESSAGE_AWARENESS = 1
+MESSAGE_QUERY_AWARENESS = 3
+
+# 同步消息子类型
+SYNC_STEP1 = 0
+SYNC_STEP2 = 1
+SYNC_UPDATE = 2
+
+# Tiptap Collaboration 扩展默认使用的 XmlFragment 名称
+DEFAULT_FRAGMENT = 'default'
+
+# Y.js 服务器的快照存储目录
+YJS_DATA_DIR = os.getenv('YJS_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yjs_data'))
+
+logger = logging.getLogger(__name__)
+
+
+def write_var_uint(value):
+    """lib0 变长无符号整数编码"""
+    buf = bytearray()
+    while value > 0x7F:
+        buf.append(0x80 | (value & 0x7F))
+        value >>= 7
+    buf.append(value & 0x7F)
+    return bytes(buf)
+
+
+def read_var_uint(data, pos=0):
+    """读取 lib0 变长无符号整数，返回 (数值, 新位置)"""
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError('变长整数被截断')
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def read_var_bytes(data, pos=0):
+    """读取带长度前缀的字节串，返回 (字节, 新位置)"""
+    length, pos = read_var_uint(data, pos)
+    if pos + length > len(data):
+        raise ValueError('字节串被截断')
+    return bytes(data[pos:pos + length]), pos + length
+
+
+def read_var_string(data, pos=0):
+    value, pos = read_var_bytes(data, pos)
+    return value.decode('utf-8'), pos
+
+
+def write_var_string(value):
+    data = value.encode('utf-8')
+    return write_var_uint(len(data)) + data
+
+
+def encode_sync_message(sync_type, payload):
+    return write_var_uint(MESSAGE_SYNC) + write_var_uint(sync_type) + write_var_uint(len(payload)) + payload
+
+
+def encode_sync_step1(state_vector):
+    """同步第一步：发送本端的状态向量"""
+    return encode_sync_message(SYNC_STEP1, state_vector)
+
+
+def encode_sync_step2(update):
+    """同步第二步：回复对端缺失的更新"""
+    return encode_sync_message(SYNC_STEP2, update)
+
+
+def encode_sync_update(update):
+    """把Y.js更新封装为 y-protocols 同步更新消息"""
+    return encode_sync_message(SYNC_UPDATE, update)
+
+
+def decode_message(message):
+    """解析 y-protocols 消息
+
+    同步消息返回 (MESSAGE_SYNC, 子类型, 载荷)，感知消息返回 (MESSAGE_AWARENESS, None, 载荷)，
+    其他类型返回 (类型, None, 剩余字节)。
+    """
+    message_type, pos = read_var_uint(message)
+    if message_type == MESSAGE_SYNC:
+        sync_type, pos = read_var_uint(message, pos)
+        payload, _ = read_var_bytes(message, pos)
+        return message_type, sync_type, payload
+    if message_type == MESSAGE_AWARENESS:
+        payload, _ = read_var_bytes(message, pos)
+        return message_type, None, payload
+    return message_type, None, bytes(message[pos:])
+
+
+def decode_awareness_update(payload):
+    """解析感知更新，返回 [(clientID, clock, 状态JSON字符串)]，状态为 'null' 表示该客户端已离开"""
+    count, pos = read_var_uint(payload)
+    entries = []
+    for _ in range(count):
+        client_id, pos = read_var_uint(payload, pos)
+        clock, pos = read_var_uint(payload, pos)
+        state, pos = read_var_string(payload, pos)
+        entries.append((client_id, clock, state))
+    return entries
+
+
+def encode_awareness_message(entries):
+    """把 [(clientID, clock, 状态JSON字符串)] 封装为 y-protocols 感知消息"""
+    payload = write_var_uint(len(entries)) + b''.join(
+        write_var_uint(client_id) + write_var_uint(clock) + write_var_string(state)
+        for client_id, clock, state in entries
+    )
+    return write_var_uint(MESSAGE_AWARENESS) + write_var_uint(len(payload)) + payload
+
+
+def extract_update(message):
+    """从客户端消息中取出文档更新，非文档更新（感知、sync step 1 等）返回None"""
+    try:
+        message_type, sync_type, payload = decode_message(message)
+    except ValueError:
+        return None
+    if message_type == MESSAGE_SYNC and sync_type in (SYNC_STEP2, SYNC_UPDATE):
+        return payload
+    return None
+
+
+def merge_updates(updates):
+    """把多个Y.js更新合并为一个等价的紧凑更新"""
+    updates = [u for u in updates if u]
+    if not updates:
+        return b''
+    if len(updates) == 1:
+        return updates[0]
+    return _merge_updates(*updates)
+
+
+# ProseMirror 节点名 -> HTML 标签
+_NODE_TAGS = {
+    'paragraph': 'p',
+    'blockquote': 'blockquote',
+    'bulletList': 'ul',
+    'orderedList': 'ol',
+    'listItem': 'li',
+    'taskList': 'ul',
+    'taskItem': 'li',
+    'table': 'table',
+    'tableRow': 'tr',
+    'tableCell': 'td',
+    'tableHeader': 'th',
+    'horizontalRule': 'hr',
+    'hardBreak': 'br',
+    'image': 'img',
+}
+_VOID_TAGS = {'hr', 'br', 'img'}
+# 需要原样输出为HTML属性的节点属性
+_PASSTHROUGH_ATTRS = ('src', 'alt', 'title', 'start', 'colspan', 'rowspan')
+
+# ProseMirror mark 名 -> HTML 标签
+_MARK_TAGS = {
+    'bold': 'strong',
+    'italic': 'em',
+    'strike': 's',
+    'underline': 'u',
+    'code': 'code',
+    'highlight': 'mark',
+    'subscript': 'sub',
+    'superscript': 'sup',
+}
+
+
+# 按节点名额外渲染的属性，其余属性只有 _PASSTHROUGH_ATTRS 和 textAlign
+_NODE_ATTRS = {'heading': ('level',), 'codeBlock': ('language',), 'taskItem': ('checked',)}
+# 按 mark 名渲染的属性，其余 mark 不带属性
+_MARK_ATTRS = {'link': ('href', 'target', 'rel', 'class'), 'textStyle': ('color',)}
+
+
+class UnsupportedContent(ValueError):
+    """文档中有渲染HTML时会丢失的节点、mark或属性（仅 strict 模式）"""
+
+
+def _check_attrs(kind, name, attrs, allowed):
+    lost = [key for key, value in attrs.items() if value is not None and key not in allowed]
+    if lost:
+        raise UnsupportedContent(f'{kind} {name} 的属性 {", ".join(sorted(lost))} 无法渲染为HTML')
+
+
+def _render_attrs(attrs):
+    return ''.join(f' {name}="{html.escape(str(value))}"' for name, value in attrs if value is not None)
+
+
+def _render_text(node, strict):
+    parts = []
+    for content, marks in node.diff():
+        if not isinstance(content, str):
+            if strict:
+                raise UnsupportedContent('文本中嵌入了非文本内容')
+            continue
+        text = html.escape(content)
+        for mark, value in (marks or {}).items():
+            value = value if isinstance(value, dict) else {}
+            if strict:
+                if mark not in _MARK_TAGS and mark not in _MARK_ATTRS:
+                    raise UnsupportedContent(f'不支持的 mark: {mark}')
+                _check_attrs('mark', mark, value, _MARK_ATTRS.get(mark, ()))
+            if mark == 'link':
+                link_attrs = [(key, value.get(key)) for key in _MARK_ATTRS['link']]
+                text = f'<a{_render_attrs(link_attrs)}>{text}</a>'
+            elif mark == 'textStyle':
+                color = value.get('color')
+                style = [('style', f'color: {color}')] if color else []
+                text = f'<span{_render_attrs(style)}>{text}</span>'
+            elif mark in _MARK_TAGS:
+                tag = _MARK_TAGS[mark]
+                text = f'<{tag}>{text}</{tag}>'
+        parts.append(text)
+    return ''.join(parts)
+
+
+def _render_node(node, strict):
+    if isinstance(node, XmlText):
+        return _render_text(node, strict)
+    if not isinstance(node, XmlElement):
+        if strict:
+            raise UnsupportedContent(f'不支持的节点类型: {type(node).__name__}')
+        return ''
+
+    name = node.tag
+    attributes = dict(node.attributes)
+    if strict:
+        if name not in _NODE_TAGS and name not in _NODE_ATTRS:
+            raise UnsupportedContent(f'不支持的节点: {name}')
+        _check_attrs('节点', name, attributes, _PASSTHROUGH_ATTRS + ('textAlign',) + _NODE_ATTRS.get(name, ()))
+    children = ''.join(_render_node(child, strict) for child in node.children)
+
+    if name == 'heading':
+        try:
+            level = min(max(int(float(attributes.get('level', 1))), 1), 6)
+        except (TypeError, ValueError):
+            level = 1
+        tag = f'h{level}'
+    elif name == 'codeBlock':
+        language = attributes.get('language')
+        code_attrs = [('class', f'language-{language}')] if language else []
+        return f'<pre><code{_render_attrs(code_attrs)}>{children}</code></pre>'
+    else:
+        tag = _NODE_TAGS.get(name, 'div')
+
+    html_attrs = [(key, attributes[key]) for key in _PASSTHROUGH_ATTRS if key in attributes]
+    if attributes.get('textAlign') and attributes['textAlign'] != 'left':
+        html_attrs.append(('style', f"text-align: {attributes['textAlign']}"))
+    if name in ('taskList', 'taskItem'):
+        html_attrs.append(('data-type', name))
+    if name == 'taskItem':
+        html_attrs.append(('data-checked', str(bool(attributes.get('checked'))).lower()))
+    if tag == 'div' and name not in _NODE_TAGS:
+        html_attrs.append(('data-type', name))
+
+    if tag in _VOID_TAGS:
+        return f'<{tag}{_render_attrs(html_attrs)}>'
+    return f'<{tag}{_render_attrs(html_attrs)}>{children}</{tag}>'
+
+
+def render_html(state, fragment=DEFAULT_FRAGMENT, strict=False):
+    """把Y.js文档状态中 Tiptap 的 XmlFragment 渲染为HTML
+
+    strict 为 True 时遇到无法从HTML还原的内容（未知节点或 mark、额外的属性）抛出 UnsupportedContent，
+    供需要用HTML代替原文档的场景使用；否则尽量渲染，丢弃无法表示的部分。
+    """
+    if not state:
+        return ''
+    doc = Doc()
+    doc.apply_update(state)
+    root = doc.get(fragment, type=XmlFragment)
+    return ''.join(_render_node(child, strict) for child in root.children)
+
+
+class YjsSnapshotStore:
+    """文档的本地持久化：每个文档一个追加写的更新日志（.ylog）和一个压缩快照（.ystate）
+
+    更新先进入内存缓冲，由 commit 批量追加到日志，每个文件每批只 fsync 一次；
+    写入快照后截断日志中已并入快照的部分。快照和HTML先写临时文件再原子替换。
+    日志偏移按追加的总字节数计，_bases 记录日志文件开头对应的偏移。
+    """
+
+    def __init__(self, directory=YJS_DATA_DIR):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()  # 保护内存缓冲和偏移，持有时间很短
+        self._io_lock = threading.Lock()  # 串行化日志文件的追加、截断和读取
+        self._pending: Dict[str, list] = {}  # document_id -> 未提交的日志记录
+        self._offsets: Dict[str, int] = {}  # document_id -> 已追加的日志总字节数（含未提交）
+        self._bases: Dict[str, int] = {}  # document_id -> 日志文件开头对应的偏移
+
+    def _path(self, document_id, suffix):
+        return os.path.join(self.directory, quote(document_id, safe='') + suffix)
+
+    def _write(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _read_snapshot(self, document_id):
+        try:
+            with open(self._path(document_id, '.ystate'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+    def _read_log(self, document_id, repair=True):
+        """以内存映射方式逐条读取日志记录，返回 (更新列表, 有效长度)
+
+        repair 为 False 时不截断不完整的尾部，供其他进程在服务运行时只读访问。
+        """
+        path = self._path(document_id, '.ylog')
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return [], 0
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return [], 0
+            updates = []
+            pos = 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                while pos < size:
+                    try:
+                        update, next_pos = read_var_bytes(mapped, pos)
+                    except ValueError:
+                        break
+                    updates.append(update)
+                    pos = next_pos
+        if pos < size and repair:
+            # 写入时崩溃留下的不完整记录
+            logger.warning(f"日志 {path} 尾部在偏移 {pos} 处不完整，已截断")
+            os.truncate(path, pos)
+        return updates, pos
+
+    def load(self, document_id):
+        """读取快照并重放日志，返回文档的Y.js状态，不存在时返回空字节"""
+        with self._io_lock:
+            snapshot = self._read_snapshot(document_id)
+            updates, size = self._read_log(document_id)
+            with self._lock:
+                if document_id not in self._offsets:
+                    self._bases[document_id] = 0
+                    self._offsets[document_id] = size
+        if not updates:
+            return snapshot
+        return merge_updates([snapshot] + updates)
+
+    def peek(self, document_id):
+        """只读方式读取文档的Y.js状态，不修改日志也不记录偏移
+
+        先读日志再读快照：两次读取之间服务端写入快照并截断日志时，
+        读到的旧日志已包含在新快照中，结果不会缺少更新。
+        """
+        updates, _ = self._read_log(document_id, repair=False)
+        snapshot = self._read_snapshot(document_id)
+        if not updates:
+            return snapshot
+        return merge_updates([snapshot] + updates)
+
+    def append(self, document_id, update):
+        """缓冲一条更新，等待下一次 commit 写入日志"""
+        record = write_var_uint(len(update)) + update
+        with self._lock:
+            self._pending.setdefault(document_id, []).append(record)
+            self._offsets[document_id] = self._offsets.get(document_id, 0) + len(record)
+
+    def mark(self, document_id):
+        """当前的日志偏移，与文档状态同时取得，用于写入快照后截断日志"""
+        with self._lock:
+            return self._offsets.get(document_id, 0)
+
+    def _take_pending(self, document_ids=None):
+        with self._lock:
+            if document_ids is None:
+                document_ids = list(self._pending)
+            return {document_id: self._pending.pop(document_id)
+                    for document_id in document_ids if document_id in self._pending}
+
+    def _restore_pending(self, batch):
+        with self._lock:
+            for document_id, records in batch.items():
+                self._pending[document_id] = records + self._pending.get(document_id, [])
+
+    def _append_records(self, batch):
+        try:
+            for document_id, records in list(batch.items()):
+                with open(self._path(document_id, '.ylog'), 'ab') as f:
+                    end = f.tell()
+                    try:
+                        f.write(b''.join(records))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    except Exception:
+                        # 去掉可能已部分写入的记录，重试时不会重复写入，日志偏移保持准确
+                        f.truncate(end)
+                        raise
+                del batch[document_id]
+        except Exception:
+            # 未写入的记录放回缓冲，下次提交时重试
+            self._restore_pending(batch)
+            raise
+
+    def commit(self):
+        """把缓冲的更新批量追加到各文档日志，返回写入的文档数"""
+        with self._io_lock:
+            batch = self._take_pending()
+            count = len(batch)
+            self._append_records(batch)
+            return count
+
+    def save(self, document_id, state, html, mark=None):
+        """写入快照和HTML，然后截断日志中偏移 mark 之前（已并入快照）的部分
+
+        截断前崩溃时日志会重放快照中已有的更新，Y.js更新是幂等的，结果不变。
+        """
+        self._write(self._path(document_id, '.ystate'), state)
+        self._write(self._path(document_id, '.html'), html.encode('utf-8'))
+        if mark is not None:
+            self._truncate_log(document_id, mark)
+
+    def release(self, document_ids):
+        """把文档未提交的日志记录写入磁盘（fsync），并清除其日志偏移
+
+        文档交给其他进程之前调用，之后本进程不再写这些文档的日志和快照。
+        """
+        with self._io_lock:
+            self._append_records(self._take_pending(document_ids))
+            with self._lock:
+                for document_id in document_ids:
+                    self._offsets.pop(document_id, None)
+                    self._bases.pop(document_id, None)
+
+    def _truncate_log(self, document_id, mark):
+        with self._io_lock:
+            self._append_records(self._take_pending([document_id]))
+            with self._lock:
+                base = self._bases.get(document_id, 0)
+            if mark <= base:
+                return
+            path = self._path(document_id, '.ylog')
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(mark - base)
+                    remainder = f.read()
+            except FileNotFoundError:
+                remainder = b''
+            self._write(path, remainder)
+            with self._lock:
+                self._bases[document_id] = mark